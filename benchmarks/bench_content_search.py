@@ -0,0 +1,128 @@
+"""Latency of searching note contents on a throwaway database.
+
+Compares decrypting every note and scanning its text, the only way to
+search encrypted contents before, with a lookup in the blind keyword
+index kept by search_index and with the in-memory session_index. Also
+times indexing the whole vault once, as search_index.backfill does for
+notes saved before the index existed and as a session index is built
+after unlocking, and writing index rows through peewee's insert_many
+against the prepared statement of storage.insert_rows that index_note uses.
+
+Run from the repository root:
+    python -m benchmarks.bench_content_search [--notes N] [--words N]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+from peewee import chunked
+
+import models as m
+import search_index
+import session_index
+import storage
+import vault
+import crypto as Crypto
+
+VOCABULARY = ['word{}'.format(i) for i in range(5000)]
+
+
+def populate(path, notes, words):
+    database = SqliteDatabase(path)
+    m.proxy.initialize(database)
+    database.create_tables(m.MODELS)
+    crypto = Crypto.Crypto()
+    keyring = vault.unlock('bench')
+    generator = random.Random(4156)
+    with database.atomic():
+        for i in range(notes):
+            data_key, key = keyring.new_note_key()
+            text = ' '.join(generator.choice(VOCABULARY) for _ in range(words))
+            m.Note.create(title='note ' + str(i), content=crypto.encrypt(text, key),
+                          vault=keyring.vault, data_key=data_key)
+    return database, keyring
+
+
+def compare_inserts(database, notes, words):
+    """Time writing the index rows of notes through insert_many and insert_rows"""
+    fields = [m.SearchTerm.term, m.SearchTerm.note]
+    batches = [[('bench{}'.format(i), note_id) for i in range(words)]
+               for note_id in range(1, notes + 1)]
+
+    def with_insert_many(rows):
+        for batch in chunked(rows, 100):
+            m.SearchTerm.insert_many(batch, fields=fields).execute()
+
+    elapsed = {}
+    for label, insert in (('insert_many', with_insert_many),
+                          ('insert_rows', lambda rows: storage.insert_rows(fields, rows))):
+        start = time.perf_counter()
+        with database.atomic():
+            for rows in batches:
+                insert(rows)
+        elapsed[label] = time.perf_counter() - start
+        m.SearchTerm.delete().where(m.SearchTerm.term.startswith('bench')).execute()
+        print('{:<18} {:>12.0f} ms for {} rows'.format(
+            label, elapsed[label] * 1000, notes * words))
+    assert elapsed['insert_rows'] < elapsed['insert_many']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=2000)
+    parser.add_argument('--words', type=int, default=300)
+    parser.add_argument('--queries', type=int, default=20)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        database, keyring = populate(os.path.join(directory, 'bench.db'), args.notes, args.words)
+        start = time.perf_counter()
+        indexed = search_index.backfill(keyring)
+        print('{} notes of {} words indexed in {:.0f} ms'.format(
+            indexed, args.words, (time.perf_counter() - start) * 1000))
+        start = time.perf_counter()
+        index = session_index.SessionIndex(keyring)
+        index.build()
+        print('session index of {} notes built in {:.0f} ms'.format(
+            len(index.texts), (time.perf_counter() - start) * 1000))
+        compare_inserts(database, args.notes, args.words)
+        queries = ['{} {}'.format(*random.Random(i).sample(VOCABULARY, 2))
+                   for i in range(args.queries)]
+
+        def scan(query):
+            wanted = search_index.words(query)
+            return {result.item.id for result in keyring.decrypt_many(m.Note.select())
+                    if wanted <= search_index.words(result.value)}
+
+        def lookup(query):
+            return {note.id for note in m.Note.select(m.Note.id).where(
+                m.Note.id.in_(search_index.matching_notes(query, keyring.master)))}
+
+        print('{:<18} {:>12} {:>10}'.format('', 'ms/query', 'matches'))
+        results = {}
+        for label, search in (('decrypt all', scan), ('blind index', lookup),
+                              ('session index', lambda query: set(index.query(query)))):
+            start = time.perf_counter()
+            results[label] = [search(query) for query in queries]
+            elapsed = time.perf_counter() - start
+            print('{:<18} {:>12.2f} {:>10}'.format(
+                label, elapsed * 1000 / len(queries), sum(map(len, results[label]))))
+        assert results['decrypt all'] == results['blind index'] == results['session index']
+        for label, query in (('phrase', '"{}"'.format(queries[0])),
+                             ('substring', '*{}*'.format(queries[0].split()[0][2:]))):
+            start = time.perf_counter()
+            matches = index.query(query)
+            print('{:<18} {:>12.2f} {:>10}'.format(
+                'session ' + label, (time.perf_counter() - start) * 1000, len(matches)))
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
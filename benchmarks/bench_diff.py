@@ -0,0 +1,99 @@
+"""Latency of diffing two versions of a large note.
+
+Compares list(difflib.Differ().compare(...)), what diffcheck always did,
+with line_diff.unified: the time until its first line is ready to print
+and the time to produce all of it. One note has lines edited, removed
+and added all over it; in the other a whole section was reworded, a
+large replaced hunk of similar lines, where Differ's intraline matching
+gets quadratic. A last note is rewritten line by line between blank
+lines, which share no unique line to anchor on and would take Myers'
+search tens of seconds without its edit and time bounds.
+
+Run from the repository root:
+    python -m benchmarks.bench_diff [--lines N] [--edit-every N] [--section N]
+"""
+import argparse
+import difflib
+import random
+import time
+
+import line_diff
+
+
+def note(lines):
+    generator = random.Random(4156)
+    return ['{} {}'.format(i, ' '.join(str(generator.randint(0, 99)) for _ in range(8)))
+            for i in range(lines)]
+
+
+def scattered(lines, edit_every):
+    old = note(lines)
+    new = []
+    for i, line in enumerate(old):
+        if i % edit_every == 0:
+            new.append(line + ' edited')
+        elif i % edit_every == 1:
+            continue
+        else:
+            new.append(line)
+        if i % (edit_every * 3) == 2:
+            new.append('inserted line {}'.format(i))
+    return old, new
+
+
+def reworded(lines, section):
+    old = note(lines)
+    start = (lines - section) // 2
+    return old, old[:start] + [line + ' edited' for line in old[start:start + section]] + \
+        old[start + section:]
+
+
+def rewritten(lines):
+    old, new = [], []
+    for i in range(lines):
+        old += ['old line {}'.format(i), '']
+        new += ['new line {}'.format(i), '']
+    return old, new
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def compare(old, new, skip_differ):
+    print('{} and {} lines'.format(len(old), len(new)))
+    print('{:<18} {:>14} {:>10} {:>10}'.format('', 'first line ms', 'total ms', 'lines'))
+    if not skip_differ:
+        diff, elapsed = timed(lambda: list(difflib.Differ().compare(old, new)))
+        print('{:<18} {:>14.1f} {:>10.1f} {:>10}'.format('Differ', elapsed, elapsed, len(diff)))
+    for label, context in (('unified, context', line_diff.CONTEXT), ('unified, whole', None)):
+        lines = line_diff.unified(old, new, context=context)
+        _, first = timed(lambda: next(lines))
+        rest, elapsed = timed(lambda: list(lines))
+        print('{:<18} {:>14.1f} {:>10.1f} {:>10}'.format(label, first, first + elapsed,
+                                                          len(rest) + 1))
+    rebuilt = []
+    for tag, i_1, i_2, j_1, j_2 in line_diff.opcodes(old, new):
+        rebuilt.extend(old[i_1:i_2] if tag == 'equal' else new[j_1:j_2])
+    assert rebuilt == new
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=4000)
+    parser.add_argument('--edit-every', type=int, default=5)
+    parser.add_argument('--section', type=int, default=200)
+    parser.add_argument('--skip-differ', action='store_true')
+    args = parser.parse_args()
+    print('Edits all over the note')
+    compare(*scattered(args.lines, args.edit_every), skip_differ=args.skip_differ)
+    print('\nA reworded section of {} lines'.format(args.section))
+    compare(*reworded(args.lines, args.section), skip_differ=args.skip_differ)
+    print('\nA rewritten note, blank lines between its lines')
+    compare(*rewritten(args.lines), skip_differ=True)
+
+
+if __name__ == '__main__':
+    main()
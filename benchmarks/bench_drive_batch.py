@@ -0,0 +1,97 @@
+"""Round trips made by upload_to_drive.main against a local fake Drive.
+
+Syncs a synthetic folder tree twice (initial upload, then a sync after
+adding, changing and removing folders and files), once with metadata
+calls sent one per request and once through Drive batch requests, and
+counts the HTTP round trips the fake server saw.
+
+Run from the repository root:
+    python -m benchmarks.bench_drive_batch [--folders N] [--files N] [--latency S]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, local_tree, sync_state
+
+
+def serial(service, requests):  # pylint: disable=unused-argument
+    """execute_batched without batching: one round trip per call"""
+    results = []
+    for request in requests:
+        try:
+            results.append((request.execute(), None))
+        except Exception as error:  # pylint: disable=broad-except
+            results.append((None, error))
+    return results
+
+
+def make_tree(full_path, folders, files):
+    # written an hour ago, so only files touched by change_tree look newer than Drive
+    past = time.time() - 3600
+    for i in range(folders):
+        folder = os.path.join(full_path, 'folder{}'.format(i), 'inner{}'.format(i))
+        os.makedirs(folder)
+        for j in range(files):
+            for directory in (folder, os.path.dirname(folder)):
+                path = os.path.join(directory, 'note{}.txt'.format(j))
+                with open(path, 'w') as note:
+                    note.write('note {} {}\n'.format(i, j))
+                os.utime(path, (past, past))
+
+
+def change_tree(full_path, folders):
+    for i in range(0, folders, 3):
+        shutil.rmtree(os.path.join(full_path, 'folder{}'.format(i)))
+    for i in range(folders, folders + folders // 3):
+        os.makedirs(os.path.join(full_path, 'folder{}'.format(i), 'inner{}'.format(i)))
+    for i in range(1, folders, 3):
+        with open(os.path.join(full_path, 'folder{}'.format(i), 'note0.txt'), 'w') as note:
+            note.write('changed\n')
+
+
+def run(label, args, batched):
+    directory = tempfile.mkdtemp()
+    full_path = os.path.join(directory, 'sync')
+    make_tree(full_path, args.folders, args.files)
+    patch = mock.patch('upload_to_drive.execute_batched', serial) if not batched \
+        else mock.patch.object(upload_to_drive, 'execute_batched', upload_to_drive.execute_batched)
+    try:
+        with FakeDrive(latency=args.latency) as drive, patch:
+            row = [label]
+            for step in (None, change_tree):
+                if step:
+                    step(full_path, args.folders)
+                drive.reset_counters()
+                start = time.perf_counter()
+                upload_to_drive.main(full_path, drive.build_service)
+                row += [drive.round_trips, time.perf_counter() - start]
+                assert drive.tree() == local_tree(directory), 'Drive does not match local'
+
+            print('{:<10} {:>12} {:>10.2f} {:>12} {:>10.2f}'.format(*row))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folders', type=int, default=30)
+    parser.add_argument('--files', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.01)
+    args = parser.parse_args()
+    print('{} folders of {} files each, {:.0f} ms per round trip'.format(
+        args.folders * 2, args.files, args.latency * 1000))
+    print('{:<10} {:>12} {:>10} {:>12} {:>10}'.format(
+        '', 'initial RTs', 'seconds', 'resync RTs', 'seconds'))
+    with sync_state():
+        run('serial', args, batched=False)
+        run('batched', args, batched=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""API calls made by incremental Drive syncs against a local fake Drive.
+
+Uploads a synthetic folder tree, then runs a sync with nothing changed,
+one after changing a local file and a download after changing a file on
+Drive. Each runs once from the saved Changes API page token and once
+with the saved state dropped, which forces the full listing.
+
+Run from the repository root:
+    python -m benchmarks.bench_drive_changes [--folders N] [--files N]
+"""
+import argparse
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+import download_from_drive
+import models as m
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, local_tree, sync_state
+
+
+def make_tree(full_path, folders, files):
+    past = time.time() - 3600
+    for i in range(folders):
+        folder = os.path.join(full_path, 'folder{}'.format(i), 'inner')
+        os.makedirs(folder)
+        for j in range(files):
+            for directory in (folder, os.path.dirname(folder)):
+                path = os.path.join(directory, 'note{}.txt'.format(j))
+                with open(path, 'w') as note:
+                    note.write('note {} {}\n'.format(i, j))
+                os.utime(path, (past, past))
+
+
+def settle(drive, directory):
+    """Gives local files the mtime of their Drive copy, as the sync compares them"""
+    for item in list(drive.files.values()):
+        if 'modifiedTime' in item and 'md5Checksum' in item:
+            mtime = datetime.datetime.strptime(item['modifiedTime'][:-2], "%Y-%m-%dT%H:%M:%S.%f")
+            drive_time = time.mktime(mtime.timetuple())
+            os.utime(os.path.join(directory, drive.path_of(item)), (drive_time, drive_time))
+
+
+def change_local(full_path):
+    with open(os.path.join(full_path, 'folder0', 'note0.txt'), 'w') as note:
+        note.write('changed locally\n')
+
+
+def change_drive(drive):
+    item = next(f for f in drive.files.values()
+                if drive.path_of(f) == 'sync/folder1/note0.txt')
+    drive.write(item, b'changed on drive\n')
+
+
+def run(label, args, incremental):
+    directory = tempfile.mkdtemp()
+    full_path = os.path.join(directory, 'sync')
+    make_tree(full_path, args.folders, args.files)
+    steps = [('no-op', upload_to_drive, None),
+             ('local edit', upload_to_drive, lambda drive: change_local(full_path)),
+             ('drive edit', download_from_drive, change_drive)]
+    try:
+        with FakeDrive() as drive:
+            upload_to_drive.main(full_path, drive.build_service)
+            settle(drive, directory)
+            row = [label]
+            for _, module, step in steps:
+                if step:
+                    step(drive)
+                if not incremental:
+                    m.DriveItem.delete().execute()
+                    m.DriveRoot.delete().execute()
+                drive.reset_counters()
+                module.main(full_path, drive.build_service)
+                row.append(drive.calls)
+                assert drive.tree() == local_tree(directory), 'Drive does not match local'
+            print('{:<12} {:>8} {:>12} {:>12}'.format(*row))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folders', type=int, default=30)
+    parser.add_argument('--files', type=int, default=3)
+    args = parser.parse_args()
+    print('{} folders of {} files each, API calls per sync'.format(
+        args.folders * 2, args.files))
+    print('{:<12} {:>8} {:>12} {:>12}'.format('', 'no-op', 'local edit', 'drive edit'))
+    with sync_state():
+        run('full', args, incremental=False)
+        run('incremental', args, incremental=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Local disk reads of a Drive sync with and without the sync manifest.
+
+Uploads a folder of larger files to a local fake Drive, then times a
+sync with nothing changed, once trusting the manifest's size and mtime
+and once with the manifest emptied so every file is hashed again.
+
+Run from the repository root:
+    python -m benchmarks.bench_drive_manifest [--files N] [--size KB]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import models as m
+import upload_to_drive
+from benchmarks.bench_listing import bytes_read
+from benchmarks.fake_drive import FakeDrive, sync_state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--size', type=int, default=1024, help='file size in KB')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    full_path = os.path.join(directory, 'sync')
+    os.makedirs(full_path)
+    for i in range(args.files):
+        with open(os.path.join(full_path, 'note{}.txt'.format(i)), 'wb') as note:
+            note.write(os.urandom(args.size * 1024))
+
+    print('{} files of {} KB, sync with nothing changed'.format(args.files, args.size))
+    print('{:<10} {:>10} {:>10}'.format('', 'MB read', 'ms'))
+    try:
+        with sync_state(), FakeDrive() as drive:
+            upload_to_drive.main(full_path, drive.build_service)
+            upload_to_drive.main(full_path, drive.build_service)
+            for label, keep in (('rehash', False), ('manifest', True)):
+                if not keep:
+                    m.DriveFile.delete().execute()
+                before, start = bytes_read(), time.perf_counter()
+                upload_to_drive.main(full_path, drive.build_service)
+                elapsed = time.perf_counter() - start
+                print('{:<10} {:>10.1f} {:>10.1f}'.format(
+                    label, (bytes_read() - before) / (1024 * 1024), elapsed * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
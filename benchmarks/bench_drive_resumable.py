@@ -0,0 +1,84 @@
+"""Cost of finishing an interrupted upload of a large file to a local fake Drive.
+
+Uploads a file with upload_to_drive.upload_new_file, cutting the
+connection once part of it has gone up. The upload is then run again
+from a new service, as a later sync would, once after dropping the saved
+upload session (starting over, as every upload used to) and once with it
+(resuming from the last byte Drive acknowledged).
+
+Run from the repository root:
+    python -m benchmarks.bench_drive_resumable [--mib N] [--chunk-kib N] [--latency S]
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from googleapiclient.http import HttpRequest
+
+import models as m
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, sync_state
+
+
+def interrupted(drive, path, parent_id, chunks):
+    """Runs an upload that fails after sending chunks chunks."""
+    next_chunk = HttpRequest.next_chunk
+    sent = []
+
+    def flaky(request, *args, **kwargs):
+        if len(sent) == chunks:
+            raise ConnectionResetError('connection reset')
+        sent.append(1)
+        return next_chunk(request, *args, **kwargs)
+
+    with mock.patch.object(HttpRequest, 'next_chunk', flaky):
+        try:
+            upload_to_drive.upload_new_file(drive.build_service(), path, parent_id)
+        except ConnectionResetError:
+            return
+    raise AssertionError('the upload was not interrupted')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mib', type=int, default=16)
+    parser.add_argument('--chunk-kib', type=int, default=1024)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    chunk = args.chunk_kib * 1024
+    upload_to_drive.UPLOAD_CHUNK_SIZE = chunk
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'big.bin')
+    with open(path, 'wb') as big:
+        big.write(os.urandom(args.mib * 1024 * 1024))
+    with open(path, 'rb') as big:
+        md5 = hashlib.md5(big.read()).hexdigest()
+    chunks = args.mib * 1024 * 1024 // chunk
+
+    print('{} MiB file in {} KiB chunks, cut after {} of {} chunks, {:.0f} ms per round trip'
+          .format(args.mib, args.chunk_kib, chunks * 3 // 4, chunks, args.latency * 1000))
+    print('{:<10} {:>8} {:>12} {:>10}'.format('', 'calls', 'MiB sent', 'ms'))
+    try:
+        with sync_state(), FakeDrive(latency=args.latency) as drive:
+            for label in ('restart', 'resume'):
+                interrupted(drive, path, 'root', chunks * 3 // 4)
+                if label == 'restart':
+                    m.UploadSession.delete().execute()
+                drive.reset_counters()
+                start = time.perf_counter()
+                drive_file = upload_to_drive.upload_new_file(drive.build_service(), path, 'root')
+                elapsed = time.perf_counter() - start
+                print('{:<10} {:>8} {:>12.1f} {:>10.1f}'.format(
+                    label, drive.calls, drive.bytes_in / 1024 / 1024, elapsed * 1000))
+                assert drive_file['md5Checksum'] == md5
+                assert not m.UploadSession.select().exists()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
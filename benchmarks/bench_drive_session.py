@@ -0,0 +1,55 @@
+"""Cost of syncing new notes with and without the shared Drive session.
+
+Uploads new notes to a local fake Drive, first building a service and
+looking up the sync folder for every note as each sync used to, then
+through upload_to_drive.DriveSession, which builds the service once per
+thread and caches the folder id. Also checks the cached folder id is
+dropped and looked up again after the folder is deleted on Drive.
+
+Run from the repository root:
+    python -m benchmarks.bench_drive_session [--notes N] [--latency S]
+"""
+import argparse
+import time
+
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    print('{} new notes, {:.0f} ms per round trip'.format(args.notes, args.latency * 1000))
+    print('{:<10} {:>12} {:>12}'.format('', 'calls/note', 'ms/note'))
+    with FakeDrive(latency=args.latency) as drive:
+        session = upload_to_drive.DriveSession(drive.build_service)
+
+        def fresh(i):
+            session.forget_folder()
+            upload_to_drive.upload_note(drive.build_service(), 'fresh{}'.format(i), 'text')
+
+        def shared(i):
+            upload_to_drive.upload_note(session.service(), 'shared{}'.format(i), 'text')
+
+        original, upload_to_drive.SESSION = upload_to_drive.SESSION, session
+        try:
+            for label, upload in (('fresh', fresh), ('session', shared)):
+                drive.reset_counters()
+                start = time.perf_counter()
+                for i in range(args.notes):
+                    upload(i)
+                elapsed = time.perf_counter() - start
+                print('{:<10} {:>12.1f} {:>12.1f}'.format(
+                    label, drive.calls / args.notes, elapsed * 1000 / args.notes))
+
+            drive.remove(session.folder_ids[upload_to_drive.DIR_NAME])
+            upload_to_drive.upload_note(session.service(), 'after delete', 'text')
+            assert 'sync/after delete.txt' in drive.tree(), 'folder was not recreated'
+        finally:
+            upload_to_drive.SESSION = original
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Media transfer throughput of the Drive sync scripts against a local fake Drive.
+
+Uploads a synthetic folder tree with upload_to_drive.main, then downloads
+it into an empty folder with download_from_drive.main, once per worker
+count, and reports files and megabytes per second for each direction.
+
+Run from the repository root:
+    python -m benchmarks.bench_drive_transfers [--files N] [--size KB] [--latency S]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import download_from_drive
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, local_tree, sync_state
+
+
+def make_tree(full_path, files, size):
+    past = time.time() - 3600
+    for i in range(files):
+        folder = os.path.join(full_path, 'folder{}'.format(i % 4))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, 'note{}.txt'.format(i))
+        with open(path, 'wb') as note:
+            note.write(os.urandom(size))
+        os.utime(path, (past, past))
+
+
+def run(args, workers):
+    upload_dir, download_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    size = args.size * 1024
+    make_tree(os.path.join(upload_dir, 'sync'), args.files, size)
+    megabytes = args.files * size / (1024 * 1024)
+    try:
+        with FakeDrive(latency=args.latency) as drive:
+            row = [workers]
+            for module, directory in ((upload_to_drive, upload_dir),
+                                      (download_from_drive, download_dir)):
+                os.makedirs(os.path.join(directory, 'sync'), exist_ok=True)
+                start = time.perf_counter()
+                module.main(os.path.join(directory, 'sync'), drive.build_service, workers)
+                seconds = time.perf_counter() - start
+                row += [args.files / seconds, megabytes / seconds]
+                assert drive.tree() == local_tree(directory), 'Drive does not match local'
+            print('{:<8} {:>12.1f} {:>10.2f} {:>12.1f} {:>10.2f}'.format(*row))
+    finally:
+        shutil.rmtree(upload_dir)
+        shutil.rmtree(download_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--size', type=int, default=64, help='file size in KB')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+    print('{} files of {} KB, {:.0f} ms per round trip'.format(
+        args.files, args.size, args.latency * 1000))
+    print('{:<8} {:>12} {:>10} {:>12} {:>10}'.format(
+        'workers', 'up files/s', 'up MB/s', 'down files/s', 'down MB/s'))
+    with sync_state():
+        for workers in args.workers:
+            run(args, workers)
+
+
+if __name__ == '__main__':
+    main()
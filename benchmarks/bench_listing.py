@@ -0,0 +1,87 @@
+"""Bytes read and latency of the note and version lists.
+
+Compares loading whole rows (the content column included) with the
+metadata projections used by view_entries and view_previous_versions,
+on a throwaway database holding large notes. Bytes read come from the
+process I/O counters in /proc/self/io where available.
+
+Run from the repository root:
+    python -m benchmarks.bench_listing
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+import models as m
+from utils import KeysetPager
+
+NOTES = 300
+NOTE_BYTES = 256 * 1024
+VERSIONS = 10
+
+
+def bytes_read():
+    try:
+        with open('/proc/self/io') as stats:
+            for line in stats:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def populate(path):
+    database = SqliteDatabase(path)
+    m.proxy.initialize(database)
+    database.create_tables(m.MODELS)
+    content = 'x' * NOTE_BYTES
+    start = datetime.datetime(2018, 1, 1)
+    with database.atomic():
+        for i in range(NOTES):
+            note = m.Note.create(title='note ' + str(i), content=content, tags='all',
+                                 timestamp=start + datetime.timedelta(minutes=i))
+        for i in range(VERSIONS):
+            m.Versions.create(note=note, version_no=i + 1, content=content,
+                              title=str(i + 1) + '_' + note.title)
+    database.close()
+    return note.id
+
+
+def measure(path, label, action):
+    database = SqliteDatabase(path)
+    m.proxy.initialize(database)
+    database.connect()
+    before, start = bytes_read(), time.perf_counter()
+    rows = action()
+    elapsed, read = time.perf_counter() - start, bytes_read() - before
+    database.close()
+    print('{:<36} {:>6} {:>14} {:>10.2f}'.format(label, rows, read, elapsed * 1000))
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.db')
+    try:
+        note_id = populate(path)
+        print('{:<36} {:>6} {:>14} {:>10}'.format('query', 'rows', 'bytes read', 'ms'))
+        measure(path, 'all notes, whole rows', lambda: len(list(
+            m.Note.select().order_by(m.Note.timestamp.desc()))))
+        measure(path, 'first page, whole rows', lambda: len(KeysetPager(
+            m.Note.select(), m.Note.timestamp, m.Note.id, 2).first()))
+        measure(path, 'first page, metadata projection', lambda: len(KeysetPager(
+            m.Note.select(*m.NOTE_LISTING), m.Note.timestamp, m.Note.id, 2).first()))
+        measure(path, 'versions, whole rows', lambda: len(list(
+            m.Versions.select().where(m.Versions.note == note_id))))
+        measure(path, 'versions, metadata projection', lambda: len(list(
+            m.Versions.select(*m.VERSION_LISTING).where(m.Versions.note == note_id))))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Cost of checking one note against its copy on a local fake Drive.
+
+Compares the old path, mirroring the whole sync folder with
+download_from_drive.main, with fetch_note asking for the note's md5 and
+downloading it only when it changed.
+
+Run from the repository root:
+    python -m benchmarks.bench_note_fetch [--notes N] [--latency S]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import download_from_drive
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, sync_state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--opens', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    full_path = os.path.join(directory, 'sync')
+    os.makedirs(full_path)
+
+    print('{} notes in the sync folder, {:.0f} ms per round trip'.format(
+        args.notes, args.latency * 1000))
+    print('{:<20} {:>14} {:>14}'.format('', 'calls/open', 'ms/open'))
+    try:
+        with sync_state(), FakeDrive(latency=args.latency) as drive:
+            service = drive.build_service()
+            drive_ids = [upload_to_drive.upload_note(service, 'note{}'.format(i),
+                                                     'note {}\n'.format(i))['id']
+                         for i in range(args.notes)]
+            drive_id = drive_ids[0]
+            mirror = os.path.join(directory, 'mirror', 'sync')
+            os.makedirs(mirror)
+
+            def folder_sync():
+                download_from_drive.main(mirror, drive.build_service)
+                with open(os.path.join(mirror, 'note0.txt')) as note:
+                    return note.read()
+
+            for label, fetch in (
+                    ('folder sync', folder_sync),
+                    ('fetch_note same', lambda: download_from_drive.fetch_note(
+                        service, 'note0', 'note 0\n', drive_id)[1]),
+                    ('fetch_note changed', lambda: download_from_drive.fetch_note(
+                        service, 'note0', 'old text', drive_id)[1])):
+                drive.reset_counters()
+                start = time.perf_counter()
+                for _ in range(args.opens):
+                    text = fetch()
+                elapsed = time.perf_counter() - start
+                assert text in (None, 'note 0\n')
+                print('{:<20} {:>14.1f} {:>14.1f}'.format(
+                    label, drive.calls / args.opens, elapsed * 1000 / args.opens))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Cost of syncing one edited note to a local fake Drive.
+
+Compares the old path, writing the note into the sync folder and running
+the whole upload_to_drive.main reconciliation, with upload_note sending
+it from memory to its known Drive file id.
+
+Run from the repository root:
+    python -m benchmarks.bench_note_upload [--notes N] [--latency S]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, sync_state
+
+
+def folder_sync(drive, full_path, title, data):
+    path = os.path.join(full_path, title + '.txt')
+    with open(path, 'w') as note:
+        note.write(data)
+    upload_to_drive.main(full_path, drive.build_service)
+    os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--edits', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    full_path = os.path.join(directory, 'sync')
+    os.makedirs(full_path)
+    for i in range(args.notes):
+        with open(os.path.join(full_path, 'note{}.txt'.format(i)), 'w') as note:
+            note.write('note {}\n'.format(i))
+
+    print('{} notes in the sync folder, {:.0f} ms per round trip'.format(
+        args.notes, args.latency * 1000))
+    print('{:<12} {:>14} {:>14}'.format('', 'calls/edit', 'ms/edit'))
+    try:
+        with sync_state(), FakeDrive(latency=args.latency) as drive:
+            upload_to_drive.main(full_path, drive.build_service)
+            service = drive.build_service()
+            drive_id = upload_to_drive.upload_note(service, 'edited', 'v0')['id']
+            for label, edit in (
+                    ('folder sync', lambda i: folder_sync(drive, full_path, 'note0',
+                                                          'edit {}'.format(i))),
+                    ('upload_note', lambda i: upload_to_drive.upload_note(
+                        service, 'edited', 'edit {}'.format(i), drive_id))):
+                drive.reset_counters()
+                start = time.perf_counter()
+                for i in range(args.edits):
+                    edit(i)
+                elapsed = time.perf_counter() - start
+                print('{:<12} {:>14.1f} {:>14.1f}'.format(
+                    label, drive.calls / args.edits, elapsed * 1000 / args.edits))
+            assert drive.files[drive_id]['content'] == 'edit {}'.format(args.edits - 1).encode()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
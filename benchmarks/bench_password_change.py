@@ -0,0 +1,89 @@
+"""Cost of changing a password, before and after the vault key hierarchy.
+
+Before, notes were encrypted under SHA256(password), so a password change
+re-encrypted every note and every version. Times that on a throwaway
+database, then the one-time move of those notes into a vault
+(vault.unlock), unlocking the vault, and vault.change_password, which
+re-wraps the master key alone whatever the number of notes.
+
+Run from the repository root:
+    python -m benchmarks.bench_password_change [--notes N] [--versions N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+import models as m
+import vault
+import crypto as Crypto
+
+
+def populate(path, notes, versions, key):
+    database = SqliteDatabase(path)
+    m.proxy.initialize(database)
+    database.create_tables(m.MODELS)
+    crypto = Crypto.Crypto()
+    text = 'a line of the note\n' * 50
+    with database.atomic():
+        for i in range(notes):
+            note = m.Note.create(title='note ' + str(i), content=crypto.encrypt(text, key),
+                                 password=key.stored_hash())
+            for version_no in range(1, versions + 1):
+                m.Versions.create(note=note, version_no=version_no, title='v',
+                                  content=crypto.encrypt(text, key))
+    return database
+
+
+def reencrypt_all(old_key, new_key):
+    """A password change before the vault: every row decrypted and encrypted again"""
+    crypto = Crypto.Crypto()
+    with m.proxy.obj.atomic():
+        for model in (m.Note, m.Versions):
+            for row in model.select(model.id, model.content):
+                model.update(content=crypto.encrypt(crypto.decrypt(row.content, old_key),
+                                                    new_key)) \
+                    .where(model.id == row.id).execute()
+        m.Note.update(password=new_key.stored_hash()).execute()
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=500)
+    parser.add_argument('--versions', type=int, default=5)
+    args = parser.parse_args()
+    old_key = Crypto.SessionKey.from_password('bench')
+    new_key = Crypto.SessionKey.from_password('bench, changed')
+    directory = tempfile.mkdtemp()
+    try:
+        database = populate(os.path.join(directory, 'bench.db'), args.notes, args.versions,
+                            old_key)
+        print('{} notes of {} versions, scrypt N = 2 ** {}'.format(
+            args.notes, args.versions, vault.KDF_COST))
+        _, elapsed = timed(lambda: reencrypt_all(old_key, new_key))
+        print('{:<32} {:>10.0f} ms'.format('re-encrypt every row', elapsed))
+        keyring, elapsed = timed(lambda: vault.unlock('bench, changed'))
+        keyring.zero()
+        print('{:<32} {:>10.0f} ms'.format('move into a vault (once)', elapsed))
+        keyring, elapsed = timed(lambda: vault.unlock('bench, changed'))
+        assert keyring.notes().count() == args.notes
+        keyring.zero()
+        print('{:<32} {:>10.0f} ms'.format('unlock the vault', elapsed))
+        _, elapsed = timed(lambda: vault.change_password('bench, changed', 'bench, again'))
+        print('{:<32} {:>10.0f} ms'.format('vault.change_password', elapsed))
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
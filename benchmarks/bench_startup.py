@@ -0,0 +1,78 @@
+"""Startup cost of the notes CLI.
+
+Measures time-to-menu (importing notes, opening the database and drawing
+the main menu once) in fresh interpreters, and uses ``python -X importtime``
+to list the slowest imports. Exits non-zero when the median time-to-menu
+exceeds --max-ms or the Drive stack is imported at startup, so it can
+guard against regressions.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup [--runs N] [--max-ms MS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DRIVE_MODULES = ('googleapiclient', 'oauth2client', 'httplib2')
+
+TO_MENU = '''
+import sys, notes
+notes.clear_screen = lambda: None
+notes.input = lambda prompt: 'q'
+notes.init()
+notes.menu_loop()
+print(','.join(name for name in {} if name in sys.modules), file=sys.stderr)
+'''.format(DRIVE_MODULES)
+
+
+def run(args, home):
+    env = dict(os.environ, HOME=home)
+    return subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def import_times(home):
+    """(cumulative microseconds, module) of each import, slowest first"""
+    result = run(['-X', 'importtime', '-c', 'import notes'], home)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.rstrip()))
+    return sorted(times, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = run(['-c', TO_MENU], home)
+            timings.append((time.perf_counter() - start) * 1000)
+        loaded = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''
+        slowest = import_times(home)[:10]
+
+    median = statistics.median(timings)
+    print('time to menu: median {:.1f} ms, min {:.1f} ms over {} runs'.format(
+        median, min(timings), len(timings)))
+    print('Drive modules imported at startup: {}'.format(loaded or 'none'))
+    print('slowest imports (cumulative):')
+    for micros, name in slowest:
+        print('  {:>8.1f} ms  {}'.format(micros / 1000, name))
+
+    if loaded or (args.max_ms is not None and median > args.max_ms):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Menu latency and Drive uploads of queued note sync against a local fake Drive.
+
+Saves a burst of edits to one synced note, first uploading each edit
+before returning like the menu used to, then only queueing it for the
+background sync worker, and reports how long each save blocked and how
+many Drive calls were made.
+
+Run from the repository root:
+    python -m benchmarks.bench_sync_worker [--edits N] [--latency S]
+"""
+import argparse
+import time
+
+import crypto as Crypto
+import models as m
+import sync_worker
+import upload_to_drive
+from benchmarks.fake_drive import FakeDrive, sync_state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--edits', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    crypto = Crypto.Crypto()
+    key = Crypto.SessionKey.from_password('benchmark')
+
+    print('{} edits of one note, {:.0f} ms per round trip'.format(
+        args.edits, args.latency * 1000))
+    print('{:<10} {:>14} {:>12}'.format('', 'ms/save', 'Drive calls'))
+    with sync_state(), FakeDrive(latency=args.latency) as drive:
+        note = m.Note.create(title='note', content=crypto.encrypt('v0', key), sync=True)
+        service = drive.build_service()
+        worker = sync_worker.SyncWorker(drive.build_service)
+
+        def blocking(text):
+            note.drive_id = upload_to_drive.upload_note(service, note.title, text,
+                                                        note.drive_id)['id']
+
+        def queued(text):
+            m.Note.update(content=crypto.encrypt(text, key)).where(m.Note.id == note.id).execute()
+            worker.enqueue(note, sync_worker.PUSH, key)
+
+        for label, save in (('blocking', blocking), ('queued', queued)):
+            note.drive_id = None
+            m.Note.update(drive_id=None).execute()
+            drive.reset_counters()
+            start = time.perf_counter()
+            for i in range(args.edits):
+                save('edit {}'.format(i))
+            blocked = time.perf_counter() - start
+            while m.SyncJob.select().exists():
+                time.sleep(0.05)
+            print('{:<10} {:>14.1f} {:>12}'.format(
+                label, blocked * 1000 / args.edits, drive.calls))
+        drive_id = m.Note.get_by_id(note.id).drive_id
+        assert drive.files[drive_id]['content'] == 'edit {}'.format(args.edits - 1).encode()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Cost of browsing a note's versions with and without the text cache.
+
+Opens a note, views its versions and diffs neighbouring ones over and
+over, as moving between view_entry, view_previous_versions and diffcheck
+does, on a throwaway database. Runs once with text_cache disabled and
+once with its default size, and prints its hit/miss counters.
+
+Run from the repository root:
+    python -m benchmarks.bench_text_cache [--lines N] [--rounds N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+import models as m
+import notes
+import text_cache
+import version_store
+import crypto as Crypto
+
+
+def populate(path, lines, key):
+    database = SqliteDatabase(path)
+    m.proxy.initialize(database)
+    database.create_tables(m.MODELS)
+    crypto = Crypto.Crypto()
+    text = '\n'.join('line {} of the note'.format(i) for i in range(lines))
+    note = notes.add_entry(crypto.encrypt(text, key), 'big', key.stored_hash())
+    for version in range(version_store.MAX_VERSIONS - 1):
+        text = text.replace('line {} '.format(version * 7), 'edited line ', 1)
+        notes.edit_entry(note, 'big', text, key)
+    return database, m.Note.get_by_id(note.id)
+
+
+def browse(note, key, rounds):
+    versions = list(m.Versions.select(*m.VERSION_LISTING).where(m.Versions.note == note)
+                    .order_by(m.Versions.version_no.desc()))
+    last = len(versions) - 1
+    for i in range(rounds):
+        text_cache.note_text(note, key)
+        version_store.version_text(versions[i % len(versions)], key)
+        list(notes.diffcheck(str(i % last), str(i % last + 1), key, last, versions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=30)
+    args = parser.parse_args()
+    key = Crypto.SessionKey.from_password('bench')
+    directory = tempfile.mkdtemp()
+    try:
+        database, note = populate(os.path.join(directory, 'bench.db'), args.lines, key)
+        print('{} line note, {} versions, {} rounds'.format(
+            args.lines, version_store.MAX_VERSIONS, args.rounds))
+        print('{:<10} {:>10} {:>8} {:>8} {:>12}'.format('cache', 'ms/round', 'hits', 'misses',
+                                                       'bytes'))
+        for label, max_bytes in (('off', 0), ('default', text_cache.MAX_BYTES)):
+            text_cache.cache = text_cache.TextCache(max_bytes)
+            start = time.perf_counter()
+            browse(note, key, args.rounds)
+            elapsed = time.perf_counter() - start
+            stats = text_cache.cache.stats()
+            print('{:<10} {:>10.2f} {:>8} {:>8} {:>12}'.format(
+                label, elapsed * 1000 / args.rounds, stats['hits'], stats['misses'],
+                stats['bytes']))
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
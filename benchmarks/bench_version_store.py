@@ -0,0 +1,72 @@
+"""Storage size and reconstruct latency of the delta version store.
+
+Replays synthetic edit histories against an in-memory database and
+compares the bytes stored by version_store with keeping a full encrypted
+copy of every version.
+
+Run from the repository root:
+    python -m benchmarks.bench_version_store
+"""
+import random
+import time
+
+from peewee import SqliteDatabase
+
+import models as m
+import text_cache
+import version_store
+
+PASSWORD = 'benchmark'
+
+
+def synthetic_history(lines, edits, rand):
+    """Yield successive texts of a note, each a few line edits away from the last"""
+    words = ['alpha', 'beta', 'gamma', 'delta', 'log', 'error', 'note', 'todo']
+    text = ['{} {}'.format(i, ' '.join(rand.choice(words) for _ in range(8)))
+            for i in range(lines)]
+    yield '\n'.join(text)
+    for _ in range(edits):
+        for _ in range(rand.randint(1, 5)):
+            pos = rand.randrange(len(text))
+            action = rand.random()
+            if action < 0.5:
+                text[pos] = text[pos] + ' edited'
+            elif action < 0.8:
+                text.insert(pos, 'inserted ' + rand.choice(words))
+            elif len(text) > 1:
+                del text[pos]
+        yield '\n'.join(text)
+
+
+def run(lines, edits, rand):
+    note = m.Note.create(title='bench', content='')
+    for text in synthetic_history(lines, edits, rand):
+        version_store.add_version(note, text, PASSWORD)
+    stored_bytes = sum(len(v.content) for v in note.versions)
+
+    versions = list(note.versions.order_by(m.Versions.version_no))
+    text_cache.cache.clear()
+    start = time.perf_counter()
+    texts = [version_store.version_text(version, PASSWORD) for version in versions]
+    average = (time.perf_counter() - start) / len(versions)
+    full_bytes = sum(len(version_store.crypto.encrypt(text, PASSWORD)) for text in texts)
+
+    print('{:>6} {:>6} {:>12} {:>12} {:>7.1f}x {:>10.2f}'.format(
+        lines, edits, full_bytes, stored_bytes, full_bytes / stored_bytes, average * 1000))
+    note.delete_instance(recursive=True)
+
+
+def main():
+    database = SqliteDatabase(':memory:')
+    m.proxy.initialize(database)
+    database.create_tables(m.MODELS)
+    rand = random.Random(4156)
+    print('{:>6} {:>6} {:>12} {:>12} {:>8} {:>10}'.format(
+        'lines', 'edits', 'full bytes', 'delta bytes', 'ratio', 'avg ms'))
+    for lines in (50, 500, 5000):
+        for edits in (3, 20):
+            run(lines, edits, rand)
+
+
+if __name__ == '__main__':
+    main()
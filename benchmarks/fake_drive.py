@@ -0,0 +1,397 @@
+"""A local stand-in for the parts of the Drive v3 API that sync uses.
+
+Serves file listing, metadata create/update/delete, simple, multipart and
+resumable media uploads, ranged media downloads, HTTP batch requests and
+the Changes API from memory. Every HTTP round trip and request body byte
+is counted, and round trips can be delayed to simulate a high latency link.
+
+    with FakeDrive(latency=0.05) as drive:
+        service = drive.build_service()
+        ...
+        print(drive.round_trips)
+"""
+import contextlib
+import email.parser
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import datetime
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import googleapiclient
+from googleapiclient import discovery
+from googleapiclient.http import build_http
+
+import models as m
+import storage
+
+FOLDER = 'application/vnd.google-apps.folder'
+DISCOVERY_DOC = os.path.join(os.path.dirname(googleapiclient.__file__),
+                             'discovery_cache', 'documents', 'drive.v3.json')
+CONDITION = re.compile(r'''^(\w+)\s*(!=|=)\s*['"]?(.*?)['"]?$''')
+IN_PARENTS = re.compile(r"^'(.+)' in parents$")
+
+
+@contextlib.contextmanager
+def sync_state():
+    """Keeps the Drive sync state in a throwaway notes database"""
+    directory = tempfile.mkdtemp()
+    try:
+        yield storage.connect(directory)
+    finally:
+        m.proxy.obj.close()
+        m.proxy.initialize(None)
+        shutil.rmtree(directory)
+
+
+def local_tree(directory):
+    """{path: md5 or None for folders} of a local folder, comparable to FakeDrive.tree"""
+    tree = {}
+    for root, _, files in os.walk(directory):
+        relative = os.path.relpath(root, directory)
+        if relative != '.':
+            tree[relative.replace(os.path.sep, '/')] = None
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as local:
+                path = os.path.normpath(os.path.join(relative, name))
+                tree[path.replace(os.path.sep, '/')] = hashlib.md5(local.read()).hexdigest()
+    return tree
+
+
+class FakeDrive:
+    """In-memory Drive served over HTTP on 127.0.0.1"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.files = {}
+        self.changes = []
+        self.uploads = {}
+        self.round_trips = 0
+        self.calls = 0
+        self.bytes_in = 0
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.add({'id': 'root', 'name': 'My Drive', 'mimeType': FOLDER, 'parents': []})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def build_service(self, http=None):
+        with open(DISCOVERY_DOC) as doc:
+            document = json.load(doc)
+        document['rootUrl'] = self.url
+        document['baseUrl'] = self.url + document['servicePath']
+        return discovery.build_from_document(document, http=http or build_http())
+
+    def reset_counters(self):
+        with self.lock:
+            self.round_trips = 0
+            self.calls = 0
+            self.bytes_in = 0
+
+    # Storage
+
+    def add(self, metadata, content=None):
+        with self.lock:
+            for parent in metadata.get('parents') or []:
+                if parent not in self.files:
+                    raise KeyError(parent)
+            item = {'id': metadata.get('id') or 'f{}'.format(next(self.ids)),
+                    'name': metadata.get('name', 'Untitled'),
+                    'mimeType': metadata.get('mimeType') or 'application/octet-stream',
+                    'parents': list(metadata.get('parents') or ['root']),
+                    'trashed': False}
+            self.files[item['id']] = item
+            self.write(item, content)
+            return item
+
+    def write(self, item, content):
+        with self.lock:
+            if content is not None:
+                item['content'] = content
+                item['md5Checksum'] = hashlib.md5(content).hexdigest()
+                item['size'] = str(len(content))
+            item['version'] = str(int(item.get('version', '0')) + 1)
+            item['headRevisionId'] = 'r' + item['version']
+            item['modifiedTime'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            self.changes.append({'fileId': item['id'], 'removed': False})
+
+    def remove(self, file_id):
+        with self.lock:
+            for child in [f['id'] for f in self.files.values() if file_id in f['parents']]:
+                self.remove(child)
+            self.files.pop(file_id, None)
+            self.changes.append({'fileId': file_id, 'removed': True})
+
+    def path_of(self, item):
+        names = []
+        while item and item['id'] != 'root':
+            names.append(item['name'])
+            item = self.files.get(item['parents'][0]) if item['parents'] else None
+        return '/'.join(reversed(names))
+
+    def tree(self):
+        """{path: md5 or None for folders} of everything in the drive"""
+        with self.lock:
+            return {self.path_of(f): f.get('md5Checksum') for f in self.files.values()
+                    if f['id'] != 'root'}
+
+    def matches(self, item, query):
+        for term in re.split(r'\s*\band\b\s*', query.strip()):
+            if not term:
+                continue
+            if term.startswith('(') and term.endswith(')'):
+                if not any(self.matches(item, part) for part in re.split(r'\s+or\s+', term[1:-1])):
+                    return False
+                continue
+            parents = IN_PARENTS.match(term)
+            if parents:
+                if parents.group(1) not in item['parents']:
+                    return False
+                continue
+            field, operator, value = CONDITION.match(term).groups()
+            actual = str(item.get(field, '')).lower() if field == 'trashed' else item.get(field)
+            value = value.lower() if field == 'trashed' else value
+            if (actual == value) != (operator == '='):
+                return False
+        return True
+
+    @staticmethod
+    def public(item):
+        return {k: v for k, v in item.items() if k != 'content'}
+
+    # Requests
+
+    def dispatch(self, method, url, headers, body):
+        """Handle one API call, returns (status, headers, body bytes)"""
+        with self.lock:
+            self.calls += 1
+        parsed = urllib.parse.urlparse(url)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        parts = [urllib.parse.unquote(p) for p in parsed.path.strip('/').split('/')]
+        try:
+            if parts[:3] == ['upload', 'drive', 'v3']:
+                return self.upload(method, parts[4:], params, headers, body)
+            if parts[:2] != ['drive', 'v3']:
+                return self.error(404, 'Not found')
+            if parts[2] == 'changes':
+                return self.list_changes(parts[3:], params)
+            return self.files_call(method, parts[3:], params, headers, body)
+        except KeyError:
+            return self.error(404, 'File not found')
+
+    def files_call(self, method, path, params, headers, body):
+        with self.lock:
+            if not path and method == 'GET':
+                return self.list_files(params)
+            if not path and method == 'POST':
+                return self.json(self.public(self.add(json.loads(body or b'{}'))))
+            item = self.files[path[0]]
+            if method == 'GET' and params.get('alt') == 'media':
+                return self.media(item, headers)
+            if method == 'GET':
+                return self.json(self.public(item))
+            if method == 'PATCH':
+                self.patch(item, json.loads(body or b'{}'), params, None)
+                return self.json(self.public(item))
+            if method == 'DELETE':
+                self.remove(item['id'])
+                return 204, {}, b''
+        return self.error(405, 'Method not allowed')
+
+    def patch(self, item, metadata, params, content):
+        for key in ('name', 'mimeType'):
+            if key in metadata:
+                item[key] = metadata[key]
+        if params.get('addParents'):
+            item['parents'] = [p for p in item['parents']
+                               if p not in params.get('removeParents', '').split(',')]
+            item['parents'] += params['addParents'].split(',')
+        self.write(item, content)
+
+    def list_files(self, params):
+        query = params.get('q', '')
+        items = sorted((f for f in self.files.values()
+                        if f['id'] != 'root' and self.matches(f, query)),
+                       key=lambda f: f['id'])
+        size = int(params.get('pageSize', 100))
+        start = int(params.get('pageToken', 0))
+        result = {'files': [self.public(f) for f in items[start:start + size]]}
+        if start + size < len(items):
+            result['nextPageToken'] = str(start + size)
+        return self.json(result)
+
+    def list_changes(self, path, params):
+        with self.lock:
+            if path == ['startPageToken']:
+                return self.json({'startPageToken': str(len(self.changes))})
+            token = params.get('pageToken', '')
+            if not token.isdigit() or int(token) > len(self.changes):
+                return self.error(400, 'Invalid page token')
+            start, size = int(token), int(params.get('pageSize', 100))
+            changes = []
+            for change in self.changes[start:start + size]:
+                entry = {'fileId': change['fileId'], 'removed': change['removed']}
+                if not change['removed'] and change['fileId'] in self.files:
+                    entry['file'] = self.public(self.files[change['fileId']])
+                elif not change['removed']:
+                    entry['removed'] = True
+                changes.append(entry)
+            result = {'changes': changes}
+            if start + size < len(self.changes):
+                result['nextPageToken'] = str(start + size)
+            else:
+                result['newStartPageToken'] = str(len(self.changes))
+            return self.json(result)
+
+    def media(self, item, headers):
+        content = item.get('content', b'')
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if not match:
+            return 200, {'Content-Type': 'application/octet-stream'}, content
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+        return 206, {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(content))}, \
+            content[start:end + 1]
+
+    def upload(self, method, path, params, headers, body):
+        upload_type = params.get('uploadType')
+        with self.lock:
+            if upload_type == 'resumable' and 'upload_id' in params:
+                return self.resumable_chunk(params['upload_id'], headers, body)
+            if upload_type == 'resumable':
+                upload_id = 'u{}'.format(next(self.ids))
+                self.uploads[upload_id] = {'path': path, 'metadata': json.loads(body or b'{}'),
+                                           'data': b'', 'params': params}
+                location = '{}upload/drive/v3/files?uploadType=resumable&upload_id={}'.format(
+                    self.url, upload_id)
+                return 200, {'Location': location}, b''
+            if upload_type == 'multipart':
+                metadata, content = self.split_related(headers, body)
+            else:
+                metadata, content = {}, body
+            return self.json(self.public(self.store(method, path, params, metadata, content)))
+
+    def store(self, method, path, params, metadata, content):
+        if method == 'POST' and not path:
+            return self.add(metadata, content)
+        item = self.files[path[0]]
+        self.patch(item, metadata, params, content)
+        return item
+
+    def resumable_chunk(self, upload_id, headers, body):
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            return self.error(404, 'Upload session expired')
+        match = re.match(r'bytes (\*|(\d+)-(\d+))/(\d+|\*)', headers.get('content-range', ''))
+        if match and match.group(1) != '*':
+            if int(match.group(2)) != len(upload['data']):
+                return self.error(400, 'Unexpected offset')
+            upload['data'] += body
+        total = match.group(4) if match else str(len(upload['data']))
+        if total != '*' and len(upload['data']) >= int(total):
+            item = self.store('POST' if not upload['path'] else 'PATCH', upload['path'],
+                              upload['params'], upload['metadata'], upload['data'])
+            del self.uploads[upload_id]
+            return self.json(self.public(item))
+        range_header = {'Range': 'bytes=0-{}'.format(len(upload['data']) - 1)} \
+            if upload['data'] else {}
+        return 308, range_header, b''
+
+    @staticmethod
+    def split_related(headers, body):
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + headers['content-type'].encode() + b'\r\n\r\n' + body)
+        metadata, media = message.get_payload()
+        metadata = json.loads(metadata.get_payload(decode=True))
+        metadata.setdefault('mimeType', media.get_content_type())
+        return metadata, media.get_payload(decode=True)
+
+    def batch(self, headers, body):
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + headers['content-type'].encode() + b'\r\n\r\n' + body)
+        boundary = 'batch_response'
+        out = []
+        for part in message.get_payload():
+            raw = part.get_payload(decode=True)
+            head, _, inner_body = raw.partition(b'\r\n\r\n')
+            if not _:
+                head, _, inner_body = raw.partition(b'\n\n')
+            lines = head.decode().splitlines()
+            method, url = lines[0].split(' ')[:2]
+            inner_headers = {k.strip().lower(): v.strip() for k, v in
+                             (line.split(':', 1) for line in lines[1:] if ':' in line)}
+            status, _, payload = self.dispatch(method, url, inner_headers, inner_body)
+            out.append('--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>'
+                       '\r\n\r\nHTTP/1.1 {} OK\r\nContent-Type: application/json\r\n\r\n{}\r\n'
+                       .format(boundary, part['Content-ID'].strip('<>'), status,
+                               payload.decode()))
+        out.append('--{}--\r\n'.format(boundary))
+        return 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary}, \
+            ''.join(out).encode()
+
+    @staticmethod
+    def json(result):
+        return 200, {'Content-Type': 'application/json'}, json.dumps(result).encode()
+
+    @staticmethod
+    def error(status, message):
+        body = {'error': {'code': status, 'message': message,
+                          'errors': [{'reason': 'fake', 'message': message}]}}
+        return status, {'Content-Type': 'application/json'}, json.dumps(body).encode()
+
+    def handler(self):
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def respond(self):
+                with drive.lock:
+                    drive.round_trips += 1
+                if drive.latency:
+                    time.sleep(drive.latency)
+                length = int(self.headers.get('content-length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with drive.lock:
+                    drive.bytes_in += len(body)
+                headers = {k.lower(): v for k, v in self.headers.items()}
+                if self.path.startswith('/batch/'):
+                    status, out_headers, payload = drive.batch(headers, body)
+                else:
+                    status, out_headers, payload = drive.dispatch(
+                        self.command, self.path, headers, body)
+                self.send_response(status)
+                for key, value in out_headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+        return Handler
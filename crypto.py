@@ -1,7 +1,120 @@
 import base64
+import collections
+import hmac
+import io
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from Cryptodome.Cipher import AES
 from Cryptodome.Hash import SHA256
 
+# Stream format v2: MAGIC, chunk size (4 bytes), nonce prefix (8 bytes), then
+# AES-GCM chunks of chunk size bytes plus a 16 byte tag. Each chunk's nonce is
+# the prefix and a chunk counter; the header and a final-chunk flag are
+# authenticated, so chunks cannot be reordered, dropped or truncated.
+MAGIC = b'NT\x02'
+TEXT_PREFIX = '$2$'
+CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+HEADER = struct.Struct('>3sI8s')
+# pycryptodome releases the GIL inside AES, so batches scale over threads
+WORKERS = os.cpu_count() or 1
+
+BatchResult = collections.namedtuple('BatchResult', ['index', 'item', 'value', 'error'])
+
+
+class SessionKey:
+    """
+    AES key derived once per session, with its cipher built once and reused.
+    Call zero() when the session ends to overwrite the key material.
+    """
+
+    def __init__(self, key, index_key=None):
+        self._key = bytearray(key)
+        self._cipher = AES.new(bytes(self._key), AES.MODE_ECB)
+        self._stream_key = bytearray(hmac.new(bytes(self._key), b'notes stream v2',
+                                              'sha256').digest())
+        self._index_key = bytearray(index_key or hmac.new(bytes(self._key), b'notes index v1',
+                                                          'sha256').digest())
+
+    @classmethod
+    def from_password(cls, password):
+        return cls(SHA256.new(password.encode()).digest())
+
+    def cipher(self):
+        if self._cipher is None:
+            raise ValueError("Session key has been zeroed")
+        return self._cipher
+
+    def chunk_cipher(self, nonce):
+        """AES-GCM cipher for one chunk of the v2 stream format"""
+        self.cipher()
+        return AES.new(bytes(self._stream_key), AES.MODE_GCM, nonce=nonce)
+
+    def blind(self, term):
+        """Keyed HMAC of a search term, the index never sees the term itself"""
+        self.cipher()
+        return hmac.new(bytes(self._index_key), term.encode(), 'sha256').hexdigest()[:32]
+
+    def child(self, key):
+        """
+        SessionKey of a key kept wrapped under this one, blinding search
+        terms as this one does so notes under different keys share an index
+        """
+        self.cipher()
+        return SessionKey(key, self._index_key)
+
+    def fingerprint(self):
+        """Identifies the key without revealing it, equal keys give equal fingerprints"""
+        self.cipher()
+        return hmac.new(bytes(self._key), b'notes fingerprint v1', 'sha256').hexdigest()[:32]
+
+    def stored_hash(self):
+        """The value Crypto.key_to_store gives for the same password"""
+        return self._key.hex()
+
+    def zero(self):
+        for buf in (self._key, self._stream_key, self._index_key):
+            for i in range(len(buf)):
+                buf[i] = 0
+        self._cipher = None
+
+
+def read_exactly(src, size):
+    """Read size bytes unless the stream ends first"""
+    data = src.read(size)
+    while data and len(data) < size:
+        more = src.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def ordered_map(func, items, workers=None):
+    """
+    Yield BatchResult(index, item, func(item), error) for each item, in order.
+    Only a bounded window of items is in flight, and an exception raised for
+    one item is reported in its result instead of stopping the batch.
+    """
+    def call(item):
+        try:
+            return func(item), None
+        except (ValueError, TypeError, KeyError) as err:
+            return None, err
+
+    workers = workers or WORKERS
+    window = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for index, item in enumerate(items):
+            window.append((index, item, pool.submit(call, item)))
+            if len(window) >= workers * 4:
+                index, item, future = window.popleft()
+                yield BatchResult(index, item, *future.result())
+        while window:
+            index, item, future = window.popleft()
+            yield BatchResult(index, item, *future.result())
+
 
 class Crypto:
     PADDING = "="
@@ -12,14 +125,100 @@ class Crypto:
     def key_hash(self, key):
         return SHA256.new(key.encode()).digest()
 
+    def session_key(self, key):
+        """Accept a password or an existing SessionKey"""
+        if isinstance(key, SessionKey):
+            return key
+        return SessionKey(self.key_hash(key))
+
+    def encrypt_stream(self, src, dst, key, chunk_size=CHUNK_SIZE):
+        """Encrypt the binary file-like src into dst holding one chunk at a time"""
+        key = self.session_key(key)
+        header = HEADER.pack(MAGIC, chunk_size, os.urandom(8))
+        dst.write(header)
+        chunk = read_exactly(src, chunk_size)
+        counter = 0
+        while True:
+            following = read_exactly(src, chunk_size) if len(chunk) == chunk_size else b''
+            cipher = key.chunk_cipher(header[-8:] + struct.pack('>I', counter))
+            cipher.update(header + (b'\x00' if following else b'\x01'))
+            encrypted, tag = cipher.encrypt_and_digest(chunk)
+            dst.write(encrypted + tag)
+            if not following:
+                return
+            chunk = following
+            counter += 1
+
+    def decrypt_stream(self, src, dst, key):
+        """
+        Decrypt src into dst, one chunk at a time for the v2 format.
+        Raises ValueError if the data was tampered with or the key is wrong.
+        """
+        key = self.session_key(key)
+        header = read_exactly(src, HEADER.size)
+        if not header.startswith(MAGIC):
+            legacy = self.decrypt((header + src.read()).decode(), key)
+            dst.write(legacy.encode())
+            return
+        _, chunk_size, prefix = HEADER.unpack(header)
+        block = read_exactly(src, chunk_size + TAG_SIZE)
+        counter = 0
+        while True:
+            following = read_exactly(src, chunk_size + TAG_SIZE) \
+                if len(block) == chunk_size + TAG_SIZE else b''
+            if len(block) < TAG_SIZE:
+                raise ValueError("Truncated ciphertext")
+            cipher = key.chunk_cipher(prefix + struct.pack('>I', counter))
+            cipher.update(header + (b'\x00' if following else b'\x01'))
+            dst.write(cipher.decrypt_and_verify(block[:-TAG_SIZE], block[-TAG_SIZE:]))
+            if not following:
+                return
+            block = following
+            counter += 1
+
     def encrypt(self, text, key):
-        while len(text) % 16 != 0:
-            text += self.PADDING
-        cipher = AES.new(self.key_hash(key), AES.MODE_ECB)
-        encrypted = cipher.encrypt(text.encode())
-        return base64.b64encode(encrypted).decode()
+        return self.encrypt_bytes(text.encode(), key)
+
+    def encrypt_bytes(self, data, key):
+        """Encrypt binary data into the same text format as encrypt"""
+        encrypted = io.BytesIO()
+        self.encrypt_stream(io.BytesIO(data), encrypted, key)
+        return TEXT_PREFIX + base64.b64encode(encrypted.getvalue()).decode()
+
+    def encrypt_many(self, texts, key, workers=None):
+        """Encrypt an iterable of strings, yielding a BatchResult for each"""
+        key = self.session_key(key)
+        return ordered_map(lambda text: self.encrypt(text, key), texts, workers)
+
+    def decrypt_many(self, items, key, workers=None):
+        """
+        Decrypt an iterable of ciphertexts or of rows with a content field
+        (Note, Versions), yielding a BatchResult for each, in order.
+        A wrong key or corrupt item sets that result's error, value is None.
+        Versions rows holding a delta are errors too, their text is rebuilt
+        by version_store.version_text.
+        """
+        key = self.session_key(key)
+
+        def decrypt_item(item):
+            if getattr(item, 'is_delta', False):
+                raise ValueError("Version holds a delta, use version_store.version_text")
+            return self.decrypt(getattr(item, 'content', item), key)
+
+        return ordered_map(decrypt_item, items, workers)
+
+    def decrypt_bytes(self, text, key):
+        """Decrypt what encrypt_bytes made, legacy texts come back UTF-8 encoded"""
+        if text.startswith(TEXT_PREFIX):
+            plain = io.BytesIO()
+            self.decrypt_stream(io.BytesIO(base64.b64decode(text[len(TEXT_PREFIX):])), plain, key)
+            return plain.getvalue()
+        return self.decrypt(text, key).encode()
 
     def decrypt(self, text, key):
-        cipher = AES.new(self.key_hash(key), AES.MODE_ECB)
+        if text.startswith(TEXT_PREFIX):
+            return self.decrypt_bytes(text, key).decode()
+        # Legacy format: AES-ECB over the text padded with "="
+        cipher = self.session_key(key).cipher()
         plain = cipher.decrypt(base64.b64decode(text))
         return plain.decode().rstrip(self.PADDING)
@@ -2,37 +2,27 @@
 
 """Initial comment."""
 
-import datetime
+import hashlib
 import io
+from collections import defaultdict
 # import mimetypes
 import os
 import shutil
-import time
-import hashlib
-import httplib2
 
 # from os import path
-from googleapiclient import discovery
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
-from googleapiclient.http import MediaIoBaseDownload   # pylint: disable=ungrouped-imports
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
+from drive_common import FOLDER_MIME_TYPE, Manifest, SyncError, TransferPool, \
+    list_files, quote, sync_tree
+from upload_to_drive import DIR_NAME, SESSION, build_service, check_upload
 
 # import initial_upload
 
-# If modifying these scopes, delete your previously saved credentials
-# at ~/.credentials/drive-python-quickstart.json
-SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly',
-          'https://www.googleapis.com/auth/drive.file',
-          'https://www.googleapis.com/auth/drive']
-CLIENT_SECRET_FILE = 'client_secret.json'
-APPLICATION_NAME = 'Drive Sync'
-
-# Declare full path to folder and folder name
+# Declare full path to folder, its name is DIR_NAME from upload_to_drive
 FULL_PATH = r'/Users/aviral/Desktop/SE/coms_4156/sync'
-DIR_NAME = 'sync'
-# Or simply
-# DIR_NAME = FULL_PATH.split('/')[-1]
+
+# Enough to tell whether a note's Drive copy changed, or is gone
+NOTE_FIELDS = 'id, name, md5Checksum, trashed'
 
 # Sample (reference) map of Google Docs MIME types to possible exports
 # (for more information check about().get() method with exportFormats field)
@@ -65,149 +55,6 @@ GOOGLE_MIME_TYPES = {
 # 'application/vnd.google-apps.drive-sdk': ''
 # 'application/octet-stream': 'text/plain'
 
-def folder_upload(service):
-    '''Uploads folder and all it's content (if it doesnt exists)
-    in root folder.
-
-    Args:
-        items: List of folders in root path on Google Drive.
-        service: Google Drive service instance.
-
-    Returns:
-        Dictionary, where keys are folder's names
-        and values are id's of these folders.
-    '''
-
-    parents_id = {}
-
-    for root, _, files in os.walk(FULL_PATH, topdown=True):
-        last_dir = root.split('/')[-1]
-        pre_last_dir = root.split('/')[-2]
-        if pre_last_dir not in parents_id.keys():
-            pre_last_dir = []
-        else:
-            pre_last_dir = parents_id[pre_last_dir]
-
-        folder_metadata = {'name': last_dir,
-                           'parents': [pre_last_dir],
-                           'mimeType': 'application/vnd.google-apps.folder'}
-        create_folder = service.files().create(body=folder_metadata,
-                                               fields='id').execute()
-        folder_id = create_folder.get('id', [])
-
-        for name in files:
-            file_metadata = {'name': name, 'parents': [folder_id]}
-            media = MediaFileUpload(                                 # pylint: disable=undefined-variable
-                os.path.join(root, name),
-                mimetype=mimetypes.MimeTypes().guess_type(name)[0])           # pylint: disable=undefined-variable
-            service.files().create(body=file_metadata,
-                                   media_body=media,
-                                   fields='id').execute()
-
-        parents_id[last_dir] = folder_id
-
-    return parents_id
-
-
-def check_upload(service):
-    """Checks if folder is already uploaded,
-    and if it's not, uploads it.
-
-    Args:
-        service: Google Drive service instance.
-
-    Returns:
-        ID of uploaded folder, full path to this folder on computer.
-
-    """
-
-    results = service.files().list(
-        pageSize=100,
-        q="'root' in parents and trashed != True and \
-        mimeType='application/vnd.google-apps.folder'").execute()
-
-    items = results.get('files', [])
-
-    # Check if folder exists, and then create it or get this folder's id.
-    if DIR_NAME in [item['name'] for item in items]:
-        folder_id = [item['id']for item in items
-                     if item['name'] == DIR_NAME][0]
-    else:
-        parents_id = folder_upload(service)
-        folder_id = parents_id[DIR_NAME]
-
-    return folder_id, FULL_PATH
-
-
-def get_credentials():
-    """Gets valid user credentials from storage.
-
-    If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is completed to obtain the new credentials.
-
-    Returns:
-        Credentials, the obtained credential.
-    """
-    home_dir = os.path.expanduser('~')
-    credential_dir = os.path.join(home_dir, '.credentials')
-    if not os.path.exists(credential_dir):
-        os.makedirs(credential_dir)
-    credential_path = os.path.join(credential_dir,
-                                   'drive-python-sync.json')
-
-    store = Storage(credential_path)
-    credentials = store.get()
-    if not credentials or credentials.invalid:
-        flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
-        flow.user_agent = APPLICATION_NAME
-        # if flags:
-        credentials = tools.run_flow(flow, store, flags=None)
-        # else:  # Needed only for compatibility with Python 2.6
-        # credentials = tools.run(flow, store)
-        print('Storing credentials to ', credential_path)
-    return credentials
-
-
-def get_tree(folder_name, tree_list, root, parents_id, service):
-    """Gets folder tree relative paths.
-
-    Recursively gets through subfolders, remembers their names ad ID's.
-
-    Args:
-        folder_name: Name of folder, initially
-        name of parent folder string.
-        folder_id: ID of folder, initially ID of parent folder.
-        tree_list: List of relative folder paths, initially
-        empy list.
-        root: Current relative folder path, initially empty string.
-        parents_id: Dictionary with pairs of {key:value} like
-        {folder's name: folder's Drive ID}, initially empty dict.
-        service: Google Drive service instance.
-
-    Returns:
-        List of folder tree relative folder paths.
-
-    """
-    folder_id = parents_id[folder_name]
-
-    results = service.files().list(
-        pageSize=100,
-        q=("%r in parents and \
-        mimeType = 'application/vnd.google-apps.folder'and \
-        trashed != True" % folder_id)).execute()
-
-    items = results.get('files', [])
-    root += folder_name + os.path.sep
-
-    for item in items:
-        parents_id[item['name']] = item['id']
-        tree_list.append(root + item['name'])
-        folder_id = [i['id'] for i in items
-                     if i['name'] == item['name']][0]
-        folder_name = item['name']
-        get_tree(folder_name, tree_list,
-                 root, parents_id, service)
-
 
 def download_file_from_gdrive(file_path, drive_file, service):
     """Downloads file from Google Drive.
@@ -242,11 +89,86 @@ def download_file_from_gdrive(file_path, drive_file, service):
 
     else:
         request = service.files().get_media(fileId=file_id)
-        file_io = io.FileIO(os.path.join(file_path, drive_file['name']), 'wb')
-        downloader = MediaIoBaseDownload(file_io, request)
-        done = False
-        while done is False:
-            _, done = downloader.next_chunk()
+        with io.FileIO(os.path.join(file_path, drive_file['name']), 'wb') as file_io:
+            downloader = MediaIoBaseDownload(file_io, request)
+            done = False
+            while done is False:
+                _, done = downloader.next_chunk()
+
+
+def queue_download(pool, file_path, drive_file, manifest=None):
+    """Queues download_file_from_gdrive on a TransferPool.
+
+    Files with an md5 on Drive (everything but Google Docs) are recorded
+    in manifest once downloaded.
+    """
+    def transfer(service):
+        download_file_from_gdrive(file_path, drive_file, service)
+        if manifest is not None and drive_file.get('md5Checksum'):
+            manifest.downloaded(os.path.join(file_path, drive_file['name']), drive_file)
+
+    pool.submit(os.path.join(file_path, drive_file['name']), transfer)
+
+
+def find_note(service, title, folder_name=DIR_NAME):
+    """Metadata of the note file <title>.txt in the sync folder, or None."""
+    cached = folder_name in SESSION.folder_ids
+    while True:
+        folder_id = SESSION.folder_id(service, folder_name, create=False)
+        if folder_id is None:
+            return None
+        query = "{} in parents and name = {} and trashed != True".format(
+            quote(folder_id), quote(title + '.txt'))
+        for drive_file in list_files(service, query, fields=NOTE_FIELDS):
+            return drive_file
+        if not cached:
+            return None
+        # Not there, unless the cached folder was replaced by a new one
+        SESSION.forget_folder(folder_name)
+        cached = False
+
+
+def fetch_note(service, title, data, drive_id=None, folder_name=DIR_NAME):
+    """Fetches one note from Drive if its copy there differs from data.
+
+    Asks Drive for the file's md5Checksum only, and downloads the body,
+    into memory, when the md5 differs from data's. A file that was deleted
+    or trashed counts as missing.
+
+    Args:
+        service: Google Drive service instance.
+        title: Note title, looked up as <title>.txt in the sync folder
+        when drive_id is not known or its file is gone.
+        data: Local note text.
+        drive_id: Drive ID of the note's file, if known.
+        folder_name: Name of the sync folder in My Drive.
+
+    Returns:
+        (Drive file metadata or None if the note is not on Drive,
+        Drive copy's text or None if it matches data).
+    """
+    drive_file = None
+    if drive_id:
+        try:
+            drive_file = service.files().get(fileId=drive_id,        # pylint: disable=no-member
+                                             fields=NOTE_FIELDS).execute()
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+        if drive_file is not None and drive_file.get('trashed'):
+            drive_file = None
+    if drive_file is None:
+        drive_file = find_note(service, title, folder_name)
+    if drive_file is None or \
+            drive_file.get('md5Checksum') == hashlib.md5(data.encode('utf-8')).hexdigest():
+        return drive_file, None
+    buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(buffer, service.files().get_media(  # pylint: disable=no-member
+        fileId=drive_file['id']))
+    done = False
+    while done is False:
+        _, done = downloader.next_chunk()
+    return drive_file, buffer.getvalue().decode('utf-8')
 
 
 def by_lines(input_str):
@@ -258,27 +180,42 @@ def by_lines(input_str):
     return input_str.count(os.path.sep)
 
 
-def main():
-    """Shows basic usage of the Google Drive API.
+def main(full_path=FULL_PATH, make_service=build_service, workers=None):
+    """Mirrors the Google Drive sync folder into the computer folder.
+
+    Downloads new and changed files, removes files and folders that are
+    gone from Drive. A file is downloaded when its md5 differs from the
+    Drive copy's; local md5s come from the sync Manifest. What is on
+    Drive comes from the saved RemoteTree, brought up to date through the
+    Changes API. File content is downloaded by a pool of workers, each
+    with its own service instance; failures are collected and the rest of
+    the sync carries on.
+
+    Args:
+        full_path: Local folder to sync.
+        make_service: Callable returning a new Google Drive service
+        instance, called once here and once per transfer worker.
+        workers: Number of concurrent file transfers.
 
-    Creates a Google Drive API service object and outputs the names and IDs
-    for up to 10 files.
+    Raises:
+        SyncError: Listing every download that failed.
     """
-    # credentials = get_credentials()
-    http = get_credentials().authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-
-    # Get id of Google Drive folder and it's path (from other script)
-    # folder_id, full_path = initial_upload.check_upload(service)
-    folder_id, full_path = check_upload(service)
-    folder_name = full_path.split(os.path.sep)[-1]
-    tree_list, root, parents_id = [], '', {}
-
-    # About_drive = service.about().get(
-    # fields='importFormats, exportFormats').execute()
-    # print(About_drive)
-    parents_id[folder_name] = folder_id
-    get_tree(folder_name, tree_list, root, parents_id, service)
+    service = make_service()
+    pool = TransferPool(make_service, workers)
+    manifest = Manifest(full_path)
+
+    # Get id of Google Drive folder and what it holds
+    tree = sync_tree(service, full_path,
+                     lambda: check_upload(service, full_path, pool)[0])
+    folder_name = os.path.basename(full_path)
+    remote = tree.paths(folder_name)
+    tree_list = [path for path, item in remote.items()
+                 if item['mimeType'] == FOLDER_MIME_TYPE]
+    drive_files = defaultdict(list)
+    for path, item in remote.items():
+        if item['mimeType'] != FOLDER_MIME_TYPE:
+            drive_files[os.path.dirname(path)].append(item)
+
     os_tree_list = []
     root_len = len(full_path.split(os.path.sep)[0:-2])
 
@@ -305,38 +242,19 @@ def main():
 
     for folder_dir in download_folders:
         variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-
-        folder_id = parents_id[last_dir]
-        results = service.files().list(                        # pylint: disable=no-member
-            pageSize=20, q=('%r in parents' % folder_id)).execute()
-
-        items = results.get('files', [])
         os.makedirs(variable)
-        files = [f for f in items
-                 if f['mimeType'] != 'application/vnd.google-apps.folder']
 
-        for drive_file in files:
-            # file_id = f['id']
-            download_file_from_gdrive(variable, drive_file, service)
+        for drive_file in drive_files[folder_dir]:
+            queue_download(pool, variable, drive_file, manifest)
 
     # Check and refresh files in existing folders
     for folder_dir in exact_folders:
         # var = '/'.join(full_path.split('/')[0:-1]) + '/'
         variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
         os_files = [f for f in os.listdir(variable)
                     if os.path.isfile(os.path.join(variable, f))]
-        folder_id = parents_id[last_dir]
 
-        results = service.files().list(                # pylint: disable=no-member
-            pageSize=1000,
-            q=('%r in parents and \
-            mimeType!="application/vnd.google-apps.folder"' % folder_id),
-            fields="files(id, name, mimeType, \
-                modifiedTime, md5Checksum)").execute()
-
-        items = results.get('files', [])
+        items = drive_files[folder_dir]
 
         refresh_files = [f for f in items if f['name'] in os_files]
         upload_files = [f for f in items if f['name'] not in os_files]
@@ -345,30 +263,21 @@ def main():
 
         for drive_file in refresh_files:
             file_dir = os.path.join(variable, drive_file['name'])
-            file_time = os.path.getmtime(file_dir)
-            # mtime = drive_file['modifiedTime']
-            mtime = datetime.datetime.strptime(drive_file['modifiedTime'][:-2],
-                                               "%Y-%m-%dT%H:%M:%S.%f")
-            drive_time = time.mktime(mtime.timetuple())
+            os_file_md5 = manifest.local_md5(file_dir)
+            drive_md5 = drive_file.get('md5Checksum')
 
-            file_dir = os.path.join(variable, drive_file['name'])
-            os_file_md5 = hashlib.md5(open(file_dir, 'rb').read()).hexdigest()
-            if 'md5Checksum' in drive_file.keys():
-                # print(1, file['md5Checksum'])
-                drive_md5 = drive_file['md5Checksum']
-                # print(2, os_file_md5)
-            else:
-                drive_md5 = None
-
-            if (file_time < drive_time) or (drive_md5 != os_file_md5):
+            if drive_md5 != os_file_md5:
                 os.remove(os.path.join(variable, drive_file['name']))
-                download_file_from_gdrive(variable, drive_file, service)
+                queue_download(pool, variable, drive_file, manifest)
 
         for os_file in remove_files:
             os.remove(os.path.join(variable, os_file))
 
         for drive_file in upload_files:
-            download_file_from_gdrive(variable, drive_file, service)
+            queue_download(pool, variable, drive_file, manifest)
+
+    failures = pool.wait()
+    manifest.save()
 
     # Delete old and unwanted folders from computer
     remove_folders = sorted(remove_folders, key=by_lines, reverse=True)
@@ -376,8 +285,10 @@ def main():
     for folder_dir in remove_folders:
         # var = '/'.join(full_path.split('/')[0:-1]) + '/'
         variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
         shutil.rmtree(variable)
 
+    if failures:
+        raise SyncError(failures)
+
 if __name__ == '__main__':
     main()
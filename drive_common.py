@@ -0,0 +1,548 @@
+"""Helpers shared by the Google Drive sync scripts."""
+import datetime
+import hashlib
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from googleapiclient.errors import HttpError
+from peewee import chunked
+
+import models as m
+import storage
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Drive rejects batch requests holding more than 100 calls
+BATCH_LIMIT = 100
+
+# Metadata kept for every file and folder of a synced tree
+FILE_FIELDS = 'id, name, mimeType, parents, trashed, md5Checksum, modifiedTime'
+CHANGE_FIELDS = ('nextPageToken, newStartPageToken, '
+                 'changes(fileId, removed, file({}))'.format(FILE_FIELDS))
+
+# Folders named in the parents clause of one file listing query
+PARENTS_PER_QUERY = 50
+
+# Statuses Drive answers an expired or unknown page token with
+INVALID_TOKEN_STATUSES = (400, 404, 410)
+
+# Bytes read at a time when hashing a local file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Concurrent media transfers, override with NOTES_DRIVE_WORKERS
+TRANSFER_WORKERS = int(os.getenv('NOTES_DRIVE_WORKERS', '4'))
+
+# Uploads larger than one chunk go up resumably, a chunk at a time. Override
+# with NOTES_DRIVE_CHUNK_KB, rounded down to Drive's 256 KiB chunk unit
+CHUNK_UNIT = 256 * 1024
+UPLOAD_CHUNK_SIZE = max(int(os.getenv('NOTES_DRIVE_CHUNK_KB', '8192')) * 1024 // CHUNK_UNIT,
+                        1) * CHUNK_UNIT
+
+# Retries of an upload call failing with a network error or a 5xx
+UPLOAD_RETRIES = 3
+
+# Drive keeps resumable upload sessions for a week
+UPLOAD_SESSION_AGE = datetime.timedelta(days=6)
+
+
+class SyncError(Exception):
+    """Raised at the end of a sync in which some Drive operations failed.
+
+    Attributes:
+        failures: List of (what, exception) pairs, one per failed operation.
+    """
+
+    def __init__(self, failures):
+        super().__init__('{} Drive operation(s) failed: {}'.format(
+            len(failures), ', '.join(str(what) for what, _ in failures)))
+        self.failures = failures
+
+
+def execute_batched(service, requests, batch_limit=BATCH_LIMIT):
+    """Runs API requests as Drive HTTP batch requests.
+
+    Media uploads and downloads cannot be batched, everything else
+    (metadata create/update, list, get, delete) can.
+
+    Args:
+        service: Google Drive service instance.
+        requests: List of HttpRequest objects, e.g. service.files().list(...).
+        batch_limit: Maximum calls per batch round trip.
+
+    Returns:
+        List of (response, exception) pairs in request order, exception is
+        None for calls that succeeded.
+    """
+    results = [(None, None)] * len(requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    for start in range(0, len(requests), batch_limit):
+        batch = service.new_batch_http_request(callback=callback)
+        for index in range(start, min(start + batch_limit, len(requests))):
+            batch.add(requests[index], request_id=str(index))
+        batch.execute()
+    return results
+
+
+def quote(value):
+    """value as a string literal in a Drive search query."""
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def list_files(service, query, fields=FILE_FIELDS, page_size=1000):
+    """Yields every file matching a Drive query, following nextPageToken.
+
+    Args:
+        service: Google Drive service instance.
+        query: Drive search query, e.g. "'root' in parents".
+        fields: File fields to fetch.
+        page_size: Files asked for per call.
+    """
+    kwargs = {'q': query, 'pageSize': page_size,
+              'fields': 'nextPageToken, files({})'.format(fields)}
+    while True:
+        response = service.files().list(**kwargs).execute()
+        for item in response.get('files', []):
+            yield item
+        if not response.get('nextPageToken'):
+            return
+        kwargs['pageToken'] = response['nextPageToken']
+
+
+def upload_progress(request, uri):
+    """Asks Drive how much of a resumable upload it has received.
+
+    Args:
+        request: HttpRequest of the upload.
+        uri: Upload session URI.
+
+    Returns:
+        (bytes received, None) for an unfinished upload, (None, response)
+        for a finished one, (None, None) if Drive no longer knows the session.
+    """
+    response, content = request.http.request(uri, 'PUT', headers={
+        'Content-Length': '0', 'Content-Range': 'bytes */{}'.format(request.resumable.size())})
+    if response.status == 308:
+        received = response.get('range')
+        return (int(received.rsplit('-', 1)[1]) + 1 if received else 0), None
+    if response.status in (200, 201):
+        return None, request.postproc(response, content)
+    return None, None
+
+
+def _save_session(key, target, fingerprint, uri):
+    m.UploadSession.insert(key=key, target=target, fingerprint=fingerprint,
+                           uri=uri).on_conflict_replace().execute()
+
+
+def execute_upload(request, key, target, fingerprint):
+    """Runs a files().create or files().update request with a media body.
+
+    Media that is not resumable goes up in the request itself. Resumable
+    media goes up a chunk at a time; its upload session URI is saved in
+    the notes database until the upload completes, so an upload of the
+    same content to the same target interrupted earlier, even by another
+    process, carries on from the last byte Drive acknowledged.
+
+    Args:
+        request: HttpRequest with a media body.
+        key: Name of what is uploaded, e.g. its local path.
+        target: Drive ID of the file updated, or of the parent folder of
+        the file created.
+        fingerprint: String that changes whenever the content does, e.g.
+        the local file's size and mtime.
+
+    Returns:
+        The response of the request.
+    """
+    if request.resumable is None:
+        return request.execute(num_retries=UPLOAD_RETRIES)
+    storage.connect()
+    saved = m.UploadSession.get_or_none(m.UploadSession.key == key)
+    if saved is not None and (saved.target, saved.fingerprint) == (target, fingerprint) and \
+            saved.created > datetime.datetime.now() - UPLOAD_SESSION_AGE:
+        progress, response = upload_progress(request, saved.uri)
+        if response is not None:
+            saved.delete_instance()
+            return response
+        if progress is not None:
+            request.resumable_uri, request.resumable_progress = saved.uri, progress
+
+    saved_uri = request.resumable_uri
+    response = None
+    try:
+        while response is None:
+            _, response = request.next_chunk(num_retries=UPLOAD_RETRIES)
+            if response is None and request.resumable_uri != saved_uri:
+                saved_uri = request.resumable_uri
+                _save_session(key, target, fingerprint, saved_uri)
+    finally:
+        # Failed before the first chunk got through, Drive may still have the session
+        if response is None and request.resumable_uri not in (None, saved_uri):
+            _save_session(key, target, fingerprint, request.resumable_uri)
+    m.UploadSession.delete().where(m.UploadSession.key == key).execute()
+    return response
+
+
+class TransferPool:
+    """Runs media uploads and downloads on a bounded pool of worker threads.
+
+    httplib2.Http is not thread-safe, so every worker thread builds its
+    own service (and with it its own authorized HTTP connection) the
+    first time it runs a transfer.
+
+    Args:
+        make_service: Callable returning a new Google Drive service instance.
+        workers: Number of concurrent transfers.
+        progress: Optional callable(done, total, what) called after each
+        transfer finishes.
+    """
+
+    def __init__(self, make_service, workers=None, progress=None):
+        self.make_service = make_service
+        self.progress = progress
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers or TRANSFER_WORKERS)
+        self.futures = []
+        self.failures = []
+        self.done = 0
+
+    def service(self):
+        """The calling thread's own service instance."""
+        if getattr(self.local, 'service', None) is None:
+            self.local.service = self.make_service()
+        return self.local.service
+
+    def submit(self, what, transfer, *args):
+        """Queues transfer(service, *args); what names it in failures."""
+        self.futures.append(self.executor.submit(self._run, what, transfer, args))
+
+    def _run(self, what, transfer, args):
+        try:
+            return transfer(self.service(), *args)
+        except (HttpError, httplib2.HttpLib2Error, OSError) as error:
+            with self.lock:
+                self.failures.append((what, error))
+            return None
+        finally:
+            with self.lock:
+                self.done += 1
+                done = self.done
+            if self.progress:
+                self.progress(done, len(self.futures), what)
+
+    def wait(self, shutdown=True):
+        """Waits for every queued transfer.
+
+        Args:
+            shutdown: Stop the worker threads, pass False to keep
+            submitting transfers afterwards.
+
+        Returns:
+            List of (what, exception) for the transfers that failed since
+            the previous wait.
+        """
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            if shutdown:
+                self.executor.shutdown()
+        with self.lock:
+            failures, self.failures = self.failures, []
+        return failures
+
+
+class RemoteTree:  # pylint: disable=too-many-instance-attributes
+    """Last known Drive metadata of everything under a synced folder.
+
+    Saved in the notes database along with a Changes API page token, so a
+    sync only asks Drive for what changed since the previous one instead
+    of listing every folder.
+
+    Args:
+        folder_id: Drive ID of the synced folder.
+        items: Dictionary of {Drive ID: file metadata} for its contents.
+    """
+
+    def __init__(self, folder_id, items=None):
+        self.folder_id = folder_id
+        self.items = items or {}
+        self.dirty = set()
+        self.rescanned = False
+        self.root_removed = False
+
+    @classmethod
+    def load(cls, full_path):
+        """Saved tree and page token of full_path, (None, None) if never synced."""
+        storage.connect()
+        root = m.DriveRoot.get_or_none(m.DriveRoot.path == full_path)
+        if root is None:
+            return None, None
+        items = {}
+        for row in root.items:
+            items[row.drive_id] = {'id': row.drive_id, 'name': row.name,
+                                   'parents': [row.parent_id], 'mimeType': row.mime_type,
+                                   'md5Checksum': row.md5, 'modifiedTime': row.modified_time}
+        return cls(root.folder_id, items), root.page_token
+
+    @classmethod
+    def scan(cls, service, folder_id):
+        """Lists everything under folder_id.
+
+        Walks the synced tree a level at a time, so the number of queries
+        grows with the tree and not with the rest of the Drive: each one
+        lists files and folders of PARENTS_PER_QUERY folders of a level.
+        """
+        tree = cls(folder_id)
+        tree.rescanned = True
+        tree.add_descendants(service, [folder_id])
+        return tree
+
+    def update(self, item):
+        """Records new metadata of a file or folder."""
+        if item['id'] == self.folder_id:
+            self.root_removed = self.root_removed or bool(item.get('trashed'))
+            return
+        if item.get('trashed'):
+            self.discard(item['id'])
+            return
+        self.items[item['id']] = {key: item.get(key) for key in
+                                  ('id', 'name', 'parents', 'mimeType',
+                                   'md5Checksum', 'modifiedTime')}
+        self.dirty.add(item['id'])
+
+    def discard(self, drive_id):
+        """Forgets a file or folder that was removed from Drive."""
+        if drive_id == self.folder_id:
+            self.root_removed = True
+        if self.items.pop(drive_id, None) is not None:
+            self.dirty.add(drive_id)
+
+    def add_descendants(self, service, folder_ids):
+        """Lists everything under folder_ids into the tree, a level at a time.
+
+        Each query names PARENTS_PER_QUERY folders of the level in its
+        parents clause.
+        """
+        level = list(folder_ids)
+        while level:
+            found = []
+            for start in range(0, len(level), PARENTS_PER_QUERY):
+                parents = ' or '.join('{} in parents'.format(quote(parent))
+                                      for parent in level[start:start + PARENTS_PER_QUERY])
+                for item in list_files(service, '({}) and trashed != True'.format(parents)):
+                    self.update(item)
+                    if item['mimeType'] == FOLDER_MIME_TYPE:
+                        found.append(item['id'])
+            level = found
+
+    def apply_changes(self, service, token):
+        """Applies every change made on Drive since token.
+
+        Changes cover the whole Drive, anything that does not end up
+        under the synced folder is dropped afterwards. A folder moved in
+        from elsewhere or restored from the trash comes as a single
+        change, so the contents of folders new to the tree are listed.
+
+        Returns:
+            Page token to start from on the next sync.
+        """
+        appeared = set()
+        while True:
+            response = service.changes().list(pageToken=token, pageSize=1000,
+                                              fields=CHANGE_FIELDS).execute()
+            for change in response.get('changes', []):
+                if change.get('removed') or 'file' not in change:
+                    self.discard(change['fileId'])
+                    appeared.discard(change['fileId'])
+                    continue
+                item = change['file']
+                if item.get('mimeType') == FOLDER_MIME_TYPE and item['id'] not in self.items:
+                    appeared.add(item['id'])
+                self.update(item)
+            if 'newStartPageToken' in response:
+                self.prune()
+                appeared &= set(self.items)
+                self.add_descendants(service, [
+                    folder for folder in appeared
+                    if (self.items[folder].get('parents') or [None])[0] not in appeared])
+                return response['newStartPageToken']
+            token = response['nextPageToken']
+
+    def paths(self, root_name):
+        """Maps relative paths to metadata of every item under the synced folder.
+
+        Args:
+            root_name: Path the synced folder itself maps to.
+
+        Returns:
+            Dictionary of {path: file metadata}, paths like root_name/sub/file.
+        """
+        children = defaultdict(list)
+        for item in self.items.values():
+            children[(item.get('parents') or [None])[0]].append(item)
+        paths, stack = {}, [(self.folder_id, root_name)]
+        while stack:
+            parent, parent_path = stack.pop()
+            for item in children[parent]:
+                path = os.path.join(parent_path, item['name'])
+                paths[path] = item
+                if item['mimeType'] == FOLDER_MIME_TYPE:
+                    stack.append((item['id'], path))
+        return paths
+
+    def prune(self):
+        """Forgets items that are no longer under the synced folder."""
+        reached = {item['id'] for item in self.paths('').values()}
+        for drive_id in [key for key in self.items if key not in reached]:
+            self.discard(drive_id)
+
+    def save(self, full_path, token):
+        """Saves the tree and page token, writing only the items that changed."""
+        with storage.transaction():
+            root = m.DriveRoot.get_or_none(m.DriveRoot.path == full_path)
+            if root is None:
+                root = m.DriveRoot.create(path=full_path, folder_id=self.folder_id,
+                                          page_token=token)
+            elif (root.folder_id, root.page_token) != (self.folder_id, token):
+                root.folder_id, root.page_token = self.folder_id, token
+                root.save()
+            stale = m.DriveItem.delete().where(m.DriveItem.root == root)
+            if not self.rescanned:
+                if not self.dirty:
+                    return
+                stale = stale.where(m.DriveItem.drive_id.in_(list(self.dirty)))
+            stale.execute()
+            ids = self.items if self.rescanned else self.dirty & set(self.items)
+            rows = []
+            for drive_id in ids:
+                item = self.items[drive_id]
+                rows.append({'root': root, 'drive_id': drive_id, 'name': item['name'],
+                             'parent_id': (item.get('parents') or [''])[0],
+                             'mime_type': item['mimeType'], 'md5': item.get('md5Checksum'),
+                             'modified_time': item.get('modifiedTime')})
+            for batch in chunked(rows, 100):
+                m.DriveItem.insert_many(batch).execute()
+        self.dirty, self.rescanned = set(), False
+
+
+def file_md5(path):
+    """Hex md5 of a file, read in HASH_CHUNK_SIZE chunks."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Size, mtime and md5 of the local files of a synced folder.
+
+    A file is only hashed again when its size or mtime changed since it
+    was last hashed. Transfers record the Drive copy a file was synced
+    with; they may do so from worker threads, the manifest is saved from
+    the syncing thread once they are done.
+
+    Args:
+        full_path: Local folder being synced.
+    """
+
+    def __init__(self, full_path):
+        storage.connect()
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.dirty = set()
+        prefix = os.path.join(full_path, '')
+        self.rows = {row.path: row for row in m.DriveFile.select().where(
+            m.DriveFile.path.startswith(prefix))}
+
+    def _row(self, path):
+        row = self.rows.get(path)
+        if row is None:
+            row = self.rows[path] = m.DriveFile(path=path)
+        self.seen.add(path)
+        self.dirty.add(path)
+        return row
+
+    def local_md5(self, path):
+        """md5 of a local file, from the manifest if it looks unchanged."""
+        stat = os.stat(path)
+        with self.lock:
+            self.seen.add(path)
+            row = self.rows.get(path)
+            if row is not None and row.md5 and \
+                    (row.size, row.mtime) == (stat.st_size, stat.st_mtime):
+                return row.md5
+        md5 = file_md5(path)
+        with self.lock:
+            row = self._row(path)
+            row.size, row.mtime, row.md5 = stat.st_size, stat.st_mtime, md5
+        return md5
+
+    def uploaded(self, path, drive_file):
+        """Records the Drive copy a local file was uploaded to."""
+        with self.lock:
+            row = self._row(path)
+            row.drive_id, row.drive_md5 = drive_file['id'], drive_file.get('md5Checksum')
+
+    def downloaded(self, path, drive_file):
+        """Records a file just downloaded, its content matching the Drive copy."""
+        stat = os.stat(path)
+        with self.lock:
+            row = self._row(path)
+            row.drive_id, row.drive_md5 = drive_file['id'], drive_file.get('md5Checksum')
+            row.size, row.mtime = stat.st_size, stat.st_mtime
+            row.md5 = drive_file.get('md5Checksum')
+
+    def save(self):
+        """Writes changed entries and drops those of files not seen this sync."""
+        with storage.transaction():
+            gone = [path for path in self.rows if path not in self.seen]
+            for batch in chunked(gone, 100):
+                m.DriveFile.delete().where(m.DriveFile.path.in_(batch)).execute()
+            for path in self.dirty:
+                self.rows[path].save()
+        self.dirty = set()
+
+
+def sync_tree(service, full_path, find_folder):
+    """Brings the saved RemoteTree of full_path up to date with Drive.
+
+    Uses the Changes API from the saved page token, so a sync with nothing
+    changed on Drive costs one call. Falls back to a full listing the
+    first time, when Drive no longer accepts the token, or when the
+    synced folder itself was removed.
+
+    Args:
+        service: Google Drive service instance.
+        full_path: Local folder being synced.
+        find_folder: Callable returning the Drive ID of the synced folder,
+        creating and uploading it if needed; only called on a full listing.
+
+    Returns:
+        Up to date RemoteTree.
+    """
+    tree, token = RemoteTree.load(full_path)
+    if token is not None:
+        try:
+            token = tree.apply_changes(service, token)
+        except HttpError as error:
+            if error.resp.status not in INVALID_TOKEN_STATUSES:
+                raise
+        else:
+            if not tree.root_removed:
+                tree.save(full_path, token)
+                return tree
+
+    # Taken before listing, so changes made while listing show up next sync
+    token = service.changes().getStartPageToken().execute()['startPageToken']
+    tree = RemoteTree.scan(service, find_folder())
+    tree.save(full_path, token)
+    return tree
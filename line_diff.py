@@ -0,0 +1,302 @@
+"""Line diff for large notes.
+
+difflib.Differ compares every pair of differing lines character by
+character, which is quadratic on notes of thousands of lines. This diffs
+whole lines instead, each interned to an integer: lines found once in
+both versions anchor a patience diff, and the gaps between anchors are
+diffed with Myers' O(ND) algorithm in linear space (bisecting on the
+middle snake, as diff-match-patch does). As there, Myers' search stops
+at a deadline, and what is left is matched by difflib.SequenceMatcher,
+which is quick on the notes that take Myers long. Matching blocks, hunks
+and unified diff lines are all produced lazily, so the first hunk can be
+shown before the rest of the diff is computed. Only replaced hunks of a
+few lines get Differ-style intraline hints.
+"""
+import bisect
+import difflib
+import time
+from collections import Counter
+
+# Lines of both versions up to which diffcheck keeps using difflib.Differ
+DIFFER_MAX_LINES = 500
+CONTEXT = 3
+# Replaced hunks up to this many lines a side get intraline hints
+INTRALINE_MAX_LINES = 8
+INTRALINE_MIN_RATIO = 0.75
+# Seconds the Myers search of one diff may take, None for no limit
+TIMEOUT = 1.0
+# Myers' search leaves a gap needing over twice this many edits to SequenceMatcher
+MAX_EDIT_COST = 400
+
+
+def intern_lines(a, b):
+    """a and b with each distinct line replaced by an integer"""
+    ids = {}
+    return [ids.setdefault(line, len(ids)) for line in a], \
+        [ids.setdefault(line, len(ids)) for line in b]
+
+
+def _bisect(a, b, deadline):
+    """
+    Where a shortest edit script of a into b crosses its middle
+    :return: (x, y) split point, None if a and b have nothing in common,
+        differ by more than MAX_EDIT_COST edits or the deadline passed
+    """
+    n, m = len(a), len(b)
+    max_d = min((n + m + 1) // 2, MAX_EDIT_COST)
+    offset, length = max_d, 2 * max_d + 2
+    forward = [-1] * length
+    forward[offset + 1] = 0
+    backward = forward[:]
+    delta = n - m
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        if time.monotonic() > deadline:
+            return None
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[x1] == b[y1]:
+                x1 += 1
+                y1 += 1
+            forward[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < length and backward[k2_offset] != -1 \
+                        and x1 >= n - backward[k2_offset]:
+                    return x1, y1
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]):
+                x2 = backward[k2_offset + 1]
+            else:
+                x2 = backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[-x2 - 1] == b[-y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < length and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    if x1 >= n - x2:
+                        return x1, offset + x1 - k1_offset
+    return None
+
+
+def _anchors(a, b):
+    """
+    Longest increasing run of lines found exactly once in both a and b
+    :return: list of (i, j) positions
+    """
+    a_counts, b_counts = Counter(a), Counter(b)
+    b_index = {line: j for j, line in enumerate(b) if b_counts[line] == 1 and a_counts[line] == 1}
+    pairs = [(i, b_index[line]) for i, line in enumerate(a) if line in b_index]
+    # Patience sorting: tails[k] ends the best run of length k + 1 found so far
+    tails, tail_pairs, previous = [], [], []
+    for index, (_, j) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tail_pairs.append(index)
+        else:
+            tails[pile] = j
+            tail_pairs[pile] = index
+        previous.append(tail_pairs[pile - 1] if pile else None)
+    anchors = []
+    index = tail_pairs[-1] if tail_pairs else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    return anchors[::-1]
+
+
+def _match(a, b, i, j, deadline):
+    """Yield the (i, j, size) equal runs of a and b in order, offset by i and j"""
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    if prefix:
+        yield i, j, prefix
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix \
+            and a[-suffix - 1] == b[-suffix - 1]:
+        suffix += 1
+    middle_a, middle_b = a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+    anchors = _anchors(middle_a, middle_b) if middle_a and middle_b else []
+    if anchors:
+        start_a = start_b = 0
+        for anchor_a, anchor_b in anchors:
+            yield from _match(middle_a[start_a:anchor_a], middle_b[start_b:anchor_b],
+                              i + prefix + start_a, j + prefix + start_b, deadline)
+            yield i + prefix + anchor_a, j + prefix + anchor_b, 1
+            start_a, start_b = anchor_a + 1, anchor_b + 1
+        yield from _match(middle_a[start_a:], middle_b[start_b:],
+                          i + prefix + start_a, j + prefix + start_b, deadline)
+    elif middle_a and middle_b and not set(middle_a).isdisjoint(middle_b):
+        split = _bisect(middle_a, middle_b, deadline)
+        if split is not None:
+            x, y = split
+            yield from _match(middle_a[:x], middle_b[:y], i + prefix, j + prefix, deadline)
+            yield from _match(middle_a[x:], middle_b[y:], i + prefix + x, j + prefix + y,
+                              deadline)
+        else:
+            # Too far apart for Myers, the two do share a line
+            matcher = difflib.SequenceMatcher(None, middle_a, middle_b)
+            for x, y, size in matcher.get_matching_blocks()[:-1]:
+                yield i + prefix + x, j + prefix + y, size
+    if suffix:
+        yield i + len(a) - suffix, j + len(b) - suffix, suffix
+
+
+def matching_blocks(a, b, timeout=TIMEOUT):
+    """
+    Yield the runs of equal items of a and b, as difflib.SequenceMatcher gives them
+    :param timeout: seconds to spend on Myers' search, None for no limit
+    :return: (i, j, size) tuples, ending with (len(a), len(b), 0)
+    """
+    deadline = float('inf') if timeout is None else time.monotonic() + timeout
+    merged = (0, 0, 0)
+    for i, j, size in _match(a, b, 0, 0, deadline):
+        if merged[0] + merged[2] == i and merged[1] + merged[2] == j:
+            merged = (merged[0], merged[1], merged[2] + size)
+        else:
+            if merged[2]:
+                yield merged
+            merged = (i, j, size)
+    if merged[2]:
+        yield merged
+    yield len(a), len(b), 0
+
+
+def opcodes(a, b, timeout=TIMEOUT):
+    """Yield the (tag, i1, i2, j1, j2) edits turning a into b, as SequenceMatcher.get_opcodes"""
+    i = j = 0
+    for a_start, b_start, size in matching_blocks(a, b, timeout):
+        if i < a_start and j < b_start:
+            yield 'replace', i, a_start, j, b_start
+        elif i < a_start:
+            yield 'delete', i, a_start, j, b_start
+        elif j < b_start:
+            yield 'insert', i, a_start, j, b_start
+        i, j = a_start + size, b_start + size
+        if size:
+            yield 'equal', a_start, i, b_start, j
+
+
+def grouped(codes, context=CONTEXT):
+    """
+    Split opcodes into hunks with at most context equal lines around changes,
+    yielding each hunk as soon as the equal run that ends it is read
+    """
+    if context is None:
+        codes = list(codes)
+        if any(code[0] != 'equal' for code in codes):
+            yield codes
+        return
+    group = []
+    first = True
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and first:
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        first = False
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            if len(group) > 1 or group[0][0] != 'equal':
+                yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and group[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = group[-1]
+        group[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _range(start, stop):
+    """Line range of a unified hunk header"""
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return '{},{}'.format(start + 1 if length else start, length)
+
+
+def _hints(old, new):
+    """Differ-style '?' guide lines marking what changed between two lines"""
+    old_marks, new_marks = [], []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new).get_opcodes():
+        old_marks.append({'equal': ' ', 'replace': '^', 'delete': '-'}.get(tag, '') * (i2 - i1))
+        new_marks.append({'equal': ' ', 'replace': '^', 'insert': '+'}.get(tag, '') * (j2 - j1))
+    return ''.join(old_marks).rstrip(), ''.join(new_marks).rstrip()
+
+
+def _replaced(old, new):
+    """Unified lines of a replaced hunk, with intraline hints if it is small"""
+    if len(old) > INTRALINE_MAX_LINES or len(new) > INTRALINE_MAX_LINES:
+        for line in old:
+            yield '-' + line
+        for line in new:
+            yield '+' + line
+        return
+    for old_line, new_line in zip(old, new):
+        matcher = difflib.SequenceMatcher(None, old_line, new_line)
+        if matcher.real_quick_ratio() < INTRALINE_MIN_RATIO or \
+                matcher.ratio() < INTRALINE_MIN_RATIO:
+            yield '-' + old_line
+            yield '+' + new_line
+            continue
+        old_hint, new_hint = _hints(old_line, new_line)
+        yield '-' + old_line
+        if old_hint:
+            yield '?' + old_hint
+        yield '+' + new_line
+        if new_hint:
+            yield '?' + new_hint
+    for line in old[len(new):]:
+        yield '-' + line
+    for line in new[len(old):]:
+        yield '+' + line
+
+
+def unified(a, b, context=CONTEXT, fromfile='', tofile='', timeout=TIMEOUT):
+    """
+    Yield a unified diff of two lists of lines, hunk by hunk
+    :param context: equal lines shown around each change, None for all
+    :param timeout: seconds to spend on Myers' search, as in matching_blocks
+    """
+    a_ids, b_ids = intern_lines(a, b)
+    started = False
+    for group in grouped(opcodes(a_ids, b_ids, timeout), context):
+        if not started:
+            yield '--- ' + fromfile
+            yield '+++ ' + tofile
+            started = True
+        yield '@@ -{} +{} @@'.format(_range(group[0][1], group[-1][2]),
+                                     _range(group[0][3], group[-1][4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+            elif tag == 'replace':
+                for line in _replaced(a[i1:i2], b[j1:j2]):
+                    yield line
+            else:
+                for line in a[i1:i2]:
+                    yield '-' + line
+                for line in b[j1:j2]:
+                    yield '+' + line
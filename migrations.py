@@ -0,0 +1,81 @@
+"""Schema and data migrations for the notes database.
+
+The schema version is kept in SQLite's ``user_version`` pragma. Columns
+added to existing models are created automatically, data migrations in
+``DATA_MIGRATIONS`` run once each, in order.
+"""
+from playhouse.migrate import SqliteMigrator, migrate as run_migrations
+
+import models as m
+
+
+def add_missing_columns(database):
+    """Add columns declared on the models but absent from existing tables"""
+    migrator = SqliteMigrator(database)
+    for model in m.MODELS:
+        table = model._meta.table_name
+        if not database.table_exists(table):
+            continue
+        existing = {column.name for column in database.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                run_migrations(migrator.add_column(table, field.column_name, field))
+
+
+def split_tags(tags):
+    """Turn a comma separated tag string (or an iterable of tags) into names"""
+    if not tags:
+        return []
+    if not isinstance(tags, (list, tuple, set)):
+        tags = str(tags).split(',')
+    return sorted({tag.strip() for tag in tags if tag and tag.strip()})
+
+
+def migrate_csv_tags(database):  # pylint: disable=unused-argument
+    """Copy the comma separated Note.tags column into the Tag/NoteTag tables"""
+    rows = m.Note.select(m.Note.id, m.Note.tags).where(m.Note.tags.is_null(False)).tuples()
+    links = [(note_id, name) for note_id, tags in rows for name in split_tags(tags)]
+    names = sorted({name for _, name in links})
+    for start in range(0, len(names), 100):
+        m.Tag.insert_many([{'name': name} for name in names[start:start + 100]]) \
+            .on_conflict_ignore().execute()
+    tag_ids = dict(m.Tag.select(m.Tag.name, m.Tag.id).tuples())
+    rows = [{'note': note_id, 'tag': tag_ids[name]} for note_id, name in links]
+    for start in range(0, len(rows), 100):
+        m.NoteTag.insert_many(rows[start:start + 100]).on_conflict_ignore().execute()
+
+
+def link_versions(database):  # pylint: disable=unused-argument
+    """Fill Versions.note/version_no from the legacy "<n>_<title>" titles"""
+    note_ids = dict(m.Note.select(m.Note.title, m.Note.id).tuples())
+    rows = list(m.Versions.select(m.Versions.id, m.Versions.title)
+                .where(m.Versions.note.is_null()).tuples())
+    for version_id, title in rows:
+        number, _, note_title = title.partition('_')
+        if number.isdigit() and note_title in note_ids:
+            m.Versions.update(note=note_ids[note_title], version_no=int(number)) \
+                .where(m.Versions.id == version_id).execute()
+
+
+def drop_listing_indexes(database):
+    """Drop indexes superseded by the covering listing indexes"""
+    database.execute_sql('DROP INDEX IF EXISTS "note_timestamp_id"')
+    database.execute_sql('DROP INDEX IF EXISTS "versions_note_id_version_no"')
+
+
+DATA_MIGRATIONS = [
+    migrate_csv_tags,
+    link_versions,
+    drop_listing_indexes,
+]
+
+
+def migrate(database):
+    """Bring the database schema and data up to date"""
+    add_missing_columns(database)
+    database.create_tables(m.MODELS, safe=True)
+    version = database.pragma('user_version')
+    for number, step in enumerate(DATA_MIGRATIONS[version:], version + 1):
+        with database.atomic():
+            step(database)
+            database.pragma('user_version', number)
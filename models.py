@@ -8,6 +8,21 @@ PATH = os.getenv('HOME', os.path.expanduser('~')) + '/.notes'
 proxy = Proxy()  # pylint: disable=invalid-name
 
 
+class Vault(Model):
+    """
+    Master key of the notes protected by one password, wrapped by a key
+    derived from the password with scrypt (N = 2 ** cost)
+    """
+    salt = CharField()
+    cost = IntegerField()
+    key_id = CharField(index=True)
+    wrapped_key = TextField()
+    created = DateTimeField(default=datetime.datetime.now)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+
+
 class Note(Model):
     """
     Note model in db
@@ -18,9 +33,21 @@ class Note(Model):
     timestamp = DateTimeField(default=datetime.datetime.now)
     tags = CharField(null=True)
     sync = BooleanField(default=False)
+    drive_id = CharField(null=True)
+    # Notes in a vault are encrypted under their own data key, kept wrapped
+    # by the vault's master key; password is only set on older notes
+    vault = ForeignKeyField(Vault, null=True, backref='notes')
+    data_key = TextField(null=True)
 
     class Meta: # pylint: disable=too-few-public-methods
         database = proxy
+        # Covers the note list, so paging it never reads the content pages
+        indexes = (
+            (('timestamp', 'id', 'title', 'tags', 'password', 'sync'), False),
+        )
+
+NOTE_LISTING = (Note.id, Note.title, Note.timestamp, Note.tags, Note.password, Note.sync)
+
 
 class Versions(Model):
     """
@@ -29,7 +56,141 @@ class Versions(Model):
     title = CharField()
     content = TextField()
     timestamp = DateTimeField(default=datetime.datetime.now)
+    note = ForeignKeyField(Note, null=True, backref='versions', on_delete='CASCADE')
+    version_no = IntegerField(default=1)
+    is_delta = BooleanField(default=False)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+        # Covers the version list of a note as well as lookups by version_no
+        indexes = (
+            (('note', 'version_no', 'title', 'timestamp', 'is_delta'), False),
+        )
+
+
+VERSION_LISTING = (Versions.id, Versions.title, Versions.timestamp, Versions.note,
+                   Versions.version_no, Versions.is_delta)
+
+
+class Tag(Model):
+    """
+    Tag model in the DB, one row per distinct tag name
+    """
+    name = CharField(unique=True)
 
     class Meta: # pylint: disable=too-few-public-methods
         database = proxy
-        
\ No newline at end of file
+
+
+class NoteTag(Model):
+    """
+    Many-to-many join between Note and Tag
+    """
+    note = ForeignKeyField(Note, backref='note_tags', on_delete='CASCADE')
+    tag = ForeignKeyField(Tag, backref='note_tags', on_delete='CASCADE')
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+        primary_key = CompositeKey('note', 'tag')
+        indexes = (
+            (('tag', 'note'), True),
+        )
+
+
+class SearchTerm(Model):
+    """
+    Blind index of note contents: one row per keyed hash of a word of a note
+    """
+    term = CharField()
+    note = ForeignKeyField(Note, backref='search_terms', on_delete='CASCADE')
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+        primary_key = CompositeKey('term', 'note')
+        indexes = (
+            (('note', 'term'), True),
+        )
+
+
+class DriveRoot(Model):
+    """
+    A local folder synced with Google Drive and its Changes API cursor
+    """
+    path = CharField(unique=True)
+    folder_id = CharField()
+    page_token = CharField(null=True)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+
+
+class DriveItem(Model):
+    """
+    Last known Drive metadata of a file or folder under a synced folder
+    """
+    root = ForeignKeyField(DriveRoot, backref='items', on_delete='CASCADE')
+    drive_id = CharField()
+    name = CharField()
+    parent_id = CharField()
+    mime_type = CharField()
+    md5 = CharField(null=True)
+    modified_time = CharField(null=True)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+        indexes = (
+            (('root', 'drive_id'), True),
+        )
+
+
+class DriveFile(Model):
+    """
+    Manifest of a synced local file: its stat and md5 when last hashed,
+    and the Drive copy it was last synced with
+    """
+    path = CharField(unique=True)
+    size = IntegerField(null=True)
+    mtime = FloatField(null=True)
+    md5 = CharField(null=True)
+    drive_id = CharField(null=True)
+    drive_md5 = CharField(null=True)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+
+
+class SyncJob(Model):
+    """
+    Pending Drive sync of a note, at most one per note and operation
+    """
+    note = ForeignKeyField(Note, backref='sync_jobs', on_delete='CASCADE')
+    operation = CharField()
+    due = DateTimeField(default=datetime.datetime.now)
+    attempts = IntegerField(default=0)
+    error = TextField(null=True)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+        indexes = (
+            (('note', 'operation'), True),
+            (('due',), False),
+        )
+
+
+class UploadSession(Model):
+    """
+    Drive resumable upload session of a large file, kept until the upload
+    completes so an interrupted one carries on from the last byte Drive got
+    """
+    key = CharField(unique=True)
+    target = CharField()
+    fingerprint = CharField()
+    uri = TextField()
+    created = DateTimeField(default=datetime.datetime.now)
+
+    class Meta: # pylint: disable=too-few-public-methods
+        database = proxy
+
+
+MODELS = [Vault, Note, Versions, Tag, NoteTag, SearchTerm, DriveRoot, DriveItem, DriveFile, SyncJob,
+          UploadSession]
@@ -6,30 +6,45 @@ import traceback
 from collections import OrderedDict
 import readline
 import getpass
-import glob
-from pathlib import Path
-import hashlib
 import difflib
 from peewee import *  # pylint: disable=redefined-builtin,wildcard-import
 from clint.textui import puts, colored
 import models as m
-from utils import clear_screen, get_paginated_entries
+import migrations
+import storage
+import sync_worker
+from utils import clear_screen, KeysetPager, ListPager
 import crypto as Crypto
-import upload_to_drive
-import download_from_drive
-
-PATH = os.getenv('HOME', os.path.expanduser('~')) + '/.notes'
-DB = SqliteDatabase(PATH + '/diary.db')
+import search_index
+import line_diff
+import session_index
+import text_cache
+import vault
+import version_store
+
+PATH = storage.PATH
+DB = storage.make_database(PATH)
 m.proxy.initialize(DB)
 FINISH_KEY = "ctrl+Z" if os.name == 'nt' else "ctrl+D"
 crypto = Crypto.Crypto()                          #pylint disable=invalid-name
 profile = None                                    #pylint disable=invalid-name
+# Note keys unlocked by a password outside the session profile, by wrapped data key
+loose_keys = {}                                   #pylint disable=invalid-name
 
 
 def reset_profile():
     """Reset the password"""
     global profile           #pylint disable=global-statement, invalid-name
+    if profile:
+        if profile.get('index'):
+            profile['index'].discard()
+        profile['keyring'].zero()
     profile = None
+    for key in loose_keys.values():
+        key.zero()
+    loose_keys.clear()
+    text_cache.cache.clear()
+    sync_worker.worker.forget_keys()
 
 
 def set_profile():
@@ -38,12 +53,72 @@ def set_profile():
         password = getpass.getpass("Password for this session: ")
         if not password:
             print("Please input a valid password")
-        else:
+            continue
+        keyring = vault.unlock(password, create_missing=False)
+        if keyring is not None:
+            break
+        confirm = getpass.getpass("No notes use this password, enter it again to start using it: ")
+        if confirm == password:
+            keyring = vault.unlock(password)
             break
+        print("Passwords do not match")
     global profile        #pylint disable=global-statement, invalid-name
+    reset_profile()
     profile = {
-        'password': password
+        'keyring': keyring
     }
+    if search_index.MODE == search_index.MEMORY:
+        profile['index'] = session_index.SessionIndex(profile['keyring'])
+        profile['index'].start()
+
+
+def current_index():
+    """The session's in-memory search index, None unless that mode is on"""
+    return profile.get('index') if profile else None
+
+
+def note_key(entry, password=None):
+    """
+    Key of a note, from the session's vault or from the vault password unlocks
+    :return: SessionKey, None if the note is not in that vault
+    """
+    if password is None:
+        keyring = profile['keyring'] if profile else None
+    else:
+        keyring = vault.unlock(password, create_missing=False)
+    if keyring is None:
+        return None
+    # Unlocking moves the password's older notes into its vault
+    entry = m.Note.get_by_id(entry.id)
+    key = keyring.note_key(entry) if keyring.owns(entry) else None
+    if password is not None:
+        # The note's key outlives this keyring, it is used to view and sync the note
+        keyring.master.zero()
+        if key is not None:
+            key = keep_key(entry.data_key, key)
+    return key
+
+
+def keep_key(data_key, key):
+    """
+    Keep a note key unlocked outside the session profile until reset_profile zeroes it
+    :param data_key: the note's wrapped data key
+    :return: the key kept for the note already, or key
+    """
+    known = loose_keys.get(data_key)
+    if known is None:
+        loose_keys[data_key] = key
+        return key
+    key.zero()
+    return known
+
+
+def index_text(note, text, key):
+    """Bring the search index up to date with the new text of a note"""
+    if search_index.MODE == search_index.BLIND:
+        search_index.update_note(note, text, key)
+    elif current_index():
+        current_index().update(note, text)
 
 
 def init():
@@ -55,15 +130,83 @@ def init():
         os.makedirs(PATH)
     try:
         DB.connect()
-        DB.create_tables([m.Note, m.Versions], safe=True)
+        migrations.migrate(DB)
     except DatabaseError as err:
         traceback.print_tb(err.__traceback__)
         exit(0)
 
 
-def add_entry(data, title, password, tags=None, sync=False):
-    m.Note.create(content=data, tags=tags, title=title, password=password, sync=sync)
-    m.Versions.create(content=data, title='1_' + title)
+def add_entry(data, title, password, tags=None, sync=False, terms=None,
+              vault=None, data_key=None):  # pylint: disable=redefined-outer-name
+    """
+    Save a new note
+    :param data: encrypted content
+    :param password: stored password hash of older notes, None in a vault
+    :param terms: blinded search terms of the content, see search_index.note_terms
+    :param vault: Vault the note is in
+    :param data_key: the note's key, wrapped by the vault's master key
+    :return: the note
+    """
+    with storage.transaction():
+        note = m.Note.create(content=data, tags=tags, title=title, password=password, sync=sync,
+                             vault=vault, data_key=data_key)
+        set_tags(note, tags)
+        if terms:
+            search_index.index_note(note, terms)
+        m.Versions.create(note=note, version_no=1, content=data, title='1_' + title)
+    return note
+
+
+def set_tags(note, tags):
+    """Replace the tags linked to a note"""
+    names = migrations.split_tags(tags)
+    m.NoteTag.delete().where(m.NoteTag.note == note).execute()
+    if not names:
+        return
+    m.Tag.insert_many([{'name': name} for name in names]).on_conflict_ignore().execute()
+    tag_ids = m.Tag.select(m.Tag.id).where(m.Tag.name.in_(names)).tuples()
+    m.NoteTag.insert_many([{'note': note, 'tag': tag_id} for tag_id, in tag_ids]).execute()
+
+
+def tag_condition(term):
+    """Indexed condition on Tag.name, a trailing '*' makes it a prefix match"""
+    if term.endswith('*'):
+        prefix = term[:-1]
+        return (m.Tag.name >= prefix) & (m.Tag.name < prefix + '\U0010ffff')
+    return m.Tag.name == term
+
+
+def notes_with_tags(terms, match_all=True, query=None):
+    """
+    Filter notes by tag through the Tag/NoteTag indexes
+    :param terms: tag names, each optionally ending in '*' for a prefix match
+    :param match_all: True to require every term (AND), False for any term (OR)
+    :param query: Note query to filter, all columns of all notes by default
+    :return: Note query
+    """
+    query = m.Note.select() if query is None else query
+    if not terms:
+        return query
+    conditions = [tag_condition(term) for term in terms]
+    if not match_all:
+        combined = conditions[0]
+        for condition in conditions[1:]:
+            combined |= condition
+        conditions = [combined]
+    for condition in conditions:
+        note_ids = m.NoteTag.select(m.NoteTag.note).join(m.Tag).where(condition)
+        query = query.where(m.Note.id.in_(note_ids))
+    return query
+
+
+def parse_tag_query(query):
+    """
+    Parse a tag search: "a,b" needs both tags, "a|b" either, "a*" is a prefix
+    :return: (terms, match_all)
+    """
+    match_all = '|' not in query
+    terms = [term.strip() for term in query.replace('|', ',').split(',')]
+    return [term for term in terms if term], match_all
 
 
 def get_input():
@@ -71,51 +214,29 @@ def get_input():
     return title
 
 
-def upload_drive(title, data):
-    try:
-        print("Syncing with Google Drive....\n")
-        dir1 = os.getcwd()
-        f = open(os.path.join(os.path.join(dir1, "sync"), title+".txt"), "w+")  # pylint: disable=invalid-name
-        f.write(data)
-        f.close()
-        upload_to_drive.main()
-        os.remove(os.path.join(os.path.join(dir1, "sync"), title+".txt"))
-        puts(colored.green("Sync successful\n"))
-        return True
-    except:
-        puts(colored.red("Oops!", sys.exc_info()[0], "occured.\n"))
-        puts(colored.red("Sync Unsuccessful"))
-        return False
+# Drive sync runs on sync_worker's background thread, the UI only queues it
+def upload_drive(entry, password):
+    """Queue the note for upload to Google Drive"""
+    sync_worker.worker.enqueue(entry, sync_worker.PUSH, password)
+    return True
 
 
 #For Download Sync
-def download_drive(entry, title, data, password):
-    try:
-        download_from_drive.main()
-        dir1 = os.getcwd()
-        folder = os.path.join(dir1, "sync")
-        path = os.path.join(folder, title+".txt")
-        myfile = Path(path)
-        if myfile.is_file():
-            h_1 = hashlib.md5(open(myfile, 'rb').read()).hexdigest()
-            data = data.encode('utf-8')
-            h_2 = hashlib.md5(data).hexdigest()
-            text_to_print = "\nThe data of the note doesn't match with the sync on Google Drive"
-            text_to_print += " do you want to update local copy? (y/n) : "
-            if h_1 != h_2:
-                print(text_to_print)
-                if input(text_to_print).lower() != 'n':
-                    with open(myfile, 'r') as ufile:
-                        data_new = ufile.read()
-                    entry.content = crypto.encrypt(data_new, password)
-                    entry.save()
-        files = glob.glob(folder+"/*")
-        for f in files:  # pylint: disable=invalid-name
-            os.remove(f)
-        return True
-    except:
-        puts(colored.red("Oops!", sys.exc_info()[0], "occured.\n"))
-        return False
+def download_drive(entry, data, password):
+    """
+    Offer the Drive copy of the note if an earlier check found it differs,
+    then queue a new check. Taking it saves it as a new version of the note.
+    :return: the note's text, updated if the Drive copy was taken
+    """
+    data_new = sync_worker.worker.take_conflict(entry.id)
+    if data_new is not None and data_new != data:
+        text_to_print = "\nThe data of the note doesn't match with the sync on Google Drive"
+        text_to_print += " do you want to replace the local copy with it? (y/N) : "
+        if input(text_to_print).lower() == 'y':
+            edit_entry(entry, entry.title, data_new, password)
+            data = data_new
+    sync_worker.worker.enqueue(entry, sync_worker.PULL, password)
+    return data
 
 
 def process_tags(tag):
@@ -150,19 +271,29 @@ def add_entry_ui():
                             print("Please input a valid password")
                         else:
                             break
+                    keyring = vault.unlock(password)
                 else:
-                    password = profile['password']
-                password_to_store = crypto.key_to_store(password)
+                    keyring = profile['keyring']
+                data_key, password = keyring.new_note_key()
+                if not profile:
+                    keyring.master.zero()
+                    keep_key(data_key, password)
                 encryped_data = crypto.encrypt(data, password)
+                terms = search_index.note_terms(data, password) \
+                    if search_index.MODE == search_index.BLIND else None
                 text_to_print = "\nDo you want this file to be also synced"
                 text_to_print += " with Google Drive? (y/n) : "
                 if input(text_to_print).lower() != 'n':
-                    add_entry(encryped_data, title, password_to_store, tags, True)
+                    note = add_entry(encryped_data, title, None, tags, True, terms,
+                                     keyring.vault, data_key)
                     puts(colored.green("Saved successfully"))
-                    upload_drive(title, data)
+                    upload_drive(note, password)
                 else:
-                    add_entry(encryped_data, title, password_to_store, tags, False)
+                    note = add_entry(encryped_data, title, None, tags, False, terms,
+                                     keyring.vault, data_key)
                     puts(colored.green("Saved successfully"))
+                if current_index():
+                    current_index().update(note, data)
                 print("Press Enter to return to main menu")
                 input()
 
@@ -183,12 +314,41 @@ def search_entries():
     while 1:
         clear_screen()
         puts(colored.blue("What do you want to search for?"))
+        puts(colored.cyan("c) Content"))
         puts(colored.cyan("t) Tags"))
         puts(colored.cyan("q) Return to the main menu"))
         print("Action [c/t/q] : ", end="")
         query_selector = input("").lower()
-        if query_selector == "t":
-            view_entries(input("Enter a search Query: "), search_content=False)
+        if query_selector == "c":
+            keyring = profile['keyring'] if profile else vault.unlock(
+                getpass.getpass("Password of the notes to search: "), create_missing=False)
+            if keyring is None:
+                puts(colored.red("No notes are protected by this password."
+                                 " Press enter to return to the main menu!"))
+                input('')
+                return_value = 1
+                break
+            if search_index.MODE == search_index.MEMORY:
+                index = current_index()
+                if index is None:
+                    index = session_index.SessionIndex(keyring)
+                    index.build()
+                elif not index.ready.is_set():
+                    print("Indexing your notes...")
+                    index.ready.wait()
+                query = input('Enter words to search for ("a phrase", *any text*): ')
+                view_entries(query, ranked=index.query(query))
+            else:
+                search_index.backfill(keyring)
+                view_entries(input("Enter words to search for: "), search_content=True,
+                             key=keyring.master)
+            if not profile:
+                keyring.zero()
+            return_value = 1
+            break
+        elif query_selector == "t":
+            view_entries(input("Enter a search Query (a,b = all of, a|b = any of, a* = prefix): "),
+                         search_content=False)
             return_value = 1
             break
         elif query_selector == "q":
@@ -215,6 +375,10 @@ def menu_loop():
         \_| \_/\___/ \__\___||___/
         """
         puts(colored.green(banner))
+        failing = sync_worker.worker.failing()
+        if failing:
+            puts(colored.red("{} note(s) waiting to sync with Google Drive, last error: {}".format(
+                len(failing), failing[-1].error)))
         puts(colored.blue("Enter 'q' to quit"))
         for key, value in MENU.items():
             puts(colored.cyan('{}) {}'.format(key, value.__doc__)))
@@ -227,33 +391,31 @@ def menu_loop():
 
 
 def delete_entry(entry):
-    versions = list(m.Versions.select().where(m.Versions.title.contains(entry.title)))
-    for version in versions:
-        version.delete_instance()
-    return entry.delete_instance()
+    with storage.transaction():
+        m.NoteTag.delete().where(m.NoteTag.note == entry).execute()
+        m.Versions.delete().where(m.Versions.note == entry).execute()
+        m.SyncJob.delete().where(m.SyncJob.note == entry).execute()
+        m.SearchTerm.delete().where(m.SearchTerm.note == entry).execute()
+        if current_index():
+            current_index().remove(entry.id)
+        text_cache.cache.invalidate(entry.id)
+        return entry.delete_instance()
 
 
 def edit_entry(entry, title, data, password):
     previous_title = entry.title
-    entry.title = title
-    entry.content = crypto.encrypt(data, password)
-    entry.save()
+    with storage.transaction():
+        entry.title = title
+        entry.content = crypto.encrypt(data, password)
+        entry.save()
+        if previous_title != title:
+            m.Versions.update(title=m.Versions.version_no.cast('TEXT').concat('_' + title)) \
+                .where(m.Versions.note == entry).execute()
+        version_store.add_version(entry, data, password, title)
+        index_text(entry, data, password)
+    text_cache.cache.invalidate(entry.id)
     if entry.sync:
-        upload_drive(title, data)
-    versions = list(m.Versions.select().where(m.Versions.title.contains(previous_title)) \
-                    .order_by(m.Versions.timestamp.desc()))
-    if previous_title != title:
-        for version in versions:
-            prev_version_title_number = version.title.split('_')[0]
-            version.title = prev_version_title_number + '_' + title
-            version.save()
-    if len(versions) == 10:
-        entry_to_delete = versions[-1]
-        entry_to_delete.delete_instance()
-        versions.pop()
-    previous_version_number = int(versions[0].title.split('_')[0])
-    title_to_save = str(previous_version_number + 1) + '_' + title
-    m.Versions.create(content=crypto.encrypt(data, password), title=title_to_save)
+        upload_drive(entry, password)
     return True
 
 
@@ -290,20 +452,8 @@ def view_previous_versions(entry, password):
     while True:
         clear_screen()
         if flag:
-            versions = m.Versions.select().where(m.Versions.title.contains(entry.title)) \
-                            .order_by(m.Versions.timestamp.desc())
-            versions = list(versions)
-            to_remove = []
-            for version in versions:
-                title = version.title.split('_')
-                title.pop(0)
-                title = '_'.join(title)
-                if title != entry.title:
-                    to_remove.append(version)
-            print([version.title for version in versions])
-            print([to_remove_title.title for to_remove_title in to_remove])
-            for remove_item in to_remove:
-                versions.remove(remove_item)
+            versions = list(m.Versions.select(*m.VERSION_LISTING).where(m.Versions.note == entry)
+                            .order_by(m.Versions.version_no.desc()))
         flag = False
         for i, version_entry in enumerate(versions):
             timestamp = version_entry.timestamp.strftime("%A %B %d, %Y %I:%M%p")
@@ -320,7 +470,8 @@ def view_previous_versions(entry, password):
             second = input('Input Second Version: ')
             diff = diffcheck(first, second, password, len(versions) - 1, versions)
             if diff != '':
-                print('\n'.join(diff))
+                for line in diff:
+                    print(line)
             else:
                 print("Invalid Input. Print enter to return to view entries")
             input()
@@ -328,7 +479,7 @@ def view_previous_versions(entry, password):
             clear_screen()
             print(versions[int(next_action)].title)
             print("=" * len(versions[int(next_action)].title))
-            print(crypto.decrypt(versions[int(next_action)].content, password))
+            print(version_store.version_text(versions[int(next_action)], password))
             print('\nPress enter to return to view entries')
             input()
         else:
@@ -338,10 +489,15 @@ def view_previous_versions(entry, password):
 def diffcheck(first, second, password, i, versions):
     if first.isdigit() and second.isdigit() \
             and 0 <= int(first) <= i and 0 <= int(second) <= i and int(first) != int(second):  # pylint: disable=undefined-loop-variable,line-too-long,no-else-return
-        content_1 = crypto.decrypt(versions[int(first)].content, password)
-        content_2 = crypto.decrypt(versions[int(second)].content, password)
+        content_1 = version_store.version_text(versions[int(first)], password)
+        content_2 = version_store.version_text(versions[int(second)], password)
         content_1_lines = content_1.splitlines()
         content_2_lines = content_2.splitlines()
+        if len(content_1_lines) + len(content_2_lines) > line_diff.DIFFER_MAX_LINES:
+            # Differ is quadratic on large notes, the line diff yields hunk by hunk
+            return line_diff.unified(content_1_lines, content_2_lines,
+                                     fromfile=versions[int(first)].title,
+                                     tofile=versions[int(second)].title)
         my_d = difflib.Differ()
         diff = my_d.compare(content_1_lines, content_2_lines)
         return list(diff)
@@ -351,13 +507,9 @@ def diffcheck(first, second, password, i, versions):
 
 def view_entry(entry, password):  # pylint: disable=inconsistent-return-statements
     title = entry.title
-    data = crypto.decrypt(entry.content, password)
+    data = text_cache.note_text(entry, password)
     if entry.sync:
-        clear_screen()
-        print("Checking for updates on note with Google Drive......")
-        download_drive(entry, title, data, password)
-        # entry = m.Note.get(m.Note.title == title)
-        # data = decrypt(entry.content, password)
+        data = download_drive(entry, data, password)
 
     clear_screen()
     puts(colored.yellow(title))
@@ -380,11 +532,10 @@ def view_entry(entry, password):  # pylint: disable=inconsistent-return-statemen
         return False
 
 
-def view_entries(search_query=None, search_content=None):
+def view_entries(search_query=None, search_content=None, key=None, ranked=None):
     """View all the notes"""
     global profile        # pylint: disable=global statement, invalid-name
     page_size = 2
-    index = 0
     reset_flag = True
 
     while 1:
@@ -392,22 +543,25 @@ def view_entries(search_query=None, search_content=None):
         if reset_flag:
             # Get entries if reset_flag is True
             # Will be True initially and on delete/edit entry
-            entries = m.Note.select().order_by(m.Note.timestamp.desc())  # pylint: disable=assignment-from-no-return
-
-            if search_query and search_content:
-                entries = entries.where(m.Note.content.contains(search_query))
-            elif search_query and not search_content:
-                entries = entries.where(m.Note.tags.contains(search_query))
+            entries = m.Note.select(*m.NOTE_LISTING)  # pylint: disable=assignment-from-no-return
 
-            entries = list(entries)
-            if not entries:
+            if ranked is not None:
+                # Results of the session index, listed best match first
+                pager = ListPager(entries, m.Note.id, ranked, page_size)
+            else:
+                if search_query and search_content:
+                    entries = entries.where(m.Note.id.in_(
+                        search_index.matching_notes(search_query, key)))
+                elif search_query and not search_content:
+                    entries = notes_with_tags(*parse_tag_query(search_query), query=entries)
+                pager = KeysetPager(entries, m.Note.timestamp, m.Note.id, page_size)
+            if not pager.first():
                 puts(colored.red("Your search had no results. Press enter to return to the main menu!")) #pylint disable=line-too-long
-                input()
+                input('')
                 clear_screen()
                 return
-            index = 0
             reset_flag = False
-        paginated_entries = get_paginated_entries(entries, index, page_size)
+        paginated_entries = pager.page
         for i, entry in enumerate(paginated_entries):
             timestamp = entry.timestamp.strftime("%A %B %d, %Y %I:%M%p")
             head = "\"{title}\" on \"{timestamp}\" Tags: {tags}".format(
@@ -421,34 +575,45 @@ def view_entries(search_query=None, search_content=None):
         if next_action == 'q':
             break
         elif next_action == 'n':
-            if index + page_size < len(entries):
-                index += page_size
+            pager.next()
         elif next_action == 'p':
-            if index - page_size >= 0:
-                index -= page_size
+            pager.previous()
         elif next_action.isdigit() and 0 <= int(next_action) < len(paginated_entries):
+            entry = paginated_entries[int(next_action)]
             while 1:
-                if not profile:
-                    password = getpass.getpass('Password To Retrieve Content: ')
-                elif crypto.key_to_store(profile['password']) != entry.password:       # pylint: disable=undefined-loop-variable
-                    password = getpass.getpass('Password To Retrieve Content: ')
-                else:
-                    password = profile['password']
-                entry = paginated_entries[int(next_action)]
-                if crypto.key_to_store(password) != entry.password:
+                password = note_key(entry)
+                if password is None:
+                    password = note_key(entry, getpass.getpass('Password To Retrieve Content: '))
+                if password is None:
                     if input("Password is incorrect. Do you want to retry? (y/n): ").lower() != 'y':
                         break
                 else:
-                    reset_flag = view_entry(paginated_entries[int(next_action)], password)
+                    reset_flag = view_entry(m.Note.get_by_id(entry.id), password)
                     break
 
 
+def change_password():
+    """Change a password"""
+    old_password = getpass.getpass("Current password: ")
+    new_password = getpass.getpass("New password: ")
+    if not new_password or new_password != getpass.getpass("Repeat the new password: "):
+        puts(colored.red("The new passwords don't match. Press Enter to return to main menu"))
+    else:
+        try:
+            vault.change_password(old_password, new_password)
+            puts(colored.green("Password changed. Press Enter to return to main menu"))
+        except ValueError as err:
+            puts(colored.red("{}. Press Enter to return to main menu".format(err)))
+    input()
+
+
 MENU = OrderedDict([
     ('a', add_entry_ui),
     ('v', view_entries),
     ('s', search_entries),
     ('p', set_profile),
     ('r', reset_profile),
+    ('c', change_password),
 ])
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+"""Blind keyword index for searching encrypted note contents.
+
+A note's text is split into words, normalized (NFKC, case folded), and
+each word is stored as a keyed hash derived from the master key of the
+note's vault (SessionKey.blind, which a note's data key shares), so the
+database never holds a plaintext word. A search hashes its words with the
+searcher's key, so only notes of that vault can match. Notes saved before
+the index existed are indexed the first time their vault is searched.
+"""
+import os
+import re
+import unicodedata
+
+from peewee import chunked, fn
+
+import models as m
+import storage
+import crypto as Crypto
+
+BLIND = 'blind'
+MEMORY = 'memory'
+# blind keeps this index in the database, memory only the in-memory
+# session_index of an unlocked session, for when nothing may be written
+MODE = os.getenv('NOTES_SEARCH_INDEX', BLIND)
+WORD = re.compile(r'\w+')
+crypto = Crypto.Crypto()  # pylint: disable=invalid-name
+
+
+def normalize(text):
+    """text as it is indexed and searched"""
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def words(text):
+    """Distinct normalized words of text"""
+    return set(WORD.findall(normalize(text)))
+
+
+def note_terms(text, key):
+    """Blinded search terms of a note's text"""
+    key = crypto.session_key(key)
+    return {key.blind(word) for word in words(text)}
+
+
+def index_note(note, terms):
+    """Make terms the search terms of note, writing only what changed"""
+    terms = set(terms)
+    existing = {term for term, in m.SearchTerm.select(m.SearchTerm.term)
+                .where(m.SearchTerm.note == note).tuples()}
+    for batch in chunked(existing - terms, 100):
+        m.SearchTerm.delete().where((m.SearchTerm.note == note) &
+                                    (m.SearchTerm.term.in_(batch))).execute()
+    note_id = getattr(note, 'id', note)
+    # A note holds hundreds of words, the statement is prepared once for all of them
+    storage.insert_rows([m.SearchTerm.term, m.SearchTerm.note],
+                        [(term, note_id) for term in terms - existing])
+
+
+def update_note(note, text, key):
+    """Index the new text of note"""
+    index_note(note, note_terms(text, key))
+
+
+def backfill(keyring, workers=None):
+    """
+    Index the notes of an unlocked vault that have no search terms yet
+    :param keyring: vault.Keyring
+    :return: number of notes indexed
+    """
+    indexed = m.SearchTerm.select(m.SearchTerm.note)
+    pending = keyring.notes(m.Note.id, m.Note.content, m.Note.vault, m.Note.data_key) \
+        .where(m.Note.id.not_in(indexed))
+    count = 0
+    with storage.transaction():
+        for result in keyring.decrypt_many(pending, workers):
+            if result.error is None:
+                index_note(result.item, note_terms(result.value, keyring.master))
+                count += 1
+    return count
+
+
+def matching_notes(query, key):
+    """
+    Notes holding every word of query, as a subquery of Note ids
+    :param key: master key of the notes' vault, or the key of older notes
+    """
+    terms = list(note_terms(query, key))
+    return m.SearchTerm.select(m.SearchTerm.note) \
+        .where(m.SearchTerm.term.in_(terms)) \
+        .group_by(m.SearchTerm.note) \
+        .having(fn.COUNT(m.SearchTerm.term) == len(terms))
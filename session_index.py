@@ -0,0 +1,155 @@
+"""In-memory search index of the notes of an unlocked session.
+
+Opt-in with NOTES_SEARCH_INDEX=memory, for when no search index may be
+written to disk, not even the blind one of search_index. Once set_profile
+unlocks the vault, a background thread decrypts its notes, in
+decrypt_many batches, and indexes their words (for ranked and phrase
+queries) and character trigrams (for substring queries).
+Edits and deletes keep it up to date and reset_profile discards it.
+"""
+import math
+import threading
+from collections import Counter, defaultdict
+
+import models as m
+import search_index
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def parse_query(query):
+    """
+    Split a query into its bare words and its "quoted phrases"
+    :return: (words, phrases), each phrase a list of words
+    """
+    parts = query.split('"')
+    phrases = [search_index.WORD.findall(search_index.normalize(part)) for part in parts[1::2]]
+    words = search_index.WORD.findall(search_index.normalize(' '.join(parts[::2])))
+    return words, [phrase for phrase in phrases if phrase]
+
+
+class SessionIndex:  # pylint: disable=too-many-instance-attributes
+    """
+    Word and trigram index of the notes of one vault
+    :param keyring: vault.Keyring of the session
+    """
+
+    def __init__(self, keyring):
+        self.keyring = keyring
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.texts = {}                     # note id: normalized text
+        self.postings = defaultdict(dict)   # word: {note id: occurrences}
+        self.grams = defaultdict(set)       # trigram: note ids
+        self.touched = set()                # notes indexed or removed since the build began
+        self.discarded = False
+        self.thread = None
+
+    def start(self):
+        """Build the index on a daemon thread"""
+        self.thread = threading.Thread(target=self.build, name='notes-index', daemon=True)
+        self.thread.start()
+
+    def build(self, workers=None):
+        """Decrypt and index every note of the vault"""
+        try:
+            notes = self.keyring.notes(m.Note.id, m.Note.content, m.Note.vault, m.Note.data_key)
+            for result in self.keyring.decrypt_many(notes, workers):
+                with self.lock:
+                    if self.discarded:
+                        return
+                    # A note edited meanwhile was indexed from its newer text
+                    if result.error is None and result.item.id not in self.touched:
+                        self._add(result.item.id, result.value)
+        finally:
+            self.ready.set()
+
+    def update(self, note, text):
+        """Index the new text of a note, or drop it if it is not in the vault"""
+        with self.lock:
+            if self.discarded:
+                return
+            self.touched.add(note.id)
+            self._remove(note.id)
+            if self.keyring.owns(note):
+                self._add(note.id, text)
+
+    def remove(self, note_id):
+        with self.lock:
+            self.touched.add(note_id)
+            self._remove(note_id)
+
+    def discard(self):
+        """Drop everything indexed, a build still running stops"""
+        with self.lock:
+            self.discarded = True
+            self.texts.clear()
+            self.postings.clear()
+            self.grams.clear()
+            self.touched.clear()
+
+    def _add(self, note_id, text):
+        text = search_index.normalize(text)
+        self.texts[note_id] = text
+        for word, count in Counter(search_index.WORD.findall(text)).items():
+            self.postings[word][note_id] = count
+        for gram in trigrams(text):
+            self.grams[gram].add(note_id)
+
+    def _remove(self, note_id):
+        text = self.texts.pop(note_id, None)
+        if text is None:
+            return
+        for word in set(search_index.WORD.findall(text)):
+            notes = self.postings[word]
+            notes.pop(note_id, None)
+            if not notes:
+                del self.postings[word]
+        for gram in trigrams(text):
+            notes = self.grams[gram]
+            notes.discard(note_id)
+            if not notes:
+                del self.grams[gram]
+
+    def query(self, query):
+        """
+        Note ids matching a query, best first: *text* finds text anywhere,
+        otherwise notes need every word and "quoted phrase"
+        """
+        query = query.strip()
+        if len(query) > 2 and query.startswith('*') and query.endswith('*'):
+            return self.substring(query[1:-1])
+        return self.search(query)
+
+    def substring(self, text):
+        """Note ids containing text, most occurrences first"""
+        text = search_index.normalize(text)
+        if not text:
+            return []
+        with self.lock:
+            needed = sorted((self.grams.get(gram, set()) for gram in trigrams(text)), key=len)
+            candidates = set.intersection(*needed) if needed else set(self.texts)
+            counts = {note_id: self.texts[note_id].count(text) for note_id in candidates}
+        return sorted((note_id for note_id, count in counts.items() if count),
+                      key=lambda note_id: (-counts[note_id], -note_id))
+
+    def search(self, query):
+        """Note ids holding every word and phrase of query, ranked by tf-idf"""
+        words, phrases = parse_query(query)
+        needed = set(words).union(*phrases)
+        if not needed:
+            return []
+        with self.lock:
+            postings = [self.postings.get(word, {}) for word in needed]
+            candidates = set.intersection(*(set(notes) for notes in postings))
+            for phrase in phrases:
+                phrase = ' {} '.format(' '.join(phrase))
+                candidates = {note_id for note_id in candidates if phrase in ' {} '.format(
+                    ' '.join(search_index.WORD.findall(self.texts[note_id])))}
+            total = len(self.texts)
+            scores = {note_id: sum(notes[note_id] * math.log(1 + total / len(notes))
+                                   for notes in postings)
+                      for note_id in candidates}
+        return sorted(scores, key=lambda note_id: (-scores[note_id], -note_id))
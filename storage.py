@@ -0,0 +1,81 @@
+"""SQLite storage engine configuration for the notes database.
+
+Pragmas default to WAL journaling with a larger page cache and memory
+mapped reads. Each can be overridden in the [sqlite] section of
+~/.notes/storage.ini, or with a NOTES_SQLITE_<PRAGMA> environment
+variable, which wins over the file. Both can set any pragma, not only
+the defaults.
+"""
+import configparser
+import os
+from collections import OrderedDict
+
+from peewee import SqliteDatabase
+
+import migrations
+import models as m
+
+PATH = os.getenv('HOME', os.path.expanduser('~')) + '/.notes'
+DB_FILE = 'diary.db'
+CONFIG_FILE = 'storage.ini'
+ENV_PREFIX = 'NOTES_SQLITE_'
+
+DEFAULT_PRAGMAS = OrderedDict([
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),   # durable at checkpoints, safe with WAL
+    ('cache_size', -16 * 1024),  # negative means KiB, so 16 MiB
+    ('mmap_size', 256 * 1024 * 1024),
+    ('busy_timeout', 5000),
+])
+
+
+def load_pragmas(path=PATH, environ=None):
+    """Default pragmas, overridden by the config file then the environment"""
+    environ = os.environ if environ is None else environ
+    pragmas = OrderedDict(DEFAULT_PRAGMAS)
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(path, CONFIG_FILE))
+    if parser.has_section('sqlite'):
+        pragmas.update(parser.items('sqlite'))
+    for variable in sorted(environ):
+        if variable.startswith(ENV_PREFIX) and len(variable) > len(ENV_PREFIX):
+            pragmas[variable[len(ENV_PREFIX):].lower()] = environ[variable]
+    return pragmas
+
+
+def make_database(path=PATH, pragmas=None):
+    """Notes database under path, configured with load_pragmas by default"""
+    if pragmas is None:
+        pragmas = load_pragmas(path)
+    return SqliteDatabase(os.path.join(path, DB_FILE), pragmas=list(pragmas.items()))
+
+
+def connect(path=PATH):
+    """Database the models are bound to, opening and migrating it if unbound.
+
+    The notes app binds its own database at import, the Drive sync scripts
+    run standalone and use this to reach their saved sync state.
+    """
+    if m.proxy.obj is None:
+        os.makedirs(path, exist_ok=True)
+        m.proxy.initialize(make_database(path))
+        migrations.migrate(m.proxy.obj)
+    return m.proxy.obj
+
+
+def insert_rows(fields, rows):
+    """
+    Insert rows of plain tuples with one prepared statement, for bulk writes
+    where building the SQL of each row in peewee would cost more than the insert
+    :param fields: the model fields the tuples hold, of a single model
+    """
+    model = fields[0].model
+    sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+        model._meta.table_name, ', '.join('"{}"'.format(field.column_name) for field in fields),
+        ', '.join('?' * len(fields)))
+    m.proxy.obj.cursor().executemany(sql, rows)
+
+
+def transaction():
+    """Group writes so they commit once; nested calls become savepoints"""
+    return m.proxy.atomic()
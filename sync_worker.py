@@ -0,0 +1,194 @@
+"""Background Google Drive sync of notes.
+
+The UI only records what needs syncing: a push (upload the note) or a
+pull (check its Drive copy) is a SyncJob row, one per note and operation,
+so several edits of a note in a row coalesce into a single upload. A
+pull waits for a pending push of the same note, the Drive copy it would
+find is older than the local note. A daemon thread runs due jobs and
+retries failed ones with exponential backoff; jobs outlive the process
+and are picked up again next run.
+
+Note content is encrypted, so a job needs the note's key. Keys are only
+kept in memory, a job whose key is unknown waits until the note is
+opened or edited again.
+"""
+import datetime
+import threading
+
+from peewee import fn
+
+import models as m
+import crypto as Crypto
+
+PUSH = 'push'
+PULL = 'pull'
+# Pushes wait this long for further edits of the same note
+DEBOUNCE = datetime.timedelta(seconds=2)
+RETRY_BASE = 5        # seconds, doubled after every failed attempt
+RETRY_MAX = 15 * 60
+crypto = Crypto.Crypto()  # pylint: disable=invalid-name
+
+
+def backoff(attempts):
+    """Delay before retrying a job that failed attempts times"""
+    return datetime.timedelta(seconds=min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX))
+
+
+def build_service():
+    """Drive service, imported here so the Drive modules load on first sync"""
+    import upload_to_drive  # pylint: disable=import-outside-toplevel
+    return upload_to_drive.build_service()
+
+
+def drop_service():
+    """Forget the service build_service returned, its connection may be broken"""
+    import upload_to_drive  # pylint: disable=import-outside-toplevel
+    upload_to_drive.drop_service()
+
+
+class SyncWorker:  # pylint: disable=too-many-instance-attributes
+    """
+    Runs queued Drive sync jobs on a daemon thread
+    :param make_service: callable returning a Drive service instance
+    :param drop_service: callable making make_service build a new instance
+    :param autostart: start the thread on the first enqueue
+    """
+
+    def __init__(self, make_service=build_service, drop_service=drop_service,
+                 autostart=True):
+        self.make_service = make_service
+        self.drop_service = drop_service
+        self.autostart = autostart
+        self.service = None
+        self.keys = {}
+        self.conflicts = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def enqueue(self, note, operation, key, now=None):
+        """Queue a push or pull of note, replacing a pending one"""
+        now = now or datetime.datetime.now()
+        with self.lock:
+            self.keys[note.id] = crypto.session_key(key)
+            if operation == PUSH:
+                # A Drive copy found before this edit is older than the note
+                self.conflicts.pop(note.id, None)
+        due = now + DEBOUNCE if operation == PUSH else now
+        m.SyncJob.insert(note=note.id, operation=operation, due=due).on_conflict(
+            conflict_target=[m.SyncJob.note, m.SyncJob.operation],
+            update={m.SyncJob.due: due, m.SyncJob.attempts: 0, m.SyncJob.error: None}).execute()
+        if self.autostart:
+            self.start()
+        self.wake.set()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='notes-sync', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            self.wake.wait(self.process_due())
+
+    def forget_keys(self):
+        """Drop every key, jobs wait until their note is opened again"""
+        with self.lock:
+            self.keys.clear()
+            self.conflicts.clear()
+
+    def take_conflict(self, note_id):
+        """Drive copy of a note found to differ by a pull, or None"""
+        with self.lock:
+            return self.conflicts.pop(note_id, None)
+
+    def failing(self):
+        """Jobs whose last attempt failed"""
+        return list(m.SyncJob.select().where(m.SyncJob.error.is_null(False)))
+
+    def process_due(self, now=None):
+        """
+        Run every due job whose key is known
+        :return: seconds until the next such job is due, None if there is none
+        """
+        now = now or datetime.datetime.now()
+        with self.lock:
+            note_ids = list(self.keys)
+        jobs = m.SyncJob.select().where(m.SyncJob.due <= now, m.SyncJob.note.in_(note_ids)) \
+            .order_by(m.SyncJob.due, m.SyncJob.operation.desc())
+        for job in list(jobs):
+            self.run_job(job, now)
+        with self.lock:
+            note_ids = list(self.keys)
+        next_due = m.SyncJob.select(fn.MIN(m.SyncJob.due)) \
+            .where(m.SyncJob.note.in_(note_ids)).scalar()
+        if next_due is None:
+            return None
+        return max((next_due - datetime.datetime.now()).total_seconds(), 0)
+
+    def run_job(self, job, now):
+        """Run one job, rescheduling it with backoff if it fails"""
+        note = m.Note.get_or_none(m.Note.id == job.note_id)
+        if note is None or not note.sync:
+            job.delete_instance()
+            return
+        with self.lock:
+            key = self.keys.get(note.id)
+        if key is None:
+            return
+        try:
+            data = crypto.decrypt(note.content, key)
+        except ValueError:     # a zeroed key, or the note moved into a vault since
+            with self.lock:
+                self.keys.pop(note.id, None)
+            return
+        # Only touch the row if it was not queued again meanwhile
+        same_job = (m.SyncJob.id == job.id) & (m.SyncJob.due == job.due)
+        if job.operation == PULL:
+            push = m.SyncJob.get_or_none((m.SyncJob.note == note.id) &
+                                         (m.SyncJob.operation == PUSH))
+            if push is not None:
+                m.SyncJob.update(due=max(push.due, now)).where(same_job).execute()
+                return
+        try:
+            if self.service is None:
+                self.service = self.make_service()
+            if job.operation == PUSH:
+                self.push(note, data)
+            else:
+                self.pull(note, data)
+        except Exception as error:  # pylint: disable=broad-except
+            self.service = None
+            self.drop_service()
+            attempts = job.attempts + 1
+            m.SyncJob.update(attempts=attempts, due=now + backoff(attempts),
+                             error=str(error) or type(error).__name__).where(same_job).execute()
+            return
+        m.SyncJob.delete().where(same_job).execute()
+
+    def push(self, note, data):
+        import upload_to_drive  # pylint: disable=import-outside-toplevel
+        drive_file = upload_to_drive.upload_note(self.service, note.title, data, note.drive_id)
+        self.remember_drive_id(note, drive_file)
+        with self.lock:
+            self.conflicts.pop(note.id, None)
+
+    def pull(self, note, data):
+        import download_from_drive  # pylint: disable=import-outside-toplevel
+        drive_file, text = download_from_drive.fetch_note(self.service, note.title, data,
+                                                          note.drive_id)
+        self.remember_drive_id(note, drive_file)
+        if text is not None:
+            with self.lock:
+                self.conflicts[note.id] = text
+
+    @staticmethod
+    def remember_drive_id(note, drive_file):
+        """Store the note's Drive ID, clearing it if its Drive copy is gone"""
+        drive_id = drive_file['id'] if drive_file is not None else None
+        if drive_id != note.drive_id:
+            m.Note.update(drive_id=drive_id).where(m.Note.id == note.id).execute()
+
+
+worker = SyncWorker()  # pylint: disable=invalid-name
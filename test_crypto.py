@@ -1,7 +1,11 @@
 import base64
+import collections
+import io
+import os
 from Cryptodome.Cipher import AES
 from Cryptodome.Hash import SHA256
 import crypto as Crypto
+import version_store
 PADDING = "="
 
 
@@ -33,21 +37,55 @@ def test_key_hash():
 
 def test_encrypt():
     crypto = Crypto.Crypto()
-    input_string = [("hello", "key"), ("hello2", ""), ("", "key"), ("", "")]
-    flag = 1
-    for i in input_string:
-        text, key = i[0], i[1]
+    input_string = [("hello", "key"), ("hello2", ""), ("", "key"), ("", ""),
+                    ("ends with ==", "key"), ("multibyte é€", "key")]
+    for text, key in input_string:
         answer = crypto.encrypt(text, key)
-        while len(text) % 16 != 0:
-            text += PADDING
+        assert answer.startswith(Crypto.TEXT_PREFIX)
+        assert answer != crypto.encrypt(text, key)
+        assert crypto.decrypt(answer, key) == text
+
+
+def test_decrypt_legacy():
+    crypto = Crypto.Crypto()
+    for text, key in [("hello", "key"), ("hello2", ""), ("", "key")]:
+        padded = text
+        while len(padded) % 16 != 0:
+            padded += PADDING
         cipher = AES.new(crypto.key_hash(key), AES.MODE_ECB)
-        encrypted = cipher.encrypt(text.encode())
-        if answer == base64.b64encode(encrypted).decode():
-            flag = flag & 1
-        else:
-            flag = 0
+        encrypted = base64.b64encode(cipher.encrypt(padded.encode())).decode()
+        assert crypto.decrypt(encrypted, key) == text
 
-    assert flag == 1
+
+def test_stream_round_trip():
+    crypto = Crypto.Crypto()
+    for size in [0, 1, 15, 64, 65, 128, 1000]:
+        data = os.urandom(size)
+        encrypted = io.BytesIO()
+        crypto.encrypt_stream(io.BytesIO(data), encrypted, "key", chunk_size=64)
+        plain = io.BytesIO()
+        crypto.decrypt_stream(io.BytesIO(encrypted.getvalue()), plain, "key")
+        assert plain.getvalue() == data
+
+
+def test_stream_tampering():
+    crypto = Crypto.Crypto()
+    encrypted = io.BytesIO()
+    crypto.encrypt_stream(io.BytesIO(b"x" * 200), encrypted, "key", chunk_size=64)
+    data = encrypted.getvalue()
+    chunk = 64 + Crypto.TAG_SIZE
+    broken = [data[:-1], data[:Crypto.HEADER.size + chunk],
+              data[:Crypto.HEADER.size] + data[Crypto.HEADER.size + chunk:]]
+    flipped = bytearray(data)
+    flipped[-20] ^= 1
+    broken.append(bytes(flipped))
+    for item in broken + [data]:
+        key = "other" if item is data else "key"
+        try:
+            crypto.decrypt_stream(io.BytesIO(item), io.BytesIO(), key)
+            assert False
+        except ValueError:
+            pass
 
 
 def test_decrypt():
@@ -68,3 +106,99 @@ def test_decrypt():
         else:
             flag = 0
     assert flag == 1
+
+
+def test_session_key():
+    crypto = Crypto.Crypto()
+    key = Crypto.SessionKey.from_password("key")
+    assert key.stored_hash() == crypto.key_to_store("key")
+    for text in ["hello", "", "a" * 40]:
+        encrypted = crypto.encrypt(text, key)
+        assert crypto.decrypt(encrypted, "key") == text
+        assert crypto.decrypt(encrypted, key) == text
+
+
+def test_session_key_zero():
+    key = Crypto.SessionKey.from_password("key")
+    key.zero()
+    assert key.stored_hash() == "00" * 32
+    try:
+        Crypto.Crypto().encrypt("hello", key)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_session_key_blind():
+    key = Crypto.SessionKey.from_password("key")
+    assert key.blind("word") == Crypto.SessionKey.from_password("key").blind("word")
+    assert key.blind("word") != Crypto.SessionKey.from_password("other").blind("word")
+    assert "word" not in key.blind("word")
+    key.zero()
+    try:
+        key.blind("word")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_session_key_fingerprint():
+    key = Crypto.SessionKey.from_password("key")
+    assert key.fingerprint() == Crypto.SessionKey.from_password("key").fingerprint()
+    assert key.fingerprint() != Crypto.SessionKey.from_password("other").fingerprint()
+    assert key.fingerprint() not in key.stored_hash()
+    key.zero()
+    try:
+        key.fingerprint()
+        assert False
+    except ValueError:
+        pass
+
+
+def test_session_key_child():
+    crypto = Crypto.Crypto()
+    master = Crypto.SessionKey(os.urandom(32))
+    child = master.child(os.urandom(32))
+    assert child.blind("word") == master.blind("word")
+    assert child.stored_hash() != master.stored_hash()
+    encrypted = crypto.encrypt("hello", child)
+    assert crypto.decrypt(encrypted, child) == "hello"
+    try:
+        crypto.decrypt(encrypted, master)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_decrypt_many():
+    crypto = Crypto.Crypto()
+    key = Crypto.SessionKey.from_password("key")
+    texts = ["note " + str(i) for i in range(50)]
+    encrypted = [result.value for result in crypto.encrypt_many(texts, key, workers=3)]
+    encrypted[7] = crypto.encrypt("other key", "other")
+    encrypted[9] = "not base64!"
+    results = list(crypto.decrypt_many(encrypted, key, workers=3))
+    assert [result.index for result in results] == list(range(50))
+    for i, result in enumerate(results):
+        if i in (7, 9):
+            assert result.value is None and isinstance(result.error, ValueError)
+        else:
+            assert (result.value, result.error) == (texts[i], None)
+
+
+def test_decrypt_many_rows():
+    crypto = Crypto.Crypto()
+    Row = collections.namedtuple('Row', ['content'])
+    rows = [Row(crypto.encrypt("a", "key")), Row(crypto.encrypt("b", "key"))]
+    results = list(crypto.decrypt_many(iter(rows), "key"))
+    assert [(result.item, result.value) for result in results] == [(rows[0], "a"), (rows[1], "b")]
+
+
+def test_decrypt_many_delta_rows():
+    crypto = Crypto.Crypto()
+    Version = collections.namedtuple('Version', ['content', 'is_delta'])
+    delta = version_store.pack_delta(version_store.make_delta("new\n", "old\n"), "key")
+    rows = [Version(crypto.encrypt("new\n", "key"), False), Version(delta, True)]
+    results = list(crypto.decrypt_many(rows, "key"))
+    assert (results[0].value, results[0].error) == ("new\n", None)
+    assert results[1].value is None and isinstance(results[1].error, ValueError)
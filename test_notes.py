@@ -1,11 +1,33 @@
 # Demo file of tests
+import base64
+import datetime
+import difflib
+import json
 import os
+import random
+import threading
 import unittest
+import zlib
+import httplib2
 import mock
+from googleapiclient.errors import HttpError
 from peewee import *  # pylint: disable=redefined-builtin,wildcard-import
 from notes import fn, add_entry, delete_entry, edit_entry, upload_drive
 from notes import download_drive, search_entries, process_tags
 from notes import view_previous_versions, diffcheck, view_entry
+from notes import notes_with_tags, parse_tag_query
+from utils import KeysetPager, ListPager
+import drive_common
+import line_diff
+import migrations
+import storage
+import search_index
+import session_index
+import sync_worker
+import text_cache
+import upload_to_drive
+import vault
+import version_store
 import models as m
 import notes   #pylint: disable=ungrouped-imports
 import crypto as Crypto
@@ -14,7 +36,14 @@ import crypto as Crypto
 DB_TEMP = SqliteDatabase(':memory:')
 m.proxy.initialize(DB_TEMP)
 DB_TEMP.connect()
-DB_TEMP.create_tables([m.Note, m.Versions], safe=True)
+DB_TEMP.create_tables(m.MODELS, safe=True)
+# Jobs are run by the tests, a worker thread would not see the in-memory database
+WORKER = sync_worker.worker
+WORKER.autostart = False
+WORKER.make_service = mock.Mock
+# A cheap KDF, the tests unlock many vaults
+vault.KDF_COST = 4
+crypto = Crypto.Crypto()
 
 
 def test_add_entry():
@@ -59,12 +88,8 @@ def test_edit_entry():
     entry = m.Note.select().where(m.Note.title == title) # pylint: disable=assignment-from-no-return
     flag = 1
     entry = m.Note.get(m.Note.title == new_title)
-    assert (entry.title, entry.content, entry.password, flag) ==\
-           (new_title, encryped_data, password_to_store, 1)
-
-
-def simple_valid():
-    return True
+    assert (entry.title, crypto.decrypt(entry.content, password), entry.password, flag) ==\
+           (new_title, crypto.decrypt(encryped_data, password), password_to_store, 1)
 
 
 def invalid_error():
@@ -72,60 +97,114 @@ def invalid_error():
 
 
 class Testnotes(unittest.TestCase):
-    @mock.patch('upload_to_drive.main', side_effect=simple_valid)
-    def test_upload_drive_valid(self, upload_drive_function):
+    @mock.patch('upload_to_drive.upload_note', return_value={'id': 'd1'})
+    def test_upload_drive_valid(self, upload_note_function):
         title = "avi"
         content = "How are you doing today?"
         password = "masterpassword"
-        sync = True
-        add_entry(content, title, password, sync)
-        entry = m.Note.get(m.Note.title == title)
-        p_1 = upload_drive(entry.title, entry.content)
-        assert p_1
-
-
-    @mock.patch('upload_to_drive.main', side_effect=invalid_error)
-    def test_upload_drive_invalid(self, upload_drive_function):
+        entry = add_entry(crypto.encrypt(content, password), title, password, sync=True)
+        assert upload_drive(entry, password)
+        assert upload_drive(entry, password)
+        now = datetime.datetime.now()
+        assert m.SyncJob.select().where(m.SyncJob.note == entry).count() == 1
+        WORKER.process_due(now)
+        assert not upload_note_function.called
+        WORKER.process_due(now + sync_worker.DEBOUNCE)
+        upload_note_function.assert_called_once_with(WORKER.service, title, content, None)
+        assert m.Note.get_by_id(entry.id).drive_id == 'd1'
+        assert not m.SyncJob.select().where(m.SyncJob.note == entry).exists()
+
+
+    @mock.patch('upload_to_drive.upload_note', side_effect=Exception("Error"))
+    def test_upload_drive_invalid(self, upload_note_function):
         title = "avi"
         content = "How are you doing today?"
         password = "masterpassword"
-        sync = True
-        add_entry(content, title, password, sync)
-        entry = m.Note.get(m.Note.title == title)
-        p_1 = upload_drive(entry.title, entry.content)
-        assert not p_1
-
-
-    @mock.patch('download_from_drive.main', side_effect=simple_valid)
-    def test_download_drive_valid(self, upload_drive_function):
+        entry = add_entry(crypto.encrypt(content, password), title, password, sync=True)
+        assert upload_drive(entry, password)
+        now = datetime.datetime.now() + sync_worker.DEBOUNCE
+        with mock.patch.object(WORKER, 'drop_service') as drop_service:
+            WORKER.process_due(now)
+            WORKER.process_due(now + sync_worker.backoff(1))
+        assert drop_service.call_count == 2
+        job = m.SyncJob.get(m.SyncJob.note == entry)
+        assert (job.attempts, job.error) == (2, "Error")
+        assert job.due == now + sync_worker.backoff(1) + sync_worker.backoff(2)
+        assert job in WORKER.failing()
+        delete_entry(entry)
+        assert not m.SyncJob.select().where(m.SyncJob.note == entry).exists()
+
+
+    @mock.patch('download_from_drive.fetch_note', return_value=({'id': 'd2'}, None))
+    def test_download_drive_valid(self, fetch_note_function):
         title = "avi"
         content = "How are you doing today?"
         password = "masterpassword"
-        sync = True
-        add_entry(content, title, password, sync)
-        entry = m.Note.get(m.Note.title == title)
-        dir1 = os.getcwd()
-        f = open(os.path.join(os.path.join(dir1, "sync"), title+".txt"), "w+")  # pylint: disable=invalid-name
-        f.write(content)
-        f.close()
-        p_1 = download_drive(entry, entry.title, entry.content, password)
-        assert p_1
-
-
-    @mock.patch('download_from_drive.main', side_effect=invalid_error)
-    def test_download_drive_invalid(self, upload_drive_function):
-        title = "avi"
-        content = "How are you doing today?"
+        entry = add_entry(crypto.encrypt(content, password), title, password, sync=True)
+        assert download_drive(entry, content, password) == content
+        WORKER.process_due()
+        fetch_note_function.assert_called_once_with(WORKER.service, title, content, None)
+        assert m.Note.get_by_id(entry.id).drive_id == 'd2'
+        assert WORKER.take_conflict(entry.id) is None
+
+
+    @mock.patch('builtins.input', lambda *args: 'y')
+    @mock.patch('download_from_drive.fetch_note', return_value=({'id': 'd3'}, "From Drive"))
+    def test_download_drive_changed(self, fetch_note_function):
+        password = Crypto.SessionKey.from_password("masterpassword")
+        note = add_entry(crypto.encrypt("Local", password), "changed on drive", "pw", sync=True)
+        assert download_drive(note, "Local", password) == "Local"
+        WORKER.process_due()
+        assert download_drive(note, "Local", password) == "From Drive"
+        assert crypto.decrypt(m.Note.get_by_id(note.id).content, password) == "From Drive"
+        newest = note.versions.order_by(m.Versions.version_no.desc()).first()
+        assert crypto.decrypt(newest.content, password) == "From Drive"
+        assert m.SyncJob.select().where((m.SyncJob.note == note) &
+                                        (m.SyncJob.operation == sync_worker.PUSH)).exists()
+        delete_entry(note)
+
+
+    @mock.patch('builtins.input', lambda *args: '')
+    @mock.patch('download_from_drive.fetch_note', return_value=({'id': 'd5'}, "From Drive"))
+    def test_download_drive_kept(self, fetch_note_function):
         password = "masterpassword"
-        sync = True
-        add_entry(content, title, password, sync)
-        entry = m.Note.get(m.Note.title == title)
-        dir1 = os.getcwd()
-        f = open(os.path.join(os.path.join(dir1, "sync"), title+".txt"), "w+")  # pylint: disable=invalid-name
-        f.write(content)
-        f.close()
-        p_1 = download_drive(entry, entry.title, entry.content, password)
-        assert not p_1
+        note = add_entry(crypto.encrypt("Local", password), "kept local", "pw", sync=True)
+        download_drive(note, "Local", password)
+        WORKER.process_due()
+        assert download_drive(note, "Local", password) == "Local"
+        assert crypto.decrypt(m.Note.get_by_id(note.id).content, password) == "Local"
+        delete_entry(note)
+
+
+    @mock.patch('upload_to_drive.upload_note', return_value={'id': 'd6'})
+    @mock.patch('download_from_drive.fetch_note', return_value=({'id': 'd6'}, "Old on Drive"))
+    def test_download_drive_waits_for_upload(self, fetch_note_function, upload_note_function):
+        password = "masterpassword"
+        note = add_entry(crypto.encrypt("Old on Drive", password), "pull after push", "pw",
+                         sync=True)
+        WORKER.conflicts[note.id] = "Old on Drive"
+        edit_entry(note, note.title, "Edited", password)
+        download_drive(note, "Edited", password)
+        now = datetime.datetime.now()
+        WORKER.process_due(now)
+        assert not fetch_note_function.called
+        fetch_note_function.side_effect = lambda *args: (upload_note_function.assert_called_once()
+                                                         or ({'id': 'd6'}, None))
+        WORKER.process_due(now + sync_worker.DEBOUNCE)
+        assert fetch_note_function.called
+        assert WORKER.take_conflict(note.id) is None
+        assert not m.SyncJob.select().where(m.SyncJob.note == note).exists()
+
+
+    @mock.patch('download_from_drive.fetch_note', return_value=({'id': 'd4'}, "From Drive"))
+    def test_download_drive_forgotten_key(self, fetch_note_function):
+        password = "masterpassword"
+        note = add_entry(crypto.encrypt("Local", password), "no key", password, sync=True)
+        download_drive(note, "Local", password)
+        WORKER.forget_keys()
+        WORKER.process_due()
+        assert not fetch_note_function.called
+        assert m.SyncJob.select().where(m.SyncJob.note == note).exists()
 
 
 def test_search_entries_valid():
@@ -152,6 +231,48 @@ def test_menu_loop_q():
     notes.menu_loop()
 
 
+@mock.patch('getpass.getpass', return_value="masterpassword")
+def test_set_and_reset_profile(getpass_function):
+    notes.set_profile()
+    keyring = notes.profile['keyring']
+    assert vault.find("masterpassword").vault.id == keyring.vault.id
+    key = keyring.master
+    data_key, note_key = keyring.new_note_key()
+    entry = add_entry(crypto.encrypt("profile", note_key), "profile note", None,
+                      vault=keyring.vault, data_key=data_key)
+    held = len(keyring.note_keys)
+    assert keyring.note_key(entry) is note_key and len(keyring.note_keys) == held
+    notes.reset_profile()
+    assert notes.profile is None
+    assert key.stored_hash() == "00" * 32
+    assert note_key.stored_hash() == "00" * 32
+
+
+def test_reset_profile_zeroes_loose_keys():
+    keyring = vault.unlock("loosepassword")
+    data_key, key = keyring.new_note_key()
+    entry = add_entry(crypto.encrypt("loose", key), "loose key", None, vault=keyring.vault,
+                      data_key=data_key)
+    keyring.zero()
+    loose = notes.note_key(entry, "loosepassword")
+    assert crypto.decrypt(entry.content, loose) == "loose"
+    assert notes.note_key(entry, "loosepassword") is loose
+    notes.reset_profile()
+    assert loose.stored_hash() == "00" * 32 and not notes.loose_keys
+
+
+@mock.patch('getpass.getpass', side_effect=["newpassword", "newpasword", "newpassword",
+                                            "newpassword"])
+def test_set_profile_confirms_new_vault(getpass_function):
+    assert vault.find("newpassword") is None
+    vaults = m.Vault.select().count()
+    notes.set_profile()
+    assert getpass_function.call_count == 4
+    assert m.Vault.select().count() == vaults + 1
+    assert vault.find("newpassword").vault.id == notes.profile['keyring'].vault.id
+    notes.reset_profile()
+
+
 def test_view_entries():
     notes.input = lambda t: 'q'
     notes.view_entries()
@@ -170,6 +291,84 @@ def test_process_tags():
     assert tags_list == compare_tag_list
 
 
+def test_parse_tag_query():
+    assert parse_tag_query("work, home") == (["work", "home"], True)
+    assert parse_tag_query("work|home*") == (["work", "home*"], False)
+
+
+def test_notes_with_tags():
+    add_entry("c1", "tagged one", "pw", process_tags("work,urgent"))
+    add_entry("c2", "tagged two", "pw", process_tags("homework"))
+    add_entry("c3", "tagged three", "pw", process_tags("work"))
+
+    def titles(terms, match_all=True):
+        query = notes_with_tags(terms, match_all).where(m.Note.title.startswith("tagged"))
+        return sorted(note.title for note in query)
+
+    assert titles(["work"]) == ["tagged one", "tagged three"]
+    assert titles(["work", "urgent"]) == ["tagged one"]
+    assert titles(["urgent", "homework"], match_all=False) == ["tagged one", "tagged two"]
+    assert titles(["home*"]) == ["tagged two"]
+
+
+def test_migrate_csv_tags():
+    database = SqliteDatabase(':memory:')
+    with database.bind_ctx(m.MODELS):
+        database.create_tables([m.Note, m.Versions])
+        m.Note.create(content="c", title="legacy", tags="all,work, home")
+        migrations.migrate(database)
+        note = m.Note.get(m.Note.title == "legacy")
+        names = sorted(link.tag.name for link in note.note_tags)
+        assert names == ["all", "home", "work"]
+        assert database.pragma('user_version') == len(migrations.DATA_MIGRATIONS)
+
+
+def test_edit_entry_versions():
+    crypto = Crypto.Crypto()
+    password = "masterpassword"
+    add_entry(crypto.encrypt("v1", password), "versioned", crypto.key_to_store(password))
+    entry = m.Note.get(m.Note.title == "versioned")
+    for i in range(2, version_store.MAX_VERSIONS + 3):
+        edit_entry(entry, "versioned", "v" + str(i), password)
+    edit_entry(entry, "renamed", "last", password)
+    versions = list(entry.versions.order_by(m.Versions.version_no))
+    assert len(versions) == version_store.MAX_VERSIONS
+    assert versions[-1].version_no == version_store.MAX_VERSIONS + 3
+    assert all(v.title == str(v.version_no) + "_renamed" for v in versions)
+    assert crypto.decrypt(versions[-1].content, password) == "last"
+    assert [v.is_delta for v in versions] == [True] * (len(versions) - 1) + [False]
+    texts = [version_store.version_text(v, password) for v in versions]
+    assert texts == ["v" + str(i) for i in range(4, version_store.MAX_VERSIONS + 3)] + ["last"]
+    delete_entry(entry)
+    assert not m.Versions.select().where(m.Versions.note == entry.id).exists()
+
+
+def test_version_delta_round_trip():
+    newer = "line one\nline two changed\nline three\nadded\n"
+    older = "line zero\nline one\nline two\nline three\nno newline"
+    ops = version_store.make_delta(newer, older)
+    assert version_store.apply_delta(newer, ops) == older
+    assert version_store.unpack_delta(version_store.pack_delta(ops, "key"), "key") == ops
+    packed = zlib.compress(json.dumps(ops).encode(), 9)
+    legacy = crypto.encrypt(base64.b64encode(packed).decode().rstrip('='), "key")
+    assert version_store.unpack_delta(legacy, "key") == ops
+
+
+def test_migrate_link_versions():
+    database = SqliteDatabase(':memory:')
+    with database.bind_ctx(m.MODELS):
+        database.execute_sql('CREATE TABLE "versions" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                             '"title" VARCHAR(255) NOT NULL, "content" TEXT NOT NULL, '
+                             '"timestamp" DATETIME NOT NULL)')
+        database.create_tables([m.Note])
+        note = m.Note.create(content="c", title="my_note")
+        database.execute_sql('INSERT INTO "versions" ("title", "content", "timestamp") '
+                             'VALUES (\'2_my_note\', \'c\', \'2018-01-01\')')
+        migrations.migrate(database)
+        version = m.Versions.get()
+        assert (version.note.id, version.version_no) == (note.id, 2)
+
+
 def test_view_previous_versions():
     notes.input = lambda t: 'q'
     crypto = Crypto.Crypto()
@@ -229,3 +428,524 @@ def test_view_entry():
     entry = m.Note.get(m.Note.title == title)
     flag = view_entry(entry, password)
     assert not flag
+
+
+def test_keyset_pager():
+    database = SqliteDatabase(':memory:')
+    with database.bind_ctx(m.MODELS):
+        database.create_tables(m.MODELS)
+        same_time = datetime.datetime(2018, 5, 1, 12, 0)
+        for i in range(7):
+            timestamp = same_time if i in (2, 3, 4) else datetime.datetime(2018, 5, 1, i)
+            m.Note.create(title=str(i), content="", timestamp=timestamp)
+        pager = KeysetPager(m.Note.select(), m.Note.timestamp, m.Note.id, 2)
+
+        def titles(page):
+            return [note.title for note in page]
+
+        assert titles(pager.first()) == ["4", "3"] and not pager.has_previous
+        assert titles(pager.next()) == ["2", "6"]
+        assert titles(pager.next()) == ["5", "1"]
+        assert titles(pager.next()) == ["0"] and not pager.has_next
+        assert titles(pager.next()) == ["0"]
+        assert titles(pager.previous()) == ["5", "1"]
+        assert titles(pager.previous()) == ["2", "6"]
+        assert titles(pager.previous()) == ["4", "3"] and not pager.has_previous
+
+
+def test_storage_pragmas(tmpdir):
+    with open(os.path.join(str(tmpdir), storage.CONFIG_FILE), 'w') as config:
+        config.write("[sqlite]\ncache_size = -2000\nsynchronous = full\n")
+    pragmas = storage.load_pragmas(str(tmpdir), environ={'NOTES_SQLITE_SYNCHRONOUS': 'off',
+                                                         'NOTES_SQLITE_TEMP_STORE': 'memory',
+                                                         'NOTES_SQLITE_': 'ignored'})
+    assert pragmas['journal_mode'] == 'wal'
+    assert pragmas['cache_size'] == '-2000'
+    assert pragmas['synchronous'] == 'off'
+    assert pragmas['temp_store'] == 'memory' and '' not in pragmas
+    database = storage.make_database(str(tmpdir), pragmas)
+    database.connect()
+    assert database.pragma('journal_mode') == 'wal'
+    assert database.pragma('cache_size') == -2000
+    assert database.pragma('synchronous') == 0
+    assert database.pragma('temp_store') == 2
+    database.close()
+
+
+@mock.patch('notes.set_tags', side_effect=invalid_error)
+def test_add_entry_rolls_back(set_tags_function):
+    try:
+        add_entry("content", "rolled back", "pw", "tag")
+        assert False
+    except Exception:  # pylint: disable=broad-except
+        pass
+    assert not m.Note.select().where(m.Note.title == "rolled back").exists()
+
+
+def test_remote_tree_changes():
+    tree = drive_common.RemoteTree('top')
+    tree.update({'id': 'a', 'name': 'sub', 'parents': ['top'],
+                 'mimeType': drive_common.FOLDER_MIME_TYPE})
+    tree.update({'id': 'b', 'name': 'n.txt', 'parents': ['a'],
+                 'mimeType': 'text/plain', 'md5Checksum': 'x'})
+    tree.update({'id': 'c', 'name': 'elsewhere.txt', 'parents': ['other'],
+                 'mimeType': 'text/plain'})
+    tree.prune()
+    tree.save('/tmp/sync', '5')
+
+    loaded, token = drive_common.RemoteTree.load('/tmp/sync')
+    assert token == '5'
+    assert sorted(loaded.paths('sync')) == ['sync/sub', 'sync/sub/n.txt']
+    assert loaded.paths('sync')['sync/sub/n.txt']['md5Checksum'] == 'x'
+
+    service = mock.MagicMock()
+    service.changes().list().execute.return_value = {
+        'changes': [{'fileId': 'a', 'removed': True}], 'newStartPageToken': '6'}
+    assert loaded.apply_changes(service, '5') == '6'
+    loaded.save('/tmp/sync', '6')
+    loaded, token = drive_common.RemoteTree.load('/tmp/sync')
+    assert token == '6' and loaded.paths('sync') == {}
+    assert not loaded.root_removed
+
+
+def test_remote_tree_folder_moved_in():
+    folder = drive_common.FOLDER_MIME_TYPE
+    tree = drive_common.RemoteTree('top')
+    listings = {
+        "('moved' in parents) and trashed != True": [
+            {'id': 'inner', 'name': 'inner', 'parents': ['moved'], 'mimeType': folder},
+            {'id': 'f1', 'name': 'a.txt', 'parents': ['moved'], 'mimeType': 'text/plain'}],
+        "('inner' in parents) and trashed != True": [
+            {'id': 'f2', 'name': 'b.txt', 'parents': ['inner'], 'mimeType': 'text/plain'}],
+    }
+    queries = []
+
+    def list_call(**kwargs):
+        queries.append(kwargs['q'])
+        return mock.Mock(execute=mock.Mock(return_value={'files': listings[kwargs['q']]}))
+    service = mock.MagicMock()
+    service.files().list.side_effect = list_call
+    service.changes().list().execute.return_value = {
+        'changes': [{'fileId': 'moved', 'file': {'id': 'moved', 'name': 'moved',
+                                                 'parents': ['top'], 'mimeType': folder}},
+                    {'fileId': 'away', 'file': {'id': 'away', 'name': 'away',
+                                                'parents': ['root'], 'mimeType': folder}}],
+        'newStartPageToken': '2'}
+    assert tree.apply_changes(service, '1') == '2'
+    assert sorted(tree.paths('sync')) == ['sync/moved', 'sync/moved/a.txt', 'sync/moved/inner',
+                                          'sync/moved/inner/b.txt']
+    assert queries == ["('moved' in parents) and trashed != True",
+                       "('inner' in parents) and trashed != True"]
+
+
+def test_sync_manifest(tmpdir):
+    path = os.path.join(str(tmpdir), 'note.txt')
+    with open(path, 'w') as note:
+        note.write('first')
+    manifest = drive_common.Manifest(str(tmpdir))
+    with mock.patch('drive_common.file_md5', wraps=drive_common.file_md5) as hashed:
+        assert manifest.local_md5(path) == drive_common.file_md5(path)
+        manifest.save()
+        assert drive_common.Manifest(str(tmpdir)).local_md5(path) == manifest.local_md5(path)
+        assert hashed.call_count == 2
+        with open(path, 'w') as note:
+            note.write('second!')
+        assert manifest.local_md5(path) == drive_common.file_md5(path)
+        assert hashed.call_count == 4
+    manifest.uploaded(path, {'id': 'd1', 'md5Checksum': 'abc'})
+    manifest.save()
+    assert m.DriveFile.get(m.DriveFile.path == path).drive_id == 'd1'
+    os.remove(path)
+    drive_common.Manifest(str(tmpdir)).save()
+    assert not m.DriveFile.select().where(m.DriveFile.path == path).exists()
+
+
+def test_remote_tree_scan_pages():
+    folder = drive_common.FOLDER_MIME_TYPE
+    pages = {
+        ("('top' in parents) and trashed != True", None): {
+            'files': [{'id': 'a', 'name': 'sub', 'parents': ['top'], 'mimeType': folder}],
+            'nextPageToken': '2'},
+        ("('top' in parents) and trashed != True", '2'): {
+            'files': [{'id': "it's", 'name': 'quoted', 'parents': ['top'], 'mimeType': folder}]},
+        ("('a' in parents or 'it\\'s' in parents) and trashed != True", None): {
+            'files': [{'id': 'b', 'name': 'sub', 'parents': ['a'], 'mimeType': folder}]},
+        ("('b' in parents) and trashed != True", None): {
+            'files': [{'id': 'c', 'name': 'n.txt', 'parents': ['b'], 'mimeType': 'text/plain'}]},
+    }
+    queries = []
+
+    def list_call(**kwargs):
+        queries.append(kwargs['q'])
+        return mock.Mock(execute=mock.Mock(return_value=pages[kwargs['q'],
+                                                                kwargs.get('pageToken')]))
+
+    service = mock.MagicMock()
+    service.files().list.side_effect = list_call
+    with mock.patch('drive_common.PARENTS_PER_QUERY', 2):
+        tree = drive_common.RemoteTree.scan(service, 'top')
+    assert sorted(tree.paths('sync')) == ['sync/quoted', 'sync/sub', 'sync/sub/sub',
+                                          'sync/sub/sub/n.txt']
+    assert queries == [query for query, _ in pages]
+
+
+class FakeBatch:
+    """Drive batch request answering each call with respond(request)"""
+
+    def __init__(self, respond, callback, batches):
+        self.respond, self.callback, self.calls = respond, callback, []
+        batches.append(self)
+
+    def add(self, request, request_id):
+        self.calls.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.calls:
+            try:
+                self.callback(request_id, self.respond(request), None)
+            except Exception as error:  # pylint: disable=broad-except
+                self.callback(request_id, None, error)
+
+
+def batch_service(respond):
+    batches = []
+    service = mock.MagicMock()
+    service.new_batch_http_request.side_effect = \
+        lambda callback: FakeBatch(respond, callback, batches)
+    return service, batches
+
+
+def test_execute_batched():
+    def respond(request):
+        if request == 3:
+            raise OSError('failed')
+        return request * 10
+    service, batches = batch_service(respond)
+    results = drive_common.execute_batched(service, list(range(5)), batch_limit=2)
+    assert [len(batch.calls) for batch in batches] == [2, 2, 1]
+    assert [response for response, _ in results] == [0, 10, 20, None, 40]
+    assert [error is None for _, error in results] == [True, True, True, False, True]
+
+
+def test_create_folders():
+    def respond(request):
+        if request['name'] == 'bad':
+            raise OSError('failed')
+        return {'id': request['parents'][0] + '/' + request['name']}
+    service, batches = batch_service(respond)
+    service.files().create.side_effect = lambda body, fields: body
+    parents_id, failures = {}, []
+    created = upload_to_drive.create_folders(
+        service, ['sync', 'sync/a', 'sync/bad', 'sync/a/b', 'sync/bad/c'], parents_id, failures)
+    assert created == ['sync', 'sync/a', 'sync/a/b']
+    assert parents_id['sync/a/b'] == 'root/sync/a/b'
+    assert [what for what, _ in failures] == ['sync/bad']
+    assert [len(batch.calls) for batch in batches] == [1, 2, 1]
+
+
+def test_transfer_pool():
+    services = {}
+
+    def transfer(service, what):
+        services.setdefault(threading.get_ident(), set()).add(service)
+        if what == 'dns':
+            raise httplib2.ServerNotFoundError('no such host')
+        if what == 'reset':
+            raise OSError('connection reset')
+        return what
+    done = []
+    pool = drive_common.TransferPool(mock.Mock, workers=2,
+                                     progress=lambda *args: done.append(args[0]))
+    for what in ['a', 'dns', 'b', 'reset', 'c']:
+        pool.submit(what, transfer, what)
+    failures = pool.wait()
+    assert sorted(what for what, _ in failures) == ['dns', 'reset']
+    assert sorted(done) == [1, 2, 3, 4, 5]
+    assert all(len(built) == 1 for built in services.values())
+    assert len(set.union(*services.values())) == len(services)
+
+    def broken(service):
+        raise KeyError('bug')
+    pool = drive_common.TransferPool(mock.Mock, workers=1)
+    pool.submit('broken', broken)
+    with unittest.TestCase().assertRaises(KeyError):
+        pool.wait()
+    with unittest.TestCase().assertRaises(RuntimeError):
+        pool.submit('late', broken)
+
+
+def test_fetch_note_gone():
+    import download_from_drive  # pylint: disable=import-outside-toplevel
+    service = mock.Mock()
+    service.files().get().execute.side_effect = HttpError(httplib2.Response({'status': 404}),
+                                                          b'not found')
+    with mock.patch('download_from_drive.find_note', return_value=None) as find_note:
+        assert download_from_drive.fetch_note(service, "gone", "text", 'd7') == (None, None)
+        find_note.assert_called_once_with(service, "gone", download_from_drive.DIR_NAME)
+        service.files().get().execute.side_effect = None
+        service.files().get().execute.return_value = {'id': 'd7', 'trashed': True,
+                                                      'md5Checksum': 'x'}
+        assert download_from_drive.fetch_note(service, "trashed", "text", 'd7') == (None, None)
+        assert find_note.call_count == 2
+    service.files().get().execute.side_effect = HttpError(httplib2.Response({'status': 500}),
+                                                          b'error')
+    with unittest.TestCase().assertRaises(HttpError):
+        download_from_drive.fetch_note(service, "broken", "text", 'd7')
+
+
+@mock.patch('download_from_drive.fetch_note', return_value=(None, None))
+def test_download_drive_gone(fetch_note_function):
+    password = "masterpassword"
+    note = add_entry(crypto.encrypt("Local", password), "gone from drive", password, sync=True)
+    m.Note.update(drive_id='d8').where(m.Note.id == note.id).execute()
+    download_drive(m.Note.get_by_id(note.id), "Local", password)
+    WORKER.process_due()
+    assert fetch_note_function.called
+    assert m.Note.get_by_id(note.id).drive_id is None
+    assert not m.SyncJob.select().where(m.SyncJob.note == note).exists()
+
+
+def test_drive_session():
+    session = upload_to_drive.DriveSession(make_service=mock.Mock)
+    service = session.service()
+    assert session.service() is service
+    other = []
+    thread = threading.Thread(target=lambda: other.append(session.service()))
+    thread.start()
+    thread.join()
+    assert other[0] is not service
+    session.forget_service()
+    assert session.service() is not service
+    with mock.patch('upload_to_drive.note_folder_id', return_value='f1') as lookup:
+        assert session.folder_id(service) == 'f1'
+        assert session.folder_id(service) == 'f1'
+        assert lookup.call_count == 1
+        session.forget_folder()
+        lookup.return_value = 'f2'
+        assert session.folder_id(service) == 'f2'
+
+
+def test_resumable_upload_session():
+    status = mock.MagicMock(status=308)
+    status.get.return_value = 'bytes=0-99'
+    request = mock.Mock(resumable_uri=None, resumable_progress=0)
+    request.http.request.return_value = (status, b'')
+
+    def interrupted(num_retries):  # pylint: disable=unused-argument
+        request.resumable_uri = 'u1'
+        raise OSError('connection reset')
+    request.next_chunk.side_effect = interrupted
+    with unittest.TestCase().assertRaises(OSError):
+        drive_common.execute_upload(request, 'big.bin', 'f1', '300:1.0')
+    assert m.UploadSession.get(m.UploadSession.key == 'big.bin').uri == 'u1'
+
+    request = mock.Mock(resumable_uri=None, resumable_progress=0)
+    request.http.request.return_value = (status, b'')
+    request.next_chunk.side_effect = [(None, None), (None, {'id': 'd1'})]
+    assert drive_common.execute_upload(request, 'big.bin', 'f1', '300:1.0') == {'id': 'd1'}
+    assert (request.resumable_uri, request.resumable_progress) == ('u1', 100)
+    assert not m.UploadSession.select().where(m.UploadSession.key == 'big.bin').exists()
+
+
+def test_search_index():
+    keyring = vault.unlock("searchpassword")
+    data_key, key = keyring.new_note_key()
+    text = "Meeting notes: Ünïcode budget review"
+    entry = add_entry(crypto.encrypt(text, key), "indexed", None,
+                      terms=search_index.note_terms(text, key),
+                      vault=keyring.vault, data_key=data_key)
+    stored = [term for term, in m.SearchTerm.select(m.SearchTerm.term)
+              .where(m.SearchTerm.note == entry).tuples()]
+    assert len(stored) == 5 and 'budget' not in stored
+
+    def found(query, search_key=keyring.master):
+        return entry.id in [note.id for note in
+                            m.Note.select().where(m.Note.id.in_(
+                                search_index.matching_notes(query, search_key)))]
+    assert found("BUDGET meeting")
+    assert found("ünïcode")
+    assert not found("budget party")
+    assert not found("budget", vault.unlock("other").master)
+    edit_entry(entry, "indexed", "Party planning", key)
+    assert found("party") and not found("budget")
+    m.SearchTerm.delete().where(m.SearchTerm.note == entry).execute()
+    assert search_index.backfill(keyring) >= 1
+    assert found("planning")
+    delete_entry(entry)
+    assert not m.SearchTerm.select().where(m.SearchTerm.note == entry).exists()
+
+
+def test_session_index():
+    keyring = vault.unlock("sessionpassword")
+
+    def note(title, text):
+        data_key, key = keyring.new_note_key()
+        return add_entry(crypto.encrypt(text, key), title, None, vault=keyring.vault,
+                         data_key=data_key)
+    first = note("first", "Good day. The quick brown fox, the QUICK dog")
+    second = note("second", "A quick day out")
+    index = session_index.SessionIndex(keyring)
+    index.build()
+    assert index.ready.is_set()
+    assert index.query("quick") == [first.id, second.id]
+    assert index.query('"quick brown"') == [first.id]
+    assert index.query('"fox quick"') == []
+    assert index.query("*ick do*") == [first.id]
+    assert index.query("*od day*") == [first.id]
+    with mock.patch('search_index.MODE', search_index.MEMORY), \
+            mock.patch('notes.profile', {'keyring': keyring, 'index': index}):
+        edit_entry(second, "second", "Slow brown day", keyring.note_key(second))
+        assert index.query("brown") == [second.id, first.id]
+        assert index.query("quick") == [first.id]
+        delete_entry(first)
+    assert index.query("brown") == [second.id]
+    pager = ListPager(m.Note.select(*m.NOTE_LISTING), m.Note.id, [second.id, first.id], 1)
+    assert [row.id for row in pager.first()] == [second.id] and pager.has_next
+    assert pager.next() == [] and pager.has_previous
+    index.discard()
+    assert index.query("brown") == [] and not index.texts
+
+
+@mock.patch('getpass.getpass', return_value="masterpassword")
+def test_set_profile_memory_index(getpass_function):
+    with mock.patch('search_index.MODE', search_index.MEMORY), \
+            mock.patch('session_index.SessionIndex.start') as start:
+        notes.set_profile()
+        index = notes.profile['index']
+        assert start.called
+        notes.reset_profile()
+    assert index.discarded and notes.current_index() is None
+
+
+def test_text_cache():
+    cache = text_cache.TextCache(max_bytes=10)
+    cache.put(text_cache.NOTE, 1, 1, 'a', "key", "12345")
+    cache.put(text_cache.VERSION, 1, 7, 1, "key", "abcd")
+    assert cache.get(text_cache.NOTE, 1, 1, 'a', "key") == "12345"
+    assert cache.get(text_cache.NOTE, 1, 1, 'a', "other") is None
+    evicted = cache.entries[next(iter(cache.entries))]
+    cache.put(text_cache.NOTE, 2, 2, 'b', "key", "xyz")
+    assert cache.size == 8 and cache.get(text_cache.VERSION, 1, 7, 1, "key") is None
+    assert evicted == bytearray(4)
+    cache.put(text_cache.NOTE, 3, 3, 'c', "key", "too long to cache")
+    assert cache.get(text_cache.NOTE, 3, 3, 'c', "key") is None
+    cache.invalidate(1)
+    assert cache.get(text_cache.NOTE, 1, 1, 'a', "key") is None
+    assert cache.stats() == {'hits': 1, 'misses': 4, 'entries': 1, 'bytes': 3}
+    assert all(Crypto.SessionKey.from_password("key").stored_hash() not in part
+               for cache_key in cache.entries for part in map(str, cache_key))
+    cached = cache.entries[next(iter(cache.entries))]
+    cache.clear()
+    assert cached == bytearray(3) and cache.size == 0
+
+
+def test_text_cache_versions():
+    key = Crypto.SessionKey.from_password("cachepassword")
+    entry = add_entry(crypto.encrypt("first", key), "cached", key.stored_hash())
+    m.Versions.update(content=crypto.encrypt("first", key)).where(
+        m.Versions.note == entry).execute()
+    edit_entry(entry, "cached", "second", key)
+    versions = list(m.Versions.select(*m.VERSION_LISTING).where(m.Versions.note == entry)
+                    .order_by(m.Versions.version_no.desc()))
+    text_cache.cache.clear()
+    misses = text_cache.cache.misses
+    assert diffcheck('0', '1', key, 1, versions) == diffcheck('0', '1', key, 1, versions)
+    assert text_cache.cache.misses == misses + 2
+    assert text_cache.note_text(entry, key) == "second"
+    edit_entry(entry, "cached", "third", key)
+    assert text_cache.note_text(m.Note.get_by_id(entry.id), key) == "third"
+    # A write that skips invalidate still changes the ciphertext the entry is keyed on
+    m.Note.update(content=crypto.encrypt("fourth", key)).where(m.Note.id == entry.id).execute()
+    assert text_cache.note_text(m.Note.get_by_id(entry.id), key) == "fourth"
+
+
+def test_line_diff():
+    generator = random.Random(4156)
+    for _ in range(200):
+        old = [generator.choice('abcd') for _ in range(generator.randint(0, 30))]
+        new = [generator.choice('abcd') for _ in range(generator.randint(0, 30))]
+        rebuilt = []
+        for tag, i_1, i_2, j_1, j_2 in line_diff.opcodes(old, new):
+            assert tag != 'equal' or old[i_1:i_2] == new[j_1:j_2]
+            rebuilt.extend(old[i_1:i_2] if tag == 'equal' else new[j_1:j_2])
+        assert rebuilt == new
+    old = ['line {}'.format(i) for i in range(40)]
+    new = old[:5] + ['line 5 changed'] + old[6:30] + old[31:] + ['end']
+    assert list(line_diff.unified(old, new, fromfile='1', tofile='2')) == \
+        list(difflib.unified_diff(old, new, '1', '2', lineterm=''))
+    assert list(line_diff.unified(['the quick fox'], ['the quack fox'], context=None)) == \
+        ['--- ', '+++ ', '@@ -1 +1 @@', '-the quick fox', '?      ^', '+the quack fox',
+         '?      ^']
+    assert list(line_diff.unified(old, old)) == []
+
+
+def test_line_diff_bounded():
+    old, new = [], []
+    for i in range(2000):
+        old += ['old line {}'.format(i), '']
+        new += ['new line {}'.format(i), '']
+    for timeout in (None, 0):
+        rebuilt = []
+        for tag, i_1, i_2, j_1, j_2 in line_diff.opcodes(old, new, timeout):
+            assert tag != 'equal' or old[i_1:i_2] == new[j_1:j_2]
+            rebuilt.extend(old[i_1:i_2] if tag == 'equal' else new[j_1:j_2])
+        assert rebuilt == new
+
+    def codes():
+        yield 'replace', 0, 1, 0, 1
+        yield 'equal', 1, 20, 1, 20
+        raise AssertionError("read past the first hunk")
+    assert next(line_diff.grouped(codes())) == [('replace', 0, 1, 0, 1), ('equal', 1, 4, 1, 4)]
+
+
+def test_diffcheck_large():
+    key = Crypto.SessionKey.from_password("diffpassword")
+    text = '\n'.join('line {}'.format(i) for i in range(line_diff.DIFFER_MAX_LINES))
+    entry = add_entry(crypto.encrypt(text, key), "large diff", key.stored_hash())
+    m.Versions.update(content=crypto.encrypt(text, key)).where(
+        m.Versions.note == entry).execute()
+    edit_entry(entry, "large diff", text.replace('line 7\n', 'line seven\n'), key)
+    versions = list(m.Versions.select(*m.VERSION_LISTING).where(m.Versions.note == entry)
+                    .order_by(m.Versions.version_no.desc()))
+    diff = diffcheck('1', '0', key, 1, versions)
+    assert next(diff) == '--- 1_large diff'
+    assert list(diff)[2:] == [' line 4', ' line 5', ' line 6', '-line 7', '+line seven',
+                              ' line 8', ' line 9', ' line 10']
+
+
+def test_vault_password_change():
+    legacy = Crypto.SessionKey.from_password("vaultpassword")
+    entry = add_entry(crypto.encrypt("first", legacy), "vaulted", legacy.stored_hash(),
+                      terms=search_index.note_terms("first", legacy))
+    edit_entry(entry, "vaulted", "second", legacy)
+    assert vault.unlock("wrongpassword", create_missing=False) is None
+    assert notes.note_key(entry, "wrongpassword") is None
+    keyring = vault.unlock("vaultpassword", create_missing=False)
+    entry = m.Note.get_by_id(entry.id)
+    assert entry.password is None and keyring.owns(entry)
+    assert not m.SearchTerm.select().where(m.SearchTerm.note == entry).exists()
+    key = keyring.note_key(entry)
+    versions = list(m.Versions.select().where(m.Versions.note == entry)
+                    .order_by(m.Versions.version_no))
+    assert [version_store.version_text(version, key) for version in versions] == \
+        ["first", "second"]
+    contents = [row.content for row in [entry] + versions]
+    vault.change_password("vaultpassword", "newvaultpassword")
+    assert vault.find("vaultpassword") is None
+    assert [row.content for row in [m.Note.get_by_id(entry.id)] +
+            list(m.Versions.select().where(m.Versions.note == entry)
+                 .order_by(m.Versions.version_no))] == contents
+    assert crypto.decrypt(entry.content, notes.note_key(entry, "newvaultpassword")) == "second"
+    assert crypto.decrypt(entry.content, keyring.note_key(entry)) == "second"
+    vault.unlock("takenpassword").zero()
+    try:
+        vault.change_password("newvaultpassword", "takenpassword")
+        assert False
+    except ValueError:
+        pass
+    try:
+        vault.change_password("vaultpassword", "anotherpassword")
+        assert False
+    except ValueError:
+        pass
+    keyring.zero()
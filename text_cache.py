@@ -0,0 +1,108 @@
+"""Cache of decrypted note and version texts.
+
+Opening a note, listing its versions and diffing them kept decrypting the
+same rows. Plaintexts are kept in an LRU cache bounded by their total
+size in bytes, keyed by row, by a hash of the ciphertext or the version
+number, and by a fingerprint of the key that decrypted them, so the cache
+holds no key material. Writes to a note invalidate its entries;
+reset_profile clears the cache and overwrites the cached bytes. The size
+can be set with NOTES_TEXT_CACHE_KB, 0 turns the cache off.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import crypto as Crypto
+
+MAX_BYTES = int(os.getenv('NOTES_TEXT_CACHE_KB', '8192')) * 1024
+NOTE = 'note'
+VERSION = 'version'
+crypto = Crypto.Crypto()  # pylint: disable=invalid-name
+
+
+def zero(buf):
+    for i in range(len(buf)):
+        buf[i] = 0
+
+
+class TextCache:
+    """
+    LRU cache of plaintexts holding at most max_bytes of UTF-8 text
+    :param max_bytes: size bound, texts larger than it are not cached
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(kind, note_id, row_id, stamp, key):
+        return kind, note_id, row_id, stamp, crypto.session_key(key).fingerprint()
+
+    def get(self, kind, note_id, row_id, stamp, key):
+        """Cached text of a row decrypted with key, None on a miss"""
+        cache_key = self._key(kind, note_id, row_id, stamp, key)
+        with self.lock:
+            buf = self.entries.get(cache_key)
+            if buf is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(cache_key)
+            return buf.decode()
+
+    def put(self, kind, note_id, row_id, stamp, key, text):
+        buf = bytearray(text.encode())
+        if len(buf) > self.max_bytes:
+            return
+        cache_key = self._key(kind, note_id, row_id, stamp, key)
+        with self.lock:
+            self._pop(cache_key)
+            self.entries[cache_key] = buf
+            self.size += len(buf)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, cache_key):
+        buf = self.entries.pop(cache_key, None)
+        if buf is not None:
+            self.size -= len(buf)
+            zero(buf)
+
+    def invalidate(self, note_id):
+        """Drop every cached text of a note and its versions"""
+        with self.lock:
+            for cache_key in [k for k in self.entries if k[1] == note_id]:
+                self._pop(cache_key)
+
+    def clear(self):
+        """Drop and overwrite every cached text"""
+        with self.lock:
+            for buf in self.entries.values():
+                zero(buf)
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+
+cache = TextCache()  # pylint: disable=invalid-name
+
+
+def note_text(note, key):
+    """Decrypted content of a note, through the cache"""
+    # Every encryption draws a new IV, so the ciphertext changes with each save
+    stamp = hashlib.sha256(note.content.encode()).hexdigest()
+    text = cache.get(NOTE, note.id, note.id, stamp, key)
+    if text is None:
+        text = crypto.decrypt(note.content, key)
+        cache.put(NOTE, note.id, note.id, stamp, key, text)
+    return text
@@ -2,12 +2,13 @@
 
 """Example cooment to make pylint stop giving me errors."""
 
-import datetime
 import hashlib
+import io
+import itertools
 import mimetypes
-import time
+from collections import defaultdict
 import os
-import httplib2
+import threading
 
 from googleapiclient import discovery
 from oauth2client import client
@@ -15,7 +16,10 @@ from oauth2client import tools
 # from oauth2client.tools import run
 
 from oauth2client.file import Storage
-from googleapiclient.http import MediaFileUpload       # pylint: disable=ungrouped-imports
+from googleapiclient.errors import HttpError           # pylint: disable=ungrouped-imports
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, build_http
+from drive_common import FOLDER_MIME_TYPE, UPLOAD_CHUNK_SIZE, Manifest, SyncError, \
+    TransferPool, execute_batched, execute_upload, list_files, quote, sync_tree
 # Import our folder uploading script
 # import initial_upload
 
@@ -33,6 +37,9 @@ DIR_NAME = 'sync'
 # Or simply
 # DIR_NAME = FULL_PATH.split('/')[-1]
 
+# Notes are uploaded as <title>.txt
+NOTE_MIME_TYPE = 'text/plain'
+
 # Don't really need it here
 GOOGLE_MIME_TYPES = {
     'application/vnd.google-apps.document':
@@ -60,81 +67,236 @@ GOOGLE_MIME_TYPES = {
 # 'application/octet-stream': 'text/plain'
 
 
-def folder_upload(service):
+def relative_folders(full_path):
+    """Lists folder paths under full_path, relative to its parent folder.
+
+    Returns:
+        List like ['sync', 'sync/sub', ...], parents before children.
+    """
+    base = os.path.dirname(full_path)
+    folders = []
+    for root, _, _ in os.walk(full_path, topdown=True):
+        folders.append(os.path.relpath(root, base))
+    return folders
+
+
+def create_folders(service, folder_dirs, parents_id, failures):
+    """Creates folders on Drive, one batch request per tree level.
+
+    Args:
+        service: Google Drive service instance.
+        folder_dirs: Relative folder paths, e.g. 'sync/sub'.
+        parents_id: Dictionary of {relative folder path: folder's Drive ID},
+        new folders are added to it.
+        failures: List collecting (folder path, exception) of failed creates.
+
+    Returns:
+        Folder paths that were created.
+    """
+    created = []
+    for _, level in itertools.groupby(sorted(folder_dirs, key=by_lines), key=by_lines):
+        level = list(level)
+        requests, pending = [], []
+        for folder_dir in level:
+            parent_dir = os.path.dirname(folder_dir)
+            if parent_dir and parent_dir not in parents_id:
+                continue        # its parent failed to be created
+            parent = parents_id[parent_dir] if parent_dir else 'root'
+            folder_metadata = {'name': os.path.basename(folder_dir),
+                               'parents': [parent],
+                               'mimeType': FOLDER_MIME_TYPE}
+            requests.append(service.files().create(body=folder_metadata, fields='id'))
+            pending.append(folder_dir)
+        for folder_dir, (response, error) in zip(pending, execute_batched(service, requests)):
+            if error is not None:
+                failures.append((folder_dir, error))
+            else:
+                parents_id[folder_dir] = response['id']
+                created.append(folder_dir)
+    return created
+
+
+def file_media(file_dir, mime_type):
+    """Media body of a local file, resumable if it is larger than a chunk."""
+    return MediaFileUpload(file_dir, mimetype=mime_type, chunksize=UPLOAD_CHUNK_SIZE,
+                           resumable=os.path.getsize(file_dir) > UPLOAD_CHUNK_SIZE)
+
+
+def file_fingerprint(file_dir):
+    """Size and mtime of a local file, telling whether a saved upload still applies."""
+    stat = os.stat(file_dir)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime)
+
+
+def upload_new_file(service, file_dir, parent_id, manifest=None):
+    """Uploads a file that does not exist on Drive yet."""
+    file_metadata = {'name': os.path.basename(file_dir), 'parents': [parent_id]}
+    media = file_media(file_dir, mimetypes.MimeTypes().guess_type(file_dir)[0])
+    request = service.files().create(body=file_metadata,                # pylint: disable=no-member
+                                     media_body=media, fields='id, md5Checksum')
+    drive_file = execute_upload(request, file_dir, parent_id, file_fingerprint(file_dir))
+    if manifest is not None:
+        manifest.uploaded(file_dir, drive_file)
+    return drive_file
+
+
+def update_file(service, file_id, file_dir, mime_type, manifest=None):
+    """Uploads new content for a file that exists on Drive."""
+    request = service.files().update(fileId=file_id,                    # pylint: disable=no-member
+                                     media_body=file_media(file_dir, mime_type),
+                                     fields='id, md5Checksum')
+    drive_file = execute_upload(request, file_dir, file_id, file_fingerprint(file_dir))
+    if manifest is not None:
+        manifest.uploaded(file_dir, drive_file)
+    return drive_file
+
+
+def upload_folder_files(pool, full_path, folder_dirs, parents_id, manifest=None):
+    """Queues uploads of every file of newly created folders."""
+    base = os.path.dirname(full_path)
+    for folder_dir in folder_dirs:
+        variable = os.path.join(base, folder_dir)
+        for name in sorted(os.listdir(variable)):
+            file_dir = os.path.join(variable, name)
+            if os.path.isfile(file_dir):
+                pool.submit(file_dir, upload_new_file, file_dir, parents_id[folder_dir],
+                            manifest)
+
+
+def folder_upload(service, full_path=FULL_PATH, pool=None):
     '''Uploads folder and all it's content (if it doesnt exists)
     in root folder.
 
     Args:
-        items: List of folders in root path on Google Drive.
         service: Google Drive service instance.
+        full_path: Local folder to upload.
+        pool: TransferPool for the file uploads, by default a single
+        worker sharing service.
 
     Returns:
-        Dictionary, where keys are folder's names
+        Dictionary, where keys are relative folder paths
         and values are id's of these folders.
     '''
 
-    parents_id = {}
-
-    for root, _, files in os.walk(FULL_PATH, topdown=True):
-        last_dir = root.split('/')[-1]
-        pre_last_dir = root.split('/')[-2]
-        if pre_last_dir not in parents_id.keys():
-            pre_last_dir = []
-        else:
-            pre_last_dir = parents_id[pre_last_dir]
-
-        folder_metadata = {'name': last_dir,
-                           'parents': [pre_last_dir],
-                           'mimeType': 'application/vnd.google-apps.folder'}
-        create_folder = service.files().create(body=folder_metadata,
-                                               fields='id').execute()
-        folder_id = create_folder.get('id', [])
-
-        for name in files:
-            file_metadata = {'name': name, 'parents': [folder_id]}
-            media = MediaFileUpload(
-                os.path.join(root, name),
-                mimetype=mimetypes.MimeTypes().guess_type(name)[0])
-            service.files().create(body=file_metadata,
-                                   media_body=media,
-                                   fields='id').execute()
-
-        parents_id[last_dir] = folder_id
-
+    parents_id, failures = {}, []
+    own_pool = pool is None
+    pool = pool or TransferPool(lambda: service, workers=1)
+    folders = relative_folders(full_path)
+    created = create_folders(service, folders, parents_id, failures)
+    upload_folder_files(pool, full_path, created, parents_id)
+    failures.extend(pool.wait(shutdown=own_pool))
+    if failures:
+        raise SyncError(failures)
     return parents_id
 
 
-def check_upload(service):
+def check_upload(service, full_path=FULL_PATH, pool=None):
     """Checks if folder is already uploaded,
     and if it's not, uploads it.
 
     Args:
         service: Google Drive service instance.
+        full_path: Local folder to sync.
+        pool: TransferPool used if the folder has to be uploaded.
 
     Returns:
         ID of uploaded folder, full path to this folder on computer.
 
     """
 
-    results = service.files().list(
-        pageSize=100,
-        q="'root' in parents and trashed != True and \
-        mimeType='application/vnd.google-apps.folder'").execute()
-
-    items = results.get('files', [])
+    dir_name = os.path.basename(full_path)
+    items = list(list_files(service, root_folder_query(dir_name), fields='id, name'))
 
     # Check if folder exists, and then create it or get this folder's id.
-    if DIR_NAME in [item['name'] for item in items]:
+    if dir_name in [item['name'] for item in items]:
         folder_id = [item['id']for item in items
-                     if item['name'] == DIR_NAME][0]
+                     if item['name'] == dir_name][0]
     else:
-        parents_id = folder_upload(service)
-        folder_id = parents_id[DIR_NAME]
+        parents_id = folder_upload(service, full_path, pool)
+        folder_id = parents_id[dir_name]
+
+    return folder_id, full_path
+
+
 
-    return folder_id, FULL_PATH
 
+def root_folder_query(folder_name):
+    """Drive query for a folder named folder_name in My Drive."""
+    return "'root' in parents and name = {} and trashed != True and " \
+        "mimeType = '{}'".format(quote(folder_name), FOLDER_MIME_TYPE)
 
 
+def note_folder_id(service, folder_name=DIR_NAME, create=True):
+    """Drive ID of the folder notes are synced to.
+
+    Args:
+        service: Google Drive service instance.
+        folder_name: Name of the sync folder in My Drive.
+        create: Create the folder if it does not exist.
+
+    Returns:
+        The folder's ID, None if it does not exist and create is False.
+    """
+    for item in list_files(service, root_folder_query(folder_name), fields='id'):
+        return item['id']
+    if not create:
+        return None
+    folder_metadata = {'name': folder_name, 'parents': ['root'], 'mimeType': FOLDER_MIME_TYPE}
+    return service.files().create(body=folder_metadata,                # pylint: disable=no-member
+                                  fields='id').execute()['id']
+
+
+def upload_note(service, title, data, drive_id=None, folder_name=DIR_NAME):
+    """Uploads one note straight from memory.
+
+    A note already on Drive is renamed and updated in place with a single
+    files().update call. A new note, or one whose Drive copy is gone, is
+    created in the sync folder. Notes larger than an upload chunk go up
+    resumably.
+
+    Args:
+        service: Google Drive service instance.
+        title: Note title, the Drive file is named <title>.txt.
+        data: Note text.
+        drive_id: Drive ID of the note's file, if it was uploaded before.
+        folder_name: Name of the sync folder in My Drive.
+
+    Returns:
+        Drive file metadata with its id and md5Checksum.
+    """
+    body = {'name': title + '.txt'}
+    payload = data.encode('utf-8')
+    key = 'note:' + title
+    fingerprint = hashlib.md5(payload).hexdigest()
+
+    def media():
+        return MediaIoBaseUpload(io.BytesIO(payload), mimetype=NOTE_MIME_TYPE,
+                                 chunksize=UPLOAD_CHUNK_SIZE,
+                                 resumable=len(payload) > UPLOAD_CHUNK_SIZE)
+
+    def create(parent_id):
+        body['parents'] = [parent_id]
+        request = service.files().create(body=body,                    # pylint: disable=no-member
+                                         media_body=media(), fields='id, md5Checksum')
+        return execute_upload(request, key, parent_id, fingerprint)
+
+    if drive_id:
+        try:
+            request = service.files().update(  # pylint: disable=no-member
+                fileId=drive_id, body=body, media_body=media(), fields='id, md5Checksum')
+            return execute_upload(request, key, drive_id, fingerprint)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+    try:
+        return create(SESSION.folder_id(service, folder_name))
+    except HttpError as error:
+        if error.resp.status != 404:
+            raise
+    # The cached sync folder is gone, look it up (or create it) again
+    SESSION.forget_folder(folder_name)
+    return create(SESSION.folder_id(service, folder_name))
+
 
 def get_credentials():
     """Gets valid user credentials from storage.
@@ -166,85 +328,121 @@ def get_credentials():
     return credentials
 
 
-def get_tree(folder_name, tree_list, root, parents_id, service):
-    """Gets folder tree relative paths.
+def by_lines(input_str):
+    """Helps Sort items by the number of slashes in it.
+
+    Returns:
+        Number of slashes in string.
+    """
+    return input_str.count(os.path.sep)
+
+
+class DriveSession:
+    """Drive connection state shared by every sync of the process.
 
-    Recursively gets through subfolders, remembers their names ad ID's.
+    Credentials are read once. Each thread builds its authorized HTTP
+    connection and its service once, httplib2 not being thread-safe, from
+    the discovery document bundled with googleapiclient rather than one
+    fetched over the network. Sync folder IDs are looked up once, and
+    looked up again after Drive answers 404 for them. oauth2client
+    refreshes expired access tokens on the fly.
 
     Args:
-        folder_name: Name of folder, initially
-        name of parent folder string.
-        folder_id: ID of folder, initially ID of parent folder.
-        tree_list: List of relative folder paths, initially
-        empy list.
-        root: Current relative folder path, initially empty string.
-        parents_id: Dictionary with pairs of {key:value} like
-        {folder's name: folder's Drive ID}, initially empty dict.
-        service: Google Drive service instance.
+        make_service: Callable returning a new service instance, by default
+        one authorized with get_credentials().
+    """
 
-    Returns:
-        List of folder tree relative folder paths.
+    def __init__(self, make_service=None):
+        self.make_service = make_service or self.authorized_service
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.credentials = None
+        self.folder_ids = {}
 
-    """
-    folder_id = parents_id[folder_name]
+    def authorized_service(self):
+        """Builds a service on a new connection sharing the credentials."""
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = get_credentials()
+        http = self.credentials.authorize(build_http())
+        return discovery.build('drive', 'v3', http=http, static_discovery=True)
 
-    results = service.files().list(
-        pageSize=1000,
-        q=("%r in parents and \
-        mimeType = 'application/vnd.google-apps.folder'and \
-        trashed != True" % folder_id)).execute()
+    def service(self):
+        """The calling thread's service instance."""
+        if getattr(self.local, 'service', None) is None:
+            self.local.service = self.make_service()
+        return self.local.service
 
-    items = results.get('files', [])
-    root += folder_name + os.path.sep
+    def forget_service(self):
+        """Drops the calling thread's service, the next one is built anew."""
+        self.local.service = None
 
-    for item in items:
-        parents_id[item['name']] = item['id']
-        tree_list.append(root + item['name'])
-        folder_id = [i['id'] for i in items
-                     if i['name'] == item['name']][0]
-        folder_name = item['name']
-        get_tree(folder_name, tree_list,
-                 root, parents_id, service)
+    def folder_id(self, service, folder_name=DIR_NAME, create=True):
+        """Cached note_folder_id."""
+        with self.lock:
+            folder_id = self.folder_ids.get(folder_name)
+        if folder_id is None:
+            folder_id = note_folder_id(service, folder_name, create)
+            if folder_id is not None:
+                with self.lock:
+                    self.folder_ids[folder_name] = folder_id
+        return folder_id
 
+    def forget_folder(self, folder_name=DIR_NAME):
+        """Drops a cached folder ID that Drive no longer knows."""
+        with self.lock:
+            self.folder_ids.pop(folder_name, None)
 
-def by_lines(input_str):
-    """Helps Sort items by the number of slashes in it.
 
-    Returns:
-        Number of slashes in string.
-    """
-    return input_str.count(os.path.sep)
+SESSION = DriveSession()
+
 
+def build_service():
+    """Authorized Google Drive service of the calling thread, built once."""
+    return SESSION.service()
 
-def main():
+
+def drop_service():
+    """Makes build_service build a new service, as after a broken connection."""
+    SESSION.forget_service()
+
+
+def main(full_path=FULL_PATH, make_service=build_service, workers=None):
     """Syncronizes computer folder with Google Drive folder.
 
     Checks files if they exist, uploads new files and subfolders,
     deletes old files from Google Drive and refreshes existing stuff.
+    A file is uploaded when its md5 differs from the Drive copy's; local
+    md5s come from the sync Manifest. What is on Drive comes from the
+    saved RemoteTree, brought up to date through the Changes API.
+    Metadata calls (folder creation, deletes) go out as batch requests,
+    file content is transferred by a pool of workers; a failed call is
+    recorded and the rest of the sync carries on.
+
+    Args:
+        full_path: Local folder to sync.
+        make_service: Callable returning a new Google Drive service
+        instance, called once here and once per transfer worker.
+        workers: Number of concurrent file transfers.
+
+    Raises:
+        SyncError: Listing every operation that failed.
     """
-    credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-
-    # Get id of Google Drive folder and it's path (from other script)
-    # folder_id, full_path = initial_upload.check_upload(service)
-    folder_id, full_path = check_upload(service)
-    folder_name = full_path.split(os.path.sep)[-1]
-    tree_list = []
-    root = ''
-    parents_id = {}
-
-    parents_id[folder_name] = folder_id
-    get_tree(folder_name, tree_list, root, parents_id, service)
-    os_tree_list = []
-    root_len = len(full_path.split(os.path.sep)[0:-2])
-
-    # Get list of folders three paths on computer
-    for root, dirs, files in os.walk(full_path, topdown=True):
-        for name in dirs:
-            var_path = (os.path.sep).join(
-                root.split(os.path.sep)[root_len + 1:])
-            os_tree_list.append(os.path.join(var_path, name))
+    service = make_service()
+    pool = TransferPool(make_service, workers)
+    manifest = Manifest(full_path)
+    failures = []
+
+    # Get id of Google Drive folder and what it holds
+    tree = sync_tree(service, full_path,
+                     lambda: check_upload(service, full_path, pool)[0])
+    folder_name = os.path.basename(full_path)
+    remote = tree.paths(folder_name)
+    parents_id = {path: item['id'] for path, item in remote.items()
+                  if item['mimeType'] == FOLDER_MIME_TYPE}
+    tree_list = list(parents_id)
+    parents_id[folder_name] = tree.folder_id
+    os_tree_list = relative_folders(full_path)[1:]
 
     # old folders on drive
     remove_folders = list(set(tree_list).difference(set(os_tree_list)))
@@ -255,137 +453,61 @@ def main():
 
     # Add starting directory
     exact_folders.append(folder_name)
-    # Sort uploadable folders
-    # so now in can be upload from top to down of tree
-    upload_folders = sorted(upload_folders, key=by_lines)
+    var = os.path.dirname(full_path) + os.path.sep
 
-    # Here we upload new (abcent on Drive) folders
-    for folder_dir in upload_folders:
-        var = os.path.join(full_path.split(os.path.sep)[0:-1]) + os.path.sep
-        variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-        pre_last_dir = folder_dir.split(os.path.sep)[-2]
-
-        files = [f for f in os.listdir(variable)
-                 if os.path.isfile(os.path.join(variable, f))]
-
-        folder_metadata = {'name': last_dir,
-                           'parents': [parents_id[pre_last_dir]],
-                           'mimeType': 'application/vnd.google-apps.folder'}
-        create_folder = service.files().create(                  # pylint: disable=no-member
-            body=folder_metadata, fields='id').execute()
-        folder_id = create_folder.get('id', [])
-        parents_id[last_dir] = folder_id
-
-        for os_file in files:
-            some_metadata = {'name': os_file, 'parents': [folder_id]}
-            os_file_mimetype = mimetypes.MimeTypes().guess_type(
-                os.path.join(variable, os_file))[0]
-            media = MediaFileUpload(os.path.join(variable, os_file),
-                                    mimetype=os_file_mimetype)
-            upload_this = service.files().create(body=some_metadata,                  # pylint: disable=no-member
-                                                 media_body=media,
-                                                 fields='id').execute()
-            upload_this = upload_this.get('id', [])
+    # Here we upload new (abcent on Drive) folders, level by level
+    created = create_folders(service, upload_folders, parents_id, failures)
+    upload_folder_files(pool, full_path, created, parents_id, manifest)
 
     # Check files in existed folders and replace them
     # with newer versions if needed
-    for folder_dir in exact_folders:
-
-        var = (os.path.sep).join(full_path.split(
-            os.path.sep)[0:-1]) + os.path.sep
+    drive_files = defaultdict(list)
+    for path, item in remote.items():
+        if item['mimeType'] != FOLDER_MIME_TYPE:
+            drive_files[os.path.dirname(path)].append(item)
 
+    for folder_dir in exact_folders:
         variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-        # print(last_dir, folder_dir)
         os_files = [f for f in os.listdir(variable)
                     if os.path.isfile(os.path.join(variable, f))]
-        results = service.files().list(                            # pylint: disable=no-member
-            pageSize=1000, q=('%r in parents and \
-            mimeType!="application/vnd.google-apps.folder" and \
-            trashed != True' % parents_id[last_dir]),
-            fields="files(id, name, mimeType, \
-            modifiedTime, md5Checksum)").execute()
 
-        items = results.get('files', [])
+        items = drive_files[folder_dir]
 
         refresh_files = [f for f in items if f['name'] in os_files]
-        remove_files = [f for f in items if f['name'] not in os_files]             # pylint: disable=unused-variable
         upload_files = [f for f in os_files
                         if f not in [j['name']for j in items]]
 
         # Check files that exist both on Drive and on PC
         for drive_file in refresh_files:
             file_dir = os.path.join(variable, drive_file['name'])
-            file_time = os.path.getmtime(file_dir)
-            mtime = [f['modifiedTime']
-                     for f in items if f['name'] == drive_file['name']][0]
-            mtime = datetime.datetime.strptime(
-                mtime[:-2], "%Y-%m-%dT%H:%M:%S.%f")
-            drive_time = time.mktime(mtime.timetuple())
-            # print(drive_file['name'])
-            # if file['mimeType'] in GOOGLE_MIME_TYPES.keys():
-            # print(file['name'], file['mimeType'])
-            # print()
-            os_file_md5 = hashlib.md5(open(file_dir, 'rb').read()).hexdigest()
-            if 'md5Checksum' in drive_file.keys():
-                # print(1, file['md5Checksum'])
-                drive_md5 = drive_file['md5Checksum']
-                # print(2, os_file_md5)
-            else:
-                # print('No hash')
-                drive_md5 = None
-                # print(drive_md5 != os_file_md5)
-
-            if (file_time > drive_time) or (drive_md5 != os_file_md5):
-                file_id = [f['id'] for f in items
-                           if f['name'] == drive_file['name']][0]
-                file_mime = [f['mimeType'] for f in items
-                             if f['name'] == drive_file['name']][0]
-
-                # File's new content.
-                # file_mime = mimetypes.MimeTypes().guess_type(file_dir)[0]
-                file_metadata = {'name': drive_file['name'],
-                                 'parents': [parents_id[last_dir]]}
-                # media_body = MediaFileUpload(file_dir, mimetype=filemime)
-                media_body = MediaFileUpload(file_dir, mimetype=file_mime)
-                # print('I am HERE, ', )
-                service.files().update(fileId=file_id,                     # pylint: disable=no-member
-                                       media_body=media_body,
-                                       fields='id').execute()
-
-        # # Remove old files from Drive
-        # for drive_file in remove_files:
-
-        #     file_id = [f['id'] for f in items
-        #                if f['name'] == drive_file['name']][0]
-        #     service.files().delete(fileId=file_id).execute()
+            os_file_md5 = manifest.local_md5(file_dir)
+            drive_md5 = drive_file.get('md5Checksum')
+
+            if drive_md5 != os_file_md5:
+                pool.submit(file_dir, update_file, drive_file['id'], file_dir,
+                            drive_file['mimeType'], manifest)
 
         # Upload new files on Drive
         for os_file in upload_files:
-
             file_dir = os.path.join(variable, os_file)
-
-            # File's new content.
-            filemime = mimetypes.MimeTypes().guess_type(file_dir)[0]
-            file_metadata = {'name': os_file,
-                             'parents': [parents_id[last_dir]]}
-            media_body = MediaFileUpload(file_dir, mimetype=filemime)
-
-            service.files().create(body=file_metadata,                      # pylint: disable=no-member
-                                   media_body=media_body,
-                                   fields='id').execute()
-
-    remove_folders = sorted(remove_folders, key=by_lines, reverse=True)
-
-    # Delete old folders from Drive
-    for folder_dir in remove_folders:
-        var = (os.path.sep).join(full_path.split(
-            os.path.sep)[0:-1]) + os.path.sep
-        variable = var + folder_dir
-        last_dir = folder_dir.split('/')[-1]
-        folder_id = parents_id[last_dir]
-        service.files().delete(fileId=folder_id).execute()                     # pylint: disable=no-member
+            pool.submit(file_dir, upload_new_file, file_dir, parents_id[folder_dir],
+                        manifest)
+
+    # Delete old folders from Drive; deleting a folder deletes its subfolders,
+    # so only the topmost removed folders are sent
+    remove_set = set(remove_folders)
+    remove_folders = sorted(folder_dir for folder_dir in remove_folders
+                            if os.path.dirname(folder_dir) not in remove_set)
+    deletes = execute_batched(service, [
+        service.files().delete(fileId=parents_id[folder_dir])  # pylint: disable=no-member
+        for folder_dir in remove_folders])
+    failures.extend((folder_dir, error) for folder_dir, (_, error)
+                    in zip(remove_folders, deletes) if error is not None)
+    failures.extend(pool.wait())
+    manifest.save()
+
+    if failures:
+        raise SyncError(failures)
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,105 @@
 import os
 
+from peewee import Tuple
 
-def get_paginated_entries(seq, index, page_size):
-    if index + page_size > len(seq):
-        return seq[index:]
-    return seq[index:index+page_size]
+
+class KeysetPager:
+    """
+    Pages through a query newest first by (timestamp, id), seeking from the
+    first or last row of the current page instead of using OFFSET. Each page
+    fetches page_size + 1 rows, the extra one only to know if more exist.
+    """
+
+    def __init__(self, query, timestamp, key, page_size):
+        self.query = query
+        self.timestamp = timestamp
+        self.key = key
+        self.page_size = page_size
+        self.page = []
+        self.has_next = False
+        self.has_previous = False
+
+    def _cursor(self, row):
+        return Tuple(self.timestamp.db_value(getattr(row, self.timestamp.name)),
+                     self.key.db_value(getattr(row, self.key.name)))
+
+    def _fetch(self, where, ascending):
+        order = (self.timestamp.asc(), self.key.asc()) if ascending \
+            else (self.timestamp.desc(), self.key.desc())
+        query = self.query.order_by(*order).limit(self.page_size + 1)
+        if where is not None:
+            query = query.where(where)
+        return list(query)
+
+    def first(self):
+        rows = self._fetch(None, False)
+        self.page = rows[:self.page_size]
+        self.has_next = len(rows) > self.page_size
+        self.has_previous = False
+        return self.page
+
+    def next(self):
+        if not self.has_next:
+            return self.page
+        columns = Tuple(self.timestamp, self.key)
+        rows = self._fetch(columns < self._cursor(self.page[-1]), False)
+        self.page = rows[:self.page_size]
+        self.has_next = len(rows) > self.page_size
+        self.has_previous = True
+        return self.page
+
+    def previous(self):
+        if not self.has_previous:
+            return self.page
+        columns = Tuple(self.timestamp, self.key)
+        rows = self._fetch(columns > self._cursor(self.page[0]), True)
+        self.page = rows[:self.page_size][::-1]
+        self.has_previous = len(rows) > self.page_size
+        self.has_next = True
+        return self.page
+
+
+class ListPager:
+    """
+    Pages through the rows of a query in the order of a list of keys, such
+    as search results ranked best first. Same interface as KeysetPager;
+    rows gone since the list was made are skipped.
+    """
+
+    def __init__(self, query, key, keys, page_size):
+        self.query = query
+        self.key = key
+        self.keys = list(keys)
+        self.page_size = page_size
+        self.start = 0
+        self.page = []
+        self.has_next = False
+        self.has_previous = False
+
+    def _fetch(self):
+        keys = self.keys[self.start:self.start + self.page_size]
+        rows = {getattr(row, self.key.name): row
+                for row in self.query.where(self.key.in_(keys))} if keys else {}
+        self.page = [rows[key] for key in keys if key in rows]
+        self.has_next = self.start + self.page_size < len(self.keys)
+        self.has_previous = self.start > 0
+        return self.page
+
+    def first(self):
+        self.start = 0
+        return self._fetch()
+
+    def next(self):
+        if not self.has_next:
+            return self.page
+        self.start += self.page_size
+        return self._fetch()
+
+    def previous(self):
+        if not self.has_previous:
+            return self.page
+        self.start = max(self.start - self.page_size, 0)
+        return self._fetch()
 
 
 def clear_screen():
@@ -0,0 +1,224 @@
+"""Key hierarchy of the notes.
+
+Notes used to be encrypted directly under SHA256(password), with that
+hash stored next to each of them, so changing a password meant
+re-encrypting every note and version. Each password now has a vault: a
+random master key wrapped by a key derived from the password with scrypt.
+Every note is encrypted under its own random data key, wrapped by the
+master key. Unlocking runs the KDF once and checks the password against
+the vault rather than each row; a password change re-wraps the master key
+alone. Notes saved under the old scheme move into the vault of their
+password the first time it is unlocked.
+"""
+import os
+
+from Cryptodome.Protocol.KDF import scrypt
+
+import models as m
+import storage
+import text_cache
+import crypto as Crypto
+
+# scrypt cost of new vaults, N = 2 ** KDF_COST
+KDF_COST = int(os.getenv('NOTES_KDF_COST', '15'))
+KDF_BLOCK_SIZE = 8
+KEY_SIZE = 32
+SALT_SIZE = 16
+# Blinded with the derived key, finds the vault of a password without trying each
+KEY_ID = 'vault key id'
+crypto = Crypto.Crypto()  # pylint: disable=invalid-name
+
+
+def derive(password, salt, cost):
+    """Key wrapping a vault's master key, derived from the password"""
+    return Crypto.SessionKey(scrypt(password, bytes.fromhex(salt), KEY_SIZE, 2 ** cost,
+                                    KDF_BLOCK_SIZE, 1))
+
+
+def wrap(secret, key):
+    """Encrypt a key under another one"""
+    return crypto.encrypt(secret.hex(), key)
+
+
+def unwrap(wrapped, key):
+    """Decrypt a wrapped key, ValueError if key is not the one it was wrapped with"""
+    return bytes.fromhex(crypto.decrypt(wrapped, key))
+
+
+class Keyring:
+    """
+    An unlocked vault
+    :param vault: Vault row
+    :param master: SessionKey of its master key
+    """
+
+    def __init__(self, vault, master):
+        self.vault = vault
+        self.master = master
+        # Note keys handed out, by wrapped data key, so opening a note again reuses its key
+        self.note_keys = {}
+
+    def owns(self, note):
+        return note.vault_id == self.vault.id
+
+    def notes(self, *fields):
+        """Query of the notes in the vault"""
+        return m.Note.select(*fields).where(m.Note.vault == self.vault.id)
+
+    def note_key(self, note):
+        """SessionKey of a note of the vault, its content and versions are encrypted under it"""
+        key = self.note_keys.get(note.data_key)
+        if key is None:
+            key = self.note_keys[note.data_key] = self._note_key(note)
+        return key
+
+    def _note_key(self, note):
+        if not self.owns(note):
+            raise ValueError("Note is not in this vault")
+        return self.master.child(unwrap(note.data_key, self.master))
+
+    def new_note_key(self):
+        """
+        Data key for a new note
+        :return: (wrapped key to store with the note, its SessionKey)
+        """
+        data_key = os.urandom(KEY_SIZE)
+        wrapped = wrap(data_key, self.master)
+        self.note_keys[wrapped] = self.master.child(data_key)
+        return wrapped, self.note_keys[wrapped]
+
+    def decrypt_many(self, notes, workers=None):
+        """Decrypt notes of the vault, yielding a BatchResult for each, as Crypto.decrypt_many"""
+        def decrypt(note):
+            key = self._note_key(note)
+            try:
+                return crypto.decrypt(note.content, key)
+            finally:
+                key.zero()
+        return Crypto.ordered_map(decrypt, notes, workers)
+
+    def zero(self):
+        """Overwrite the master key and every note key handed out"""
+        for key in list(self.note_keys.values()):
+            key.zero()
+        self.note_keys = {}
+        self.master.zero()
+
+
+def _open(password):
+    """
+    The vault password unlocks and its master key, one KDF run per
+    salt and cost in use
+    :return: (vault, master key bytes), (None, None) if no vault uses password
+    """
+    for salt, cost in m.Vault.select(m.Vault.salt, m.Vault.cost).distinct().tuples():
+        derived = derive(password, salt, cost)
+        try:
+            vault = m.Vault.get_or_none((m.Vault.salt == salt) & (m.Vault.cost == cost) &
+                                        (m.Vault.key_id == derived.blind(KEY_ID)))
+            if vault is not None:
+                return vault, unwrap(vault.wrapped_key, derived)
+        finally:
+            derived.zero()
+    return None, None
+
+
+def find(password):
+    """Keyring of the vault password unlocks, None if no vault uses it"""
+    vault, master = _open(password)
+    return Keyring(vault, Crypto.SessionKey(master)) if vault else None
+
+
+def create(password):
+    """
+    New vault for password. It shares the salt of the vaults already there,
+    so finding the vault of a password still runs the KDF once.
+    """
+    existing = m.Vault.select(m.Vault.salt).where(m.Vault.cost == KDF_COST).first()
+    salt = existing.salt if existing else os.urandom(SALT_SIZE).hex()
+    derived = derive(password, salt, KDF_COST)
+    master = os.urandom(KEY_SIZE)
+    vault = m.Vault.create(salt=salt, cost=KDF_COST, key_id=derived.blind(KEY_ID),
+                           wrapped_key=wrap(master, derived))
+    derived.zero()
+    return Keyring(vault, Crypto.SessionKey(master))
+
+
+def legacy_notes(password):
+    """Query of the notes encrypted under SHA256(password), outside any vault"""
+    return m.Note.select().where(m.Note.vault.is_null() &
+                                 (m.Note.password == crypto.key_to_store(password)))
+
+
+def adopt(keyring, password):
+    """
+    Move the older notes of password into the vault, re-encrypting each
+    and its versions under a new data key. Search terms blinded under the
+    old key are dropped, search_index.backfill indexes the notes again.
+    :return: number of notes moved
+    """
+    legacy = Crypto.SessionKey.from_password(password)
+    count = 0
+    for note in legacy_notes(password):
+        versions = list(m.Versions.select(m.Versions.id, m.Versions.content)
+                        .where(m.Versions.note == note))
+        try:
+            # Bytes, as deltas are binary
+            texts = [crypto.decrypt_bytes(row.content, legacy) for row in [note] + versions]
+        except ValueError:
+            continue
+        data_key, key = keyring.new_note_key()
+        with storage.transaction():
+            note.content = crypto.encrypt_bytes(texts[0], key)
+            note.vault, note.data_key, note.password = keyring.vault, data_key, None
+            note.save()
+            for version, text in zip(versions, texts[1:]):
+                m.Versions.update(content=crypto.encrypt_bytes(text, key)) \
+                    .where(m.Versions.id == version.id).execute()
+            m.SearchTerm.delete().where(m.SearchTerm.note == note).execute()
+        text_cache.cache.invalidate(note.id)
+        count += 1
+    legacy.zero()
+    return count
+
+
+def unlock(password, create_missing=True):
+    """
+    Keyring of the vault of password, moving its older notes into it
+    :param create_missing: create the vault if there is none, it always is
+        if older notes use password
+    :return: Keyring, None if password has no vault and none was created
+    """
+    keyring = find(password)
+    if keyring is None and (create_missing or legacy_notes(password).exists()):
+        keyring = create(password)
+    if keyring is not None:
+        adopt(keyring, password)
+    return keyring
+
+
+def change_password(old_password, new_password):
+    """
+    Re-wrap the master key of the vault of old_password under new_password,
+    the notes and their data keys are left as they are. Older notes of
+    old_password move into the vault.
+    Raises ValueError if no notes use old_password, or a vault new_password.
+    """
+    vault, master = _open(old_password)
+    if vault is None and not legacy_notes(old_password).exists():
+        raise ValueError("No notes are protected by this password")
+    other = find(new_password)
+    if other is not None:
+        other.zero()
+        raise ValueError("Other notes are already protected by the new password")
+    if vault is None:
+        keyring = create(new_password)
+    else:
+        derived = derive(new_password, vault.salt, vault.cost)
+        vault.key_id, vault.wrapped_key = derived.blind(KEY_ID), wrap(master, derived)
+        derived.zero()
+        with storage.transaction():
+            vault.save()
+        keyring = Keyring(vault, Crypto.SessionKey(master))
+    adopt(keyring, old_password)
+    keyring.zero()
@@ -0,0 +1,116 @@
+"""Delta compressed storage for note versions.
+
+The newest version of a note is stored in full. When a new version is
+added, the previous newest one is rewritten as a reverse delta against
+it, so older versions are rebuilt by walking the chain from the newest
+full copy. Deltas are line based, zlib compressed and then encrypted.
+"""
+import base64
+import difflib
+import json
+import zlib
+
+import models as m
+import crypto as Crypto
+import text_cache
+
+MAX_VERSIONS = 10
+crypto = Crypto.Crypto()  # pylint: disable=invalid-name
+
+
+def make_delta(newer, older):
+    """
+    Describe older in terms of newer
+    :return: list of [start, end] line ranges copied from newer and literal strings
+    """
+    newer_lines = newer.splitlines(True)
+    older_lines = older.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, newer_lines, older_lines, autojunk=False)
+    ops = []
+    for tag, i_1, i_2, j_1, j_2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i_1, i_2])
+        elif j_2 > j_1:
+            ops.append(''.join(older_lines[j_1:j_2]))
+    return ops
+
+
+def apply_delta(newer, ops):
+    """Rebuild the older text from newer and the ops made by make_delta"""
+    newer_lines = newer.splitlines(True)
+    parts = []
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(newer_lines[op[0]:op[1]])
+    return ''.join(parts)
+
+
+def pack_delta(ops, key):
+    return crypto.encrypt_bytes(zlib.compress(json.dumps(ops, separators=(',', ':')).encode(), 9),
+                                key)
+
+
+def unpack_delta(content, key):
+    packed = crypto.decrypt_bytes(content, key)
+    if not packed.startswith(b'x'):
+        # Deltas were written as unpadded base64, zlib data starts with 0x78
+        packed = base64.b64decode(packed + b'=' * (-len(packed) % 4))
+    return json.loads(zlib.decompress(packed).decode())
+
+
+def add_version(note, text, key, title=None):
+    """
+    Store text as the newest version of note and prune the oldest ones
+    :return: the created Versions row
+    """
+    title = title or note.title
+    newest = m.Versions.select().where(m.Versions.note == note) \
+        .order_by(m.Versions.version_no.desc()).first()
+    version_no = newest.version_no + 1 if newest else 1
+    if newest and not newest.is_delta:
+        ops = make_delta(text, crypto.decrypt(newest.content, key))
+        newest.content = pack_delta(ops, key)
+        newest.is_delta = True
+        newest.save()
+    m.Versions.delete().where((m.Versions.note == note) &
+                              (m.Versions.version_no <= version_no - MAX_VERSIONS)).execute()
+    return m.Versions.create(note=note, version_no=version_no, is_delta=False,
+                             content=crypto.encrypt(text, key),
+                             title=str(version_no) + '_' + title)
+
+
+def version_text(version, key):
+    """
+    Decrypt a version, replaying deltas from the nearest newer full copy.
+    Versions never change their text, so it is cached by row
+    """
+    text = text_cache.cache.get(text_cache.VERSION, version.note_id, version.id,
+                                version.version_no, key)
+    if text is None:
+        text = _version_text(version, key)
+        text_cache.cache.put(text_cache.VERSION, version.note_id, version.id,
+                             version.version_no, key, text)
+    return text
+
+
+def _version_text(version, key):
+    if version.content is None:
+        version = m.Versions.get_by_id(version.id)
+    if not version.is_delta:
+        return crypto.decrypt(version.content, key)
+    chain = [version]
+    newer = m.Versions.select().where((m.Versions.note == version.note_id) &
+                                      (m.Versions.version_no > version.version_no)) \
+        .order_by(m.Versions.version_no)
+    for row in newer:
+        if not row.is_delta:
+            text = crypto.decrypt(row.content, key)
+            break
+        chain.append(row)
+    else:
+        raise ValueError('No full copy newer than version {}'.format(version.version_no))
+    for row in reversed(chain):
+        text = apply_delta(text, unpack_delta(row.content, key))
+    return text